@@ -0,0 +1,284 @@
+# ~/qwen-api/affinity_router.py
+"""
+Cache-affinity routing tier in front of several API replicas.
+
+Each replica keeps state that only helps requests that land on it: the
+in-process response cache (memory_cache), prompt KV prefixes and resident
+LoRA adapters. Round-robin spreads requests sharing a prompt over all
+replicas, each warms its own copy and hit rates fall as replicas are added.
+This router sends requests with the same affinity key to the same replica:
+
+- the X-Conversation-Id header if the client sends one (a chat, an editor
+  session), else
+- `model` plus the first ROUTER_PREFIX_CHARS of the prompt, whitespace
+  collapsed: `prompt` for /v1/generate, the last user message for chat
+  (that is what the server prefills), the code before the cursor for
+  /v1/completions, the first input for /v1/embeddings.
+
+Keys are placed on a consistent-hash ring (ROUTER_VNODES points per
+replica), so adding or removing a replica only moves the keys it owns.
+Load is bounded: a replica takes a request only while its load is below
+ROUTER_LOAD_FACTOR x the average load (plus this request); otherwise the
+next replica on the ring gets it, so a hot prefix spills over instead of
+queueing on one replica. A replica's load is the larger of the router's own
+in-flight count and the in_flight it reports in /health, which is polled
+every ROUTER_HEALTH_INTERVAL seconds; replicas failing it or without a
+loaded model get no traffic. Requests without a key go to the least loaded
+replica.
+
+    ROUTER_REPLICAS=http://api-1:8000,http://api-2:8000 python affinity_router.py
+
+nginx then proxies to the router instead of a replica. Responses carry
+X-Replica (set by the replica) and X-Routing: affinity, overflow or any.
+"""
+import asyncio
+import itertools
+import logging
+import math
+import os
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import Counter, Gauge, generate_latest
+
+from hash_ring import HashRing
+from serialization import loads
+
+logging.basicConfig(
+    level=getattr(logging, os.getenv("LOG_LEVEL", "INFO")),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+ROUTER_REPLICAS = [url.strip().rstrip("/") for url in os.getenv("ROUTER_REPLICAS", "").split(",") if url.strip()]
+ROUTER_VNODES = int(os.getenv("ROUTER_VNODES", "160"))
+ROUTER_LOAD_FACTOR = float(os.getenv("ROUTER_LOAD_FACTOR", "1.25"))
+ROUTER_PREFIX_CHARS = int(os.getenv("ROUTER_PREFIX_CHARS", "256"))
+ROUTER_HEALTH_INTERVAL = float(os.getenv("ROUTER_HEALTH_INTERVAL", "2"))
+ROUTER_TIMEOUT = float(os.getenv("ROUTER_TIMEOUT", "600"))
+# Replicas only accept their API_DOMAIN as Host (TrustedHostMiddleware), health checks send it
+API_DOMAIN = os.getenv("API_DOMAIN", "localhost")
+
+CONVERSATION_HEADER = "x-conversation-id"
+# Hop-by-hop headers stay between the two ends of one connection
+HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+    "transfer-encoding", "upgrade"
+}
+
+ROUTER_REQUESTS = Counter('qwen_router_requests_total', 'Requests routed per replica', ['replica', 'routing'])
+ROUTER_FAILOVERS = Counter('qwen_router_failovers_total', 'Requests resent to another replica after a connect error')
+ROUTER_REPLICA_LOAD = Gauge('qwen_router_replica_load', 'Replica load as seen by the router', ['replica'], multiprocess_mode='max')
+ROUTER_REPLICA_HEALTHY = Gauge('qwen_router_replica_healthy', 'Replica passes health checks (1/0)', ['replica'], multiprocess_mode='max')
+
+
+def prompt_text(path: str, data: Dict) -> str:
+    """The part of a request body the replica prefills first"""
+    if path.endswith("/chat/completions"):
+        users = [m.get("content") for m in data.get("messages") or [] if isinstance(m, dict) and m.get("role") == "user"]
+        value = users[-1] if users else ""
+    elif path.endswith("/completions"):
+        value = data.get("prefix")
+    else:
+        value = data.get("prompt", data.get("input"))
+        if isinstance(value, list):
+            value = value[0] if value else ""
+    return value if isinstance(value, str) else ""
+
+
+def affinity_key(path: str, headers, body: bytes) -> Optional[str]:
+    """Routing key of a request, None if it has nothing worth keeping together"""
+    conversation = headers.get(CONVERSATION_HEADER)
+    if conversation:
+        return f"conversation:{conversation}"
+    if not body:
+        return None
+    try:
+        data = loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    # Collapsing whitespace only needs to see a little more than the prefix kept
+    text = " ".join(prompt_text(path, data)[:4 * ROUTER_PREFIX_CHARS].split())[:ROUTER_PREFIX_CHARS]
+    if not text:
+        return None
+    return f"{data.get('model') or ''}\n{text}"
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = False  # until the first health check passes
+        self.in_flight = 0
+        self.reported = 0
+
+    @property
+    def load(self) -> int:
+        return max(self.in_flight, self.reported)
+
+
+class AffinityRouter:
+    """Consistent hashing with bounded loads over the replica URLs.
+
+    policy "round_robin" ignores keys and load, the baseline to compare with.
+    """
+
+    def __init__(self, urls: List[str] = ROUTER_REPLICAS, load_factor: float = ROUTER_LOAD_FACTOR,
+                 vnodes: int = ROUTER_VNODES, policy: str = "affinity"):
+        if not urls:
+            raise ValueError("No replicas configured (ROUTER_REPLICAS)")
+        self.replicas = {url: Replica(url) for url in urls}
+        self.ring = HashRing(urls, vnodes)
+        self.load_factor = load_factor
+        self.policy = policy
+        self.turn = itertools.count()
+        self.client: Optional[httpx.AsyncClient] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def choose(self, key: Optional[str], exclude: Tuple[str, ...] = ()) -> Tuple[Replica, str]:
+        healthy = [r for r in self.replicas.values() if r.healthy and r.url not in exclude]
+        if not healthy:
+            raise HTTPException(status_code=503, detail="No healthy replica")
+        if self.policy == "round_robin":
+            return healthy[next(self.turn) % len(healthy)], "any"
+        if key is None:
+            return min(healthy, key=lambda r: r.load), "any"
+
+        # The least loaded replica is always below this, so the walk finds one
+        capacity = math.ceil(self.load_factor * (sum(r.load for r in healthy) + 1) / len(healthy))
+        for position, url in enumerate(self.ring.walk(key)):
+            replica = self.replicas[url]
+            if replica in healthy and replica.load < capacity:
+                return replica, "affinity" if position == 0 else "overflow"
+        raise AssertionError("bounded load walk found no replica")
+
+    async def check(self, replica: Replica):
+        try:
+            response = await self.client.get(
+                f"{replica.url}/health", headers={"Host": API_DOMAIN}, timeout=ROUTER_HEALTH_INTERVAL
+            )
+            health = response.json() if response.status_code == 200 else {}
+        except (httpx.HTTPError, ValueError):
+            health = {}
+        healthy = bool(health.get("model_loaded"))
+        if healthy != replica.healthy:
+            logger.info(f"Replica {replica.url} {'healthy' if healthy else 'unhealthy'}")
+        replica.healthy = healthy
+        replica.reported = (health.get("load") or {}).get("in_flight", 0)
+        ROUTER_REPLICA_HEALTHY.labels(replica=replica.url).set(int(healthy))
+        ROUTER_REPLICA_LOAD.labels(replica=replica.url).set(replica.load)
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(r) for r in self.replicas.values()))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(ROUTER_HEALTH_INTERVAL)
+            await self.check_all()
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=ROUTER_TIMEOUT, limits=httpx.Limits(max_keepalive_connections=64))
+        await self.check_all()
+        self.task = asyncio.create_task(self._health_loop())
+        logger.info(f"Routing over {len(self.replicas)} replicas ({self.policy}), "
+                    f"{sum(r.healthy for r in self.replicas.values())} healthy")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def forward(self, request: Request) -> Response:
+        body = await request.body()
+        key = affinity_key(request.url.path, request.headers, body)
+        headers = [(k, v) for k, v in request.headers.items() if k.lower() not in HOP_HEADERS]
+        tried: Tuple[str, ...] = ()
+        while True:
+            replica, routing = self.choose(key, exclude=tried)
+            upstream = self.client.build_request(
+                request.method, f"{replica.url}{request.url.path}", params=request.query_params,
+                headers=headers, content=body
+            )
+            replica.in_flight += 1
+            try:
+                response = await self.client.send(upstream, stream=True)
+                break
+            except httpx.ConnectError:
+                # Nothing reached the replica, so resending is safe
+                replica.in_flight -= 1
+                replica.healthy = False
+                ROUTER_FAILOVERS.inc()
+                tried += (replica.url,)
+                logger.warning(f"Replica {replica.url} unreachable, marked unhealthy")
+            except httpx.HTTPError as e:
+                replica.in_flight -= 1
+                logger.warning(f"Replica {replica.url} request failed: {e}")
+                raise HTTPException(status_code=502, detail="Replica request failed")
+            except BaseException:
+                replica.in_flight -= 1
+                raise
+        ROUTER_REQUESTS.labels(replica=replica.url, routing=routing).inc()
+
+        async def body_stream():
+            try:
+                async for chunk in response.aiter_raw():
+                    yield chunk
+            finally:
+                await response.aclose()
+                replica.in_flight -= 1
+
+        response_headers = {k: v for k, v in response.headers.items() if k.lower() not in HOP_HEADERS}
+        response_headers["X-Routing"] = routing
+        return StreamingResponse(body_stream(), status_code=response.status_code, headers=response_headers)
+
+    def status(self) -> Dict:
+        return {
+            "policy": self.policy,
+            "replicas": [
+                {"url": r.url, "healthy": r.healthy, "in_flight": r.in_flight, "reported_load": r.reported}
+                for r in self.replicas.values()
+            ]
+        }
+
+
+def create_app(router: AffinityRouter) -> FastAPI:
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await router.start()
+        yield
+        await router.stop()
+
+    app = FastAPI(title="Qwen API router", docs_url=None, redoc_url=None, lifespan=lifespan)
+
+    @app.get("/router/health")
+    async def router_health():
+        """Router's own health: healthy while at least one replica is"""
+        status = router.status()
+        if not any(r["healthy"] for r in status["replicas"]):
+            raise HTTPException(status_code=503, detail="No healthy replica")
+        return status
+
+    @app.get("/router/metrics")
+    async def router_metrics():
+        return Response(generate_latest(), media_type="text/plain")
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+    async def proxy(request: Request):
+        return await router.forward(request)
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        create_app(AffinityRouter()),
+        host=os.getenv("ROUTER_HOST", "0.0.0.0"),
+        port=int(os.getenv("ROUTER_PORT", "8080"))
+    )
@@ -1,30 +1,40 @@
 # ~/qwen-api/api_server.py
 import asyncio
-import hashlib
+import base64
+import functools
+import gzip
 import json
 import logging
 import os
 import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 from contextlib import asynccontextmanager
-from typing import Dict, List, Optional
+from array import array
+from typing import Dict, List, Literal, Optional, Union
 
-import bleach
-import redis.asyncio as redis
-import torch
 from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from fastapi.responses import Response
-from prometheus_client import Counter, Histogram, generate_latest
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
 from pydantic import BaseModel, Field, validator
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
 from tenacity import retry, stop_after_attempt, wait_exponential
-from transformers import AutoModelForCausalLM, AutoTokenizer
 
+from cache_backend import CACHE_REDIS_NODES, CacheShards
+from cache_keys import build_cache_key, build_embedding_key, template_version
+from completion_cache import covers, fit_cached, join_resumed, resume_point
+from inference_ipc import INFERENCE_SOCKET, InferenceClient, InferenceError
+from memory_monitor import CRITICAL, HIGH, NORMAL, OOM_RETRIES, AdjustableSemaphore, MemoryMonitor
+from rate_limit import DEFAULT_TIER, RedisRateLimiter
+from usage_events import UsagePipeline
+from tinylfu_cache import HitRatio, TinyLFUCache
+from serialization import FastJSONResponse, RawJSON, decode_cache_record, dumps, encode_cache_record
 from auth import verify_token, require_generate, require_admin, api_key_manager
 
 # Logging Setup
@@ -39,17 +49,124 @@ REQUEST_COUNT = Counter('qwen_requests_total', 'Total requests', ['endpoint', 's
 REQUEST_DURATION = Histogram('qwen_request_duration_seconds', 'Request duration')
 CACHE_HITS = Counter('qwen_cache_hits_total', 'Cache hits')
 CACHE_MISSES = Counter('qwen_cache_misses_total', 'Cache misses')
+EARLY_STOPS = Counter('qwen_early_stops_total', 'Generations stopped before max_tokens', ['reason'])
+TOKENS_SAVED = Counter('qwen_tokens_saved_total', 'Decode steps skipped by early stopping', ['reason'])
+QUEUE_WAIT = Histogram('qwen_generation_queue_seconds', 'Time spent waiting for a generation slot')
+# Per endpoint, with fine buckets at the low end for autocomplete
+ENDPOINT_LATENCY = Histogram(
+    'qwen_endpoint_latency_seconds', 'Request latency by endpoint', ['endpoint'],
+    buckets=(0.025, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1, 2, 5, 10, 30, 60, 120)
+)
+
+# Model selection
+MODEL_ID = os.getenv("MODEL_ID", "Qwen/Qwen2.5-Coder-32B-Instruct")
+MODEL_REVISION = os.getenv("MODEL_REVISION", "main")
+
+# Response cache tuning
+CACHE_TTL_SECONDS = 86400
+CACHE_HITS_KEY = "cache:hits"  # sorted set per cache node: cache key -> hit count
+CACHE_HITS_MAX_ENTRIES = int(os.getenv("CACHE_HITS_MAX_ENTRIES", "100000"))
+CACHE_WARM_KEYS = int(os.getenv("CACHE_WARM_KEYS", "500"))
+CACHE_WARM_BATCH = 200
+# In-process tier in front of Redis, "tinylfu" (frequency-aware admission) or "ttl" (admit everything)
+MEMORY_CACHE_POLICY = os.getenv("MEMORY_CACHE_POLICY", "tinylfu")
+MEMORY_CACHE_SIZE = int(os.getenv("MEMORY_CACHE_SIZE", "1000"))
+MEMORY_CACHE_TTL_SECONDS = 3600
+# Share of a cache's capacity it keeps under high memory pressure (none under critical)
+MEMORY_SHED_KEEP = float(os.getenv("MEMORY_SHED_KEEP", "0.5"))
+
+# Concurrent model.generate calls in the model-owning process
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "1"))
+# Upper bound for n / best_of of one chat request
+MAX_SAMPLES = int(os.getenv("MAX_SAMPLES", "8"))
+# Prompts per /v1/batch/generate request
+MAX_BATCH_REQUESTS = int(os.getenv("MAX_BATCH_REQUESTS", "64"))
+# API keys per bulk create/revoke call and per listing page
+MAX_BULK_KEYS = 1000
+
+# One directory per LoRA adapter (see lora_adapters.py), empty = base model only
+LORA_ADAPTER_DIR = os.getenv("LORA_ADAPTER_DIR", "")
+
+# Embeddings: pooling over the last hidden state ("mean" or "last"), cached for a week
+EMBEDDING_POOLING = os.getenv("EMBEDDING_POOLING", "mean")
+EMBEDDING_CACHE_TTL_SECONDS = 7 * 86400
+EMBEDDING_MAX_TOKENS = int(os.getenv("EMBEDDING_MAX_TOKENS", "8192"))
+MAX_EMBEDDING_INPUTS = 2048
+
+# Fill-in-the-middle completions (Qwen2.5-Coder FIM tokens)
+FIM_PREFIX, FIM_SUFFIX, FIM_MIDDLE = "<|fim_prefix|>", "<|fim_suffix|>", "<|fim_middle|>"
+# Besides the tokenizer eos, these end a FIM middle
+FIM_EOS_TOKENS = ("<|endoftext|>", "<|fim_pad|>", "<|file_sep|>", "<|repo_name|>")
+FIM_STOPS = {"line": ["\n"], "block": ["\n\n"]}
+
+# Name this replica reports in /health and X-Replica (affinity_router.py)
+REPLICA_ID = os.getenv("REPLICA_ID", socket.gethostname())
+
+async def watch_disconnect(request: Request, cancel_event: threading.Event):
+    """Set cancel_event when the HTTP client disconnects.
+
+    Waits on the ASGI receive channel, where the message after the request
+    body is http.disconnect. Request.is_disconnected() cannot be used: it
+    polls with an already cancelled scope, which never gets through the
+    BaseHTTPMiddleware layers of this app.
+    """
+    while not cancel_event.is_set():
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            cancel_event.set()
+            return
+
 
 class QwenAPI:
     def __init__(self):
         self.model = None
         self.tokenizer = None
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.redis_client = None
-        self.memory_cache = TTLCache(maxsize=1000, ttl=3600)  # 1h TTL
+        self.device = None  # set by load_model
+        self.redis_client = None  # the single cache node when CACHE_REDIS_NODES is empty
+        self.cache_shards: Optional[CacheShards] = None
+        if MEMORY_CACHE_POLICY == "ttl":
+            self.memory_cache = TTLCache(maxsize=MEMORY_CACHE_SIZE, ttl=MEMORY_CACHE_TTL_SECONDS)
+        else:
+            # One-off prompts do not push out the frequently repeated ones
+            self.memory_cache = TinyLFUCache(MEMORY_CACHE_SIZE, MEMORY_CACHE_TTL_SECONDS)
+        # Memory or Redis, published as qwen_cache_hit_ratio{tier="response"}
+        self.cache_hit_ratio = HitRatio("response")
+        self.chat_template_version = ""
+        # Bucketed static-KV-cache decoding (STATIC_KV_CACHE=1)
+        self.static_decoder = None
+        # Prompt KV reuse for requests sharing a prefix (dynamic-cache path only)
+        self.prefix_cache = None
+        # Continuous batching on the paged KV cache (PAGED_KV_CACHE=1)
+        self.engine = None
+        # LoRA adapters served on top of the model (LORA_ADAPTER_DIR)
+        self.adapters = None
+        # Fire-and-forget tasks, referenced until done so they are not garbage collected
+        self.background_tasks = set()
+        # Set in HTTP workers that delegate generation to the inference process
+        self.inference_client: Optional[InferenceClient] = None
+        self.generation_slots = AdjustableSemaphore(GENERATION_CONCURRENCY)
+        # Generations retried after an OOM run one at a time
+        self.oom_retry_lock = asyncio.Lock()
+        # /v1/ requests being served by this process (reported as load in /health)
+        self.in_flight = 0
         
+    @property
+    def ready(self) -> bool:
+        return self.tokenizer is not None and (self.model is not None or self.inference_client is not None)
+
+    def load(self) -> Dict:
+        """Current load, what a routing tier balances on"""
+        return {
+            "in_flight": self.in_flight,
+            "generating": self.generation_slots.active,
+            "generation_slots": self.generation_slots.limit,
+            "memory_pressure": memory_monitor.level
+        }
+
     async def get_redis(self):
         if not self.redis_client:
+            import redis.asyncio as redis
+
             password = os.getenv("REDIS_PASSWORD", "")
             self.redis_client = redis.Redis(
                 host='redis', 
@@ -59,36 +176,62 @@ class QwenAPI:
                 decode_responses=True
             )
         return self.redis_client
+
+    async def get_cache(self) -> CacheShards:
+        """Cache nodes (CACHE_REDIS_NODES, else the one `redis` host)"""
+        if self.cache_shards is None:
+            if CACHE_REDIS_NODES:
+                self.cache_shards = CacheShards.from_urls(CACHE_REDIS_NODES, os.getenv("REDIS_PASSWORD", ""))
+            else:
+                self.cache_shards = CacheShards({"redis": await self.get_redis()})
+        return self.cache_shards
+
+    async def redis_for(self, key: str):
+        """Redis client of the cache node that owns key"""
+        return (await self.get_cache()).client_for(key)
         
+    # torch/transformers are imported on first use (model_runtime), so that
+    # importing this module stays cheap for tests, admin tools and sidecars
+    def load_tokenizer(self):
+        """Load only the tokenizer (enough for HTTP workers)"""
+        import model_runtime
+
+        self.tokenizer = model_runtime.load_tokenizer(MODEL_ID, MODEL_REVISION)
+        self.chat_template_version = template_version(self.tokenizer.chat_template)
+
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     async def load_model(self):
         """Load Qwen model with retry logic"""
         try:
-            model_path = "Qwen/Qwen2.5-Coder-32B-Instruct"
-            
+            import model_runtime
+
+            self.device = model_runtime.detect_device()
             logger.info(f"Loading model on {self.device}")
             
-            # Load tokenizer
-            self.tokenizer = AutoTokenizer.from_pretrained(
-                model_path,
-                trust_remote_code=True,
-                cache_dir="/app/models"
-            )
-            
-            # Load model with optimizations
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                device_map="auto",
-                torch_dtype=torch.bfloat16,
-                trust_remote_code=True,
-                cache_dir="/app/models",
-                low_cpu_mem_usage=True,
-                attn_implementation="flash_attention_2" if torch.cuda.is_available() else "eager"
+            self.load_tokenizer()
+            self.model, self.static_decoder = model_runtime.load_model(
+                MODEL_ID, MODEL_REVISION, self.device, self.tokenizer
             )
-            
-            # Compile model for faster inference (PyTorch 2.0+)
-            if hasattr(torch, 'compile'):
-                self.model = torch.compile(self.model)
+            if LORA_ADAPTER_DIR:
+                import lora_adapters
+
+                self.adapters = lora_adapters.AdapterRegistry(self.model, LORA_ADAPTER_DIR)
+                logger.info(f"LoRA adapters available: {', '.join(self.adapters.names()) or 'none yet'}")
+            if model_runtime.PAGED_KV_CACHE and self.static_decoder is None:
+                import generation_engine
+                import kv_offload
+
+                pool = generation_engine.PagedKVPool.for_memory(self.model)
+                # Evicted prefix blocks go to host RAM / disk (KV_HOST_CACHE_GB, KV_DISK_CACHE_GB)
+                offload = kv_offload.TieredKVStore(pool) if kv_offload.KV_OFFLOAD_ENABLED else None
+                self.engine = generation_engine.GenerationEngine(
+                    self.model, self.tokenizer, self.device, pool=pool, offload=offload
+                )
+                self.engine.start()
+                # The engine batches whatever is admitted, KV blocks are the real limit
+                self.generation_slots = AdjustableSemaphore(max(GENERATION_CONCURRENCY, self.engine.max_sequences))
+            elif self.static_decoder is None:
+                self.prefix_cache = model_runtime.PrefixKVCache()
             
             logger.info("Model loaded successfully")
             
@@ -96,32 +239,56 @@ class QwenAPI:
             logger.error(f"Error loading model: {e}")
             raise
 
-    def get_cache_key(self, prompt: str, **kwargs) -> str:
-        """Generate cache key from prompt and parameters"""
-        cache_data = {"prompt": prompt, **kwargs}
-        return hashlib.md5(json.dumps(cache_data, sort_keys=True).encode()).hexdigest()
+    def get_cache_key(self, token_ids, **params) -> Optional[str]:
+        """Canonical cache key for a tokenized prompt, None if not cacheable"""
+        return build_cache_key(
+            MODEL_ID,
+            MODEL_REVISION,
+            self.chat_template_version,
+            token_ids,
+            **params
+        )
+
+    async def _record_hit(self, cache_key: str):
+        """Bump the hit counter used to rank keys for cache warming"""
+        try:
+            redis_client = await self.redis_for(cache_key)
+            await redis_client.zincrby(CACHE_HITS_KEY, 1, cache_key)
+        except Exception as e:
+            logger.debug(f"Cache hit counter error: {e}")
 
     async def get_from_cache(self, cache_key: str) -> Optional[str]:
         """Get response from cache (Memory first, then Redis)"""
         try:
             # Try memory cache first (fastest)
-            if cache_key in self.memory_cache:
+            cached = self.memory_cache.get(cache_key)
+            if cached is not None:
                 CACHE_HITS.inc()
-                return self.memory_cache[cache_key]
+                self.cache_hit_ratio.record(True)
+                # Counter update must not delay the hit
+                task = asyncio.create_task(self._record_hit(cache_key))
+                self.background_tasks.add(task)
+                task.add_done_callback(self.background_tasks.discard)
+                return cached
             
-            # Try Redis cache
-            redis_client = await self.get_redis()
-            cached = await redis_client.get(cache_key)
+            # Try Redis cache, counting the hit in the same round trip
+            redis_client = await self.redis_for(cache_key)
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.get(cache_key)
+                pipe.zincrby(CACHE_HITS_KEY, 1, cache_key)
+                cached, _ = await pipe.execute()
             if cached:
                 # Store in memory cache for faster access
                 self.memory_cache[cache_key] = cached
                 CACHE_HITS.inc()
+                self.cache_hit_ratio.record(True)
                 return cached
                 
         except Exception as e:
             logger.warning(f"Cache read error: {e}")
         
         CACHE_MISSES.inc()
+        self.cache_hit_ratio.record(False)
         return None
 
     async def store_in_cache(self, cache_key: str, response: str):
@@ -130,89 +297,620 @@ class QwenAPI:
             # Store in memory cache
             self.memory_cache[cache_key] = response
             
-            # Store in Redis with 24h TTL
-            redis_client = await self.get_redis()
-            await redis_client.setex(cache_key, 86400, response)
+            # Store in Redis with 24h TTL and register the key for warming
+            redis_client = await self.redis_for(cache_key)
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.setex(cache_key, CACHE_TTL_SECONDS, response)
+                pipe.zadd(CACHE_HITS_KEY, {cache_key: 0}, nx=True)
+                # Keep the ranking bounded, dropping the coldest keys
+                pipe.zremrangebyrank(CACHE_HITS_KEY, 0, -CACHE_HITS_MAX_ENTRIES - 1)
+                await pipe.execute()
             
         except Exception as e:
             logger.warning(f"Cache write error: {e}")
 
-    @torch.inference_mode()
+    async def warm_cache(self, limit: int = CACHE_WARM_KEYS) -> int:
+        """Bulk-load the most frequently hit Redis entries into memory_cache"""
+        limit = min(limit, self.memory_cache.maxsize)
+        if limit <= 0:
+            return 0
+
+        cache = await self.get_cache()
+        hot_keys = [key for key, _ in await self.ranked_keys(limit)]
+
+        loaded = 0
+        expired = []
+        # Load coldest first so the hottest keys are the most recently inserted
+        for i in range(len(hot_keys), 0, -CACHE_WARM_BATCH):
+            batch = hot_keys[max(0, i - CACHE_WARM_BATCH):i]
+            values = await cache.mget(batch)
+            for key, value in reversed(list(zip(batch, values))):
+                if value is None:
+                    expired.append(key)
+                    continue
+                self.memory_cache[key] = value
+                loaded += 1
+
+        # Entries that expired in Redis no longer need a rank
+        if expired:
+            await cache.by_node(expired, lambda client, keys: client.zrem(CACHE_HITS_KEY, *keys))
+
+        logger.info(f"Cache warmed with {loaded} entries ({len(expired)} expired)")
+        return loaded
+
+    async def ranked_keys(self, limit: Optional[int] = None) -> List:
+        """(key, hits) of the most hit cache keys over all nodes, hottest first"""
+        cache = await self.get_cache()
+        end = -1 if limit is None else limit - 1
+        # Each node ranks its own keys, the overall top is within the per-node tops
+        ranked = await cache.each(lambda client: client.zrevrange(CACHE_HITS_KEY, 0, end, withscores=True))
+        merged = sorted((entry for node_ranked in ranked for entry in node_ranked), key=lambda e: e[1], reverse=True)
+        return merged if limit is None else merged[:limit]
+
+    async def export_cache(self, limit: Optional[int] = None) -> bytes:
+        """Export ranked cache entries as gzipped JSON lines"""
+        cache = await self.get_cache()
+        ranked = await self.ranked_keys(limit)
+
+        async def read(client, keys):
+            async with client.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.get(key)
+                    pipe.ttl(key)
+                results = await pipe.execute()
+            return zip(results[0::2], results[1::2])
+
+        lines = []
+        for i in range(0, len(ranked), CACHE_WARM_BATCH):
+            batch = ranked[i:i + CACHE_WARM_BATCH]
+            entries = {}
+            for keys, results in await cache.by_node([key for key, _ in batch], read):
+                entries.update(zip(keys, results))
+            for key, hits in batch:
+                value, ttl = entries[key]
+                if value is None:
+                    continue
+                lines.append(json.dumps(
+                    {"k": key, "v": value, "h": int(hits), "t": ttl if ttl > 0 else CACHE_TTL_SECONDS},
+                    separators=(",", ":")
+                ))
+
+        return gzip.compress("\n".join(lines).encode())
+
+    async def import_cache(self, payload: bytes, warm: bool = True) -> int:
+        """Restore entries produced by export_cache into Redis (and memory).
+
+        The whole file is checked first; ValueError on a malformed entry,
+        before anything is written.
+        """
+        entries = []
+        for number, line in enumerate(gzip.decompress(payload).decode().splitlines(), 1):
+            if not line:
+                continue
+            entry = json.loads(line)
+            if not (
+                isinstance(entry, dict)
+                and isinstance(entry.get("k"), str) and entry["k"]
+                and isinstance(entry.get("v"), str)
+                and isinstance(entry.get("h"), (int, float)) and not isinstance(entry["h"], bool)
+                and isinstance(entry.get("t"), int) and not isinstance(entry["t"], bool) and entry["t"] > 0
+            ):
+                raise ValueError(f"line {number} is not a cache entry")
+            entries.append(entry)
+
+        cache = await self.get_cache()
+        for i in range(0, len(entries), CACHE_WARM_BATCH):
+            batch = {entry["k"]: entry for entry in entries[i:i + CACHE_WARM_BATCH]}
+
+            async def write(client, keys):
+                async with client.pipeline(transaction=False) as pipe:
+                    for key in keys:
+                        pipe.setex(key, batch[key]["t"], batch[key]["v"])
+                        pipe.zadd(CACHE_HITS_KEY, {key: batch[key]["h"]})
+                    await pipe.execute()
+
+            await cache.by_node(list(batch), write)
+
+        if warm:
+            await self.warm_cache()
+
+        logger.info(f"Imported {len(entries)} cache entries")
+        return len(entries)
+
+    async def run_generation(
+        self,
+        input_ids: List[int],
+        cancel_event: threading.Event,
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        stop: List[str],
+        priority: bool = False,
+        use_prefix_cache: bool = False,
+        eos_token_ids: Optional[List[int]] = None,
+        samples: int = 1,
+        seed: Optional[int] = None,
+        adapter: Optional[str] = None
+    ) -> Dict:
+        """Decode a tokenized prompt on the local model.
+
+        Only runs in the process that owns the model; HTTP workers reach it
+        through InferenceClient.run_generation. priority requests get the
+        next free generation slot before any normal one. adapter names a
+        LoRA adapter, loaded on first use.
+        """
+        if self.model is None:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+        import model_runtime
+
+        lora = await self.get_adapter(adapter) if adapter else None
+
+        queued_at = time.perf_counter()
+        async with self.generation_slots.slot(priority):
+            queue_seconds = time.perf_counter() - queued_at
+            QUEUE_WAIT.observe(queue_seconds)
+            if cancel_event.is_set():
+                return {"text": "", "generated_tokens": 0, "stopped": "disconnect", "queue_seconds": queue_seconds}
+
+            if self.engine is not None:
+                # Prompt prefixes are shared by the engine's own block index
+                run = lambda: asyncio.wrap_future(self.engine.submit(
+                    input_ids, cancel_event, max_tokens=max_tokens, temperature=temperature,
+                    top_p=top_p, stop=stop, eos_token_ids=eos_token_ids, samples=samples, seed=seed,
+                    adapter=lora
+                ))
+            else:
+                decode = functools.partial(
+                    model_runtime.generate_tokens,
+                    self.model,
+                    self.tokenizer,
+                    self.device,
+                    input_ids,
+                    cancel_event,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    stop=stop,
+                    static_decoder=self.static_decoder,
+                    prefix_cache=self.prefix_cache if use_prefix_cache else None,
+                    eos_token_ids=eos_token_ids,
+                    samples=samples,
+                    seed=seed,
+                    adapter=lora
+                )
+                # Generate off the event loop so disconnects can still be observed
+                run = lambda: asyncio.to_thread(decode)
+            try:
+                result = await run()
+            except Exception as e:
+                if not model_runtime.is_out_of_memory(e):
+                    raise
+                result = await self._retry_after_oom(run)
+
+        result["queue_seconds"] = queue_seconds
+        return result
+
+    async def get_adapter(self, name: str):
+        """Resident LoRA adapter by name (loaded from disk off the event loop)"""
+        if self.adapters is None:
+            raise HTTPException(status_code=404, detail=f"Unknown model: {name}")
+        import lora_adapters
+
+        try:
+            return await asyncio.to_thread(self.adapters.get, name)
+        except lora_adapters.UnknownAdapter:
+            raise HTTPException(status_code=404, detail=f"Unknown model: {name}")
+
+    async def _retry_after_oom(self, run) -> Dict:
+        """Shed caches and concurrency, then retry once with the device to ourselves.
+
+        Every concurrent generation that hit the OOM retries this way, one
+        after the other, instead of all of them failing.
+        """
+        import model_runtime
+
+        logger.warning("Out of memory during generation, shedding load and retrying")
+        await memory_monitor.on_out_of_memory()
+        async with self.oom_retry_lock:
+            try:
+                result = await run()
+            except Exception as e:
+                if not model_runtime.is_out_of_memory(e):
+                    raise
+                OOM_RETRIES.labels(outcome="failed").inc()
+                raise HTTPException(
+                    status_code=503,
+                    detail="Out of memory, retry later",
+                    headers={"Retry-After": "5"}
+                )
+        OOM_RETRIES.labels(outcome="recovered").inc()
+        return result
+
+    def register_shedders(self, monitor: MemoryMonitor):
+        """Hook the caches and slots this process owns into the memory monitor"""
+        monitor.register("memory_cache", self._shed_memory_cache)
+        if self.model is not None:
+            monitor.register("kv_cache", self._shed_kv_cache)
+            monitor.register("concurrency", self._shed_concurrency)
+
+    def _shed_memory_cache(self, level: int) -> bool:
+        # The monitor calls this on every check while pressure lasts: shed down
+        # to a share of the capacity, not by a share of what is left
+        keep = int(self.memory_cache.maxsize * MEMORY_SHED_KEEP) if level == HIGH else 0
+        if level == NORMAL or len(self.memory_cache) <= keep:
+            return False
+        # Coldest entries go first; everything under critical pressure
+        while len(self.memory_cache) > keep:
+            self.memory_cache.popitem()
+        return True
+
+    def _shed_kv_cache(self, level: int) -> bool:
+        if level == NORMAL:
+            return False
+        import model_runtime
+
+        dropped = self.static_decoder.trim(1 if level == HIGH else 0) if self.static_decoder else False
+        if self.prefix_cache is not None:
+            keep = int(self.prefix_cache.max_entries * MEMORY_SHED_KEEP) if level == HIGH else 0
+            dropped = self.prefix_cache.trim(keep) or dropped
+        if self.engine is not None:
+            # The block pool itself stays allocated, only shared prefix blocks are given up
+            keep = int(self.engine.pool.allocator.num_blocks * MEMORY_SHED_KEEP) if level == HIGH else 0
+            dropped = self.engine.drop_prefix_blocks(keep) or dropped
+        if dropped:
+            # Hand what was freed back to the device, not on every check under pressure
+            model_runtime.release_device_memory()
+        return dropped
+
+    async def _shed_concurrency(self, level: int) -> bool:
+        capacity = self.generation_slots.capacity
+        limit = {NORMAL: capacity, HIGH: max(1, capacity // 2), CRITICAL: 1}[level]
+        if limit == self.generation_slots.limit:
+            return False
+        logger.info(f"Generation concurrency {self.generation_slots.limit} -> {limit}")
+        await self.generation_slots.set_limit(limit)
+        return True
+
     async def generate_response(
         self, 
         prompt: str, 
         max_tokens: int = 2048,
         temperature: float = 0.1,
-        top_p: float = 0.95
-    ) -> str:
-        """Generate response with caching"""
+        top_p: float = 0.95,
+        stop: Optional[List[str]] = None,
+        request: Optional[Request] = None,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        seed: Optional[int] = None,
+        adapter: Optional[str] = None,
+        cancel_event: Optional[threading.Event] = None
+    ) -> Dict:
+        """Generate response with caching.
+
+        Generation ends early when a stop string is produced or, if request
+        is given, when the client disconnects. Cancelled output is never cached.
+        A caller running several generations for one request passes a shared
+        cancel_event and watches the disconnect itself.
+
+        Returns the completion as already-encoded JSON (text_json) together
+        with cached, finish_reason, prompt_tokens and completion_tokens.
+        With n > 1 there is also choices, a list of text_json/finish_reason
+        dicts (the first one repeats the top-level completion).
+        """
         
         # Check if model and tokenizer are loaded
-        if self.model is None or self.tokenizer is None:
+        if not self.ready:
             raise HTTPException(status_code=503, detail="Model not loaded yet")
-        
-        cache_key = self.get_cache_key(
-            prompt=prompt,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p
+
+        # Prepare input
+        messages = [{"role": "user", "content": prompt}]
+        text = self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        )
+        input_ids = self.tokenizer(text).input_ids
+        return await self.generate_from_tokens(
+            input_ids, max_tokens, temperature, top_p, stop, request, n=n, best_of=best_of, seed=seed,
+            adapter=adapter, cancel_event=cancel_event
         )
+
+    async def complete_fim(
+        self,
+        prefix: str,
+        suffix: str,
+        max_tokens: int,
+        temperature: float,
+        stop: List[str],
+        request: Optional[Request] = None,
+        adapter: Optional[str] = None
+    ) -> Dict:
+        """Fill-in-the-middle completion between prefix and suffix.
+
+        The FIM prompt is built directly (no chat template) and runs in the
+        priority lane with prefix KV reuse, since consecutive autocomplete
+        requests for a file share most of their prefix.
+        """
+        if not self.ready:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+
+        input_ids = self.tokenizer(f"{FIM_PREFIX}{prefix}{FIM_SUFFIX}{suffix}{FIM_MIDDLE}").input_ids
+        vocab = self.tokenizer.get_vocab()
+        eos_token_ids = [self.tokenizer.eos_token_id] + [vocab[t] for t in FIM_EOS_TOKENS if t in vocab]
+        return await self.generate_from_tokens(
+            input_ids, max_tokens, temperature, 1.0, stop, request, adapter=adapter,
+            priority=True, use_prefix_cache=True, eos_token_ids=sorted(set(eos_token_ids))
+        )
+
+    async def generate_from_tokens(
+        self,
+        input_ids: List[int],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        stop: Optional[List[str]] = None,
+        request: Optional[Request] = None,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        seed: Optional[int] = None,
+        adapter: Optional[str] = None,
+        cancel_event: Optional[threading.Event] = None,
+        **engine_params
+    ) -> Dict:
+        """Cached generation for an already tokenized prompt (see generate_response).
+
+        best_of samples share one prefill; the n with the highest cumulative
+        logprob are returned. adapter selects a LoRA adapter. engine_params
+        (priority, use_prefix_cache, eos_token_ids) are passed on to
+        run_generation.
+        """
+        stop = stop or []
+        samples = max(best_of or n, n)
+        # Single greedy completions are cached per prompt for any max_tokens (completion_cache.py)
+        greedy = temperature == 0 and samples == 1
+
+        cache_params = dict(temperature=temperature, top_p=top_p, stop=stop)
+        if not greedy:
+            cache_params["max_tokens"] = max_tokens
+        # Only when set, keys of plain requests stay as they were
+        if samples > 1:
+            cache_params.update(n=n, best_of=samples)
+        if seed is not None:
+            cache_params["seed"] = seed
+        if adapter:
+            cache_params["adapter"] = adapter
+        cache_key = self.get_cache_key(input_ids, **cache_params)
         
         # Check cache first
-        cached_response = await self.get_from_cache(cache_key)
-        if cached_response:
-            return cached_response
+        resume_from: List[int] = []
+        if cache_key:
+            cached_response = await self.get_from_cache(cache_key)
+            cached = None
+            if cached_response:
+                try:
+                    cached = decode_cache_record(cached_response)
+                except ValueError as e:
+                    # Not one of our records (e.g. an edited import): a miss, overwritten below
+                    logger.warning(f"Unreadable cache record {cache_key}: {e}")
+            if cached is not None and "token_ids" in cached and not covers(cached, max_tokens):
+                # Greedy completion cut off by a smaller max_tokens: decode only the rest
+                resume_from = resume_point(cached["token_ids"], stop)
+            elif cached is not None:
+                result = fit_cached(self.tokenizer, cached, max_tokens, stop) if "token_ids" in cached else cached
+                if "choices" in result:
+                    result["choices"] = [{"text_json": result["text_json"], "finish_reason": result["finish_reason"]}] + [
+                        {"text_json": RawJSON(dumps(c["text"]).decode()), "finish_reason": c["finish_reason"]}
+                        for c in result["choices"]
+                    ]
+                result.update(cached=True, prompt_tokens=len(input_ids))
+                if request is not None:
+                    request.state.server_timing = {"cache": "hit"}
+                return result
+
+        watcher = None
+        if cancel_event is None:
+            cancel_event = threading.Event()
+            # Only one task may wait on the request's receive channel
+            watcher = asyncio.create_task(watch_disconnect(request, cancel_event)) if request else None
+        generate = self.inference_client.run_generation if self.inference_client else self.run_generation
 
         try:
-            # Prepare input
-            messages = [{"role": "user", "content": prompt}]
-            text = self.tokenizer.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=True
+            result = await generate(
+                input_ids + resume_from,
+                cancel_event,
+                max_tokens=max_tokens - len(resume_from),
+                temperature=temperature,
+                top_p=top_p,
+                stop=stop,
+                # Greedy samples would all be the same, decode once
+                samples=samples if temperature > 0 else 1,
+                seed=seed,
+                adapter=adapter,
+                **engine_params
             )
-            
-            inputs = self.tokenizer(text, return_tensors="pt").to(self.device)
-            
-            # Generate
-            with torch.cuda.amp.autocast():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=max_tokens,
-                    temperature=temperature,
-                    top_p=top_p,
-                    do_sample=temperature > 0,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                )
-            
-            # Decode response
-            response = self.tokenizer.decode(
-                outputs[0][inputs.input_ids.shape[-1]:], 
-                skip_special_tokens=True
-            )
-            
+
+            if resume_from:
+                result = join_resumed(self.tokenizer, resume_from, result, stop)
+            choices = result.get("choices") or [result]
+            choices = choices + choices[:1] * (samples - len(choices))
+            generated_tokens = sum(c["generated_tokens"] for c in choices)
+            if request is not None:
+                request.state.server_timing = {"cache": "miss", "queue": result.get("queue_seconds", 0.0)}
+            if any(c["stopped"] == "disconnect" for c in choices):
+                EARLY_STOPS.labels(reason="disconnect").inc()
+                TOKENS_SAVED.labels(reason="disconnect").inc(max_tokens * samples - generated_tokens)
+                logger.info(f"Client disconnected, generation aborted after {generated_tokens} tokens")
+                raise HTTPException(status_code=499, detail="Client closed request")
+            for choice in choices:
+                if choice["stopped"] == "stop_sequence":
+                    EARLY_STOPS.labels(reason="stop_sequence").inc()
+                    TOKENS_SAVED.labels(reason="stop_sequence").inc(max_tokens - choice["generated_tokens"])
+            if samples > n:
+                # best_of: most likely samples first (greedy replicas have no logprob)
+                choices = sorted(choices, key=lambda c: c.get("logprob") or 0.0, reverse=True)[:n]
+            first = choices[0]
+
             # Store in cache
-            await self.store_in_cache(cache_key, response)
+            if cache_key:
+                # text first in the nested dicts, ',"text":' marks the top-level text of a record
+                extra = {"choices": [{"text": c["text"], "finish_reason": c["finish_reason"]} for c in choices[1:]]} if n > 1 else {}
+                if greedy:
+                    extra["token_ids"] = first["token_ids"]
+                await self.store_in_cache(cache_key, encode_cache_record(
+                    first["text"],
+                    finish_reason=first["finish_reason"],
+                    completion_tokens=generated_tokens,
+                    **extra
+                ))
             
+            response = {
+                "text_json": RawJSON(dumps(first["text"]).decode()),
+                "cached": False,
+                "finish_reason": first["finish_reason"],
+                "prompt_tokens": len(input_ids),
+                "completion_tokens": generated_tokens
+            }
+            if n > 1:
+                response["choices"] = [
+                    {"text_json": RawJSON(dumps(c["text"]).decode()), "finish_reason": c["finish_reason"]} for c in choices
+                ]
             return response
             
+        except HTTPException:
+            raise
+        except InferenceError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
         except Exception as e:
             logger.error(f"Generation error: {e}")
             raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
+        finally:
+            if watcher:
+                watcher.cancel()
+
+    async def run_embeddings(self, token_lists: List[List[int]]) -> List[str]:
+        """Embed tokenized inputs on the local model (base64 float32 vectors)"""
+        if self.model is None:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+        import model_runtime
+
+        embed = functools.partial(
+            model_runtime.embed_tokens,
+            self.model,
+            self.device,
+            token_lists,
+            model_runtime.pad_token_id(self.tokenizer),
+            EMBEDDING_POOLING
+        )
+        # Shares the model with generation, so it takes a generation slot
+        async with self.generation_slots:
+            try:
+                return await asyncio.to_thread(embed)
+            except Exception as e:
+                if not model_runtime.is_out_of_memory(e):
+                    raise
+                return await self._retry_after_oom(lambda: asyncio.to_thread(embed))
+
+    async def get_embeddings(self, texts: List[str]) -> Dict:
+        """Embeddings for texts, served from Redis by content hash where possible.
+
+        Returns vectors (base64 float32, input order), prompt_tokens and
+        cached (True if no forward pass was needed). An input over
+        EMBEDDING_MAX_TOKENS is a 400, not embedded truncated.
+        """
+        if not self.ready:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+
+        token_lists = self.tokenizer(texts).input_ids
+        for index, ids in enumerate(token_lists):
+            if len(ids) > EMBEDDING_MAX_TOKENS:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"input[{index}] is {len(ids)} tokens, over the limit of {EMBEDDING_MAX_TOKENS}"
+                )
+        keys = [build_embedding_key(MODEL_ID, MODEL_REVISION, EMBEDDING_POOLING, ids) for ids in token_lists]
+
+        try:
+            vectors = await (await self.get_cache()).mget(keys)
+        except Exception as e:
+            logger.warning(f"Embedding cache read error: {e}")
+            vectors = [None] * len(keys)
+
+        # Identical inputs in one call are embedded once
+        missing: Dict[str, int] = {}
+        for index, (key, vector) in enumerate(zip(keys, vectors)):
+            if vector is None and key not in missing:
+                missing[key] = index
+
+        if missing:
+            CACHE_MISSES.inc(len(missing))
+            embed = self.inference_client.run_embeddings if self.inference_client else self.run_embeddings
+            try:
+                computed = dict(zip(missing, await embed([token_lists[i] for i in missing.values()])))
+            except InferenceError as e:
+                raise HTTPException(status_code=e.status_code, detail=e.detail)
+            vectors = [vector or computed[key] for key, vector in zip(keys, vectors)]
+
+            async def write(client, keys):
+                async with client.pipeline(transaction=False) as pipe:
+                    for key in keys:
+                        pipe.setex(key, EMBEDDING_CACHE_TTL_SECONDS, computed[key])
+                    await pipe.execute()
+
+            try:
+                await (await self.get_cache()).by_node(list(computed), write)
+            except Exception as e:
+                logger.warning(f"Embedding cache write error: {e}")
+        CACHE_HITS.inc(len(keys) - len(missing))
+
+        return {
+            "vectors": vectors,
+            "prompt_tokens": sum(len(ids) for ids in token_lists),
+            "cached": not missing
+        }
 
 # Global API instance
 qwen_api = QwenAPI()
 
-# Rate Limiting
-limiter = Limiter(key_func=get_remote_address)
+# Samples host/device memory and sheds caches and concurrency under pressure
+memory_monitor = MemoryMonitor()
+
+# Usage accounting, kept next to the API keys (db 1)
+usage_pipeline = UsagePipeline(api_key_manager.get_redis)
+
+# Rate Limiting (per authenticated user and tier, shared through the auth Redis)
+rate_limiter = RedisRateLimiter(api_key_manager.get_redis)
+
+async def require_generate_quota(request: Request, user_data: Dict = Depends(require_generate)) -> Dict:
+    """require_generate plus the distributed rate limit"""
+    await rate_limiter.enforce(request, user_data)
+    return user_data
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
     logger.info("Starting Qwen API Server...")
-    await qwen_api.load_model()
+    if INFERENCE_SOCKET:
+        # Multi-worker mode: the model lives in the inference process
+        qwen_api.load_tokenizer()
+        qwen_api.inference_client = InferenceClient(INFERENCE_SOCKET)
+    else:
+        await qwen_api.load_model()
+    try:
+        await qwen_api.warm_cache()
+    except Exception as e:
+        logger.warning(f"Cache warming skipped: {e}")
+    try:
+        await api_key_manager.backfill_key_indexes()
+    except Exception as e:
+        logger.warning(f"API key index backfill skipped: {e}")
+    usage_pipeline.start()
+    qwen_api.register_shedders(memory_monitor)
+    memory_monitor.start()
     logger.info("Server ready!")
     yield
     logger.info("Shutting down...")
+    await memory_monitor.stop()
+    await usage_pipeline.stop()
+    if qwen_api.engine is not None:
+        qwen_api.engine.stop()
 
 app = FastAPI(
     title="Secure Qwen 2.5 Coder API",
@@ -223,9 +921,6 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-
 # Security Middleware
 allowed_hosts = [os.getenv("API_DOMAIN", "localhost")]
 app.add_middleware(
@@ -262,92 +957,355 @@ def sanitize_input(text: str) -> str:
     
     return text
 
+def normalize_stop(stop) -> List[str]:
+    """Accept OpenAI style stop (string or list, up to 4 entries)"""
+    if stop is None:
+        return []
+    if isinstance(stop, str):
+        stop = [stop]
+    if not isinstance(stop, list) or not all(isinstance(s, str) for s in stop):
+        raise HTTPException(status_code=400, detail="stop must be a string or a list of strings")
+    if len(stop) > 4:
+        raise HTTPException(status_code=400, detail="At most 4 stop sequences allowed")
+    return [s for s in stop if s]
+
 # Request Models
 class GenerateRequest(BaseModel):
     prompt: str
     max_tokens: int = Field(default=2048, ge=1, le=8192)
     temperature: float = Field(default=0.1, ge=0.0, le=2.0)
     top_p: float = Field(default=0.95, ge=0.1, le=1.0)
+    stop: Optional[Union[str, List[str]]] = None
     
     @validator('prompt')
     def validate_prompt(cls, v):
         return sanitize_input(v)
 
+    @validator('stop')
+    def validate_stop(cls, v):
+        return normalize_stop(v)
+
+class BatchGenerateRequest(BaseModel):
+    requests: List[GenerateRequest]
+
+    @validator('requests')
+    def validate_requests(cls, v):
+        if not v or len(v) > MAX_BATCH_REQUESTS:
+            raise ValueError(f"requests must contain 1 to {MAX_BATCH_REQUESTS} entries")
+        return v
+
+class APIKeySpec(BaseModel):
+    user_id: str = Field(min_length=1)
+    permissions: List[str] = ["generate"]
+    tier: str = "standard"
+    adapter: Optional[str] = None
+
+class BulkAPIKeyRequest(BaseModel):
+    keys: List[APIKeySpec]
+
+    @validator('keys')
+    def validate_keys(cls, v):
+        if not v or len(v) > MAX_BULK_KEYS:
+            raise ValueError(f"keys must contain 1 to {MAX_BULK_KEYS} entries")
+        return v
+
+class RevokeAPIKeysRequest(BaseModel):
+    key_hashes: List[str] = []
+    user_id: Optional[str] = None
+
+    @validator('key_hashes')
+    def validate_key_hashes(cls, v):
+        if len(v) > MAX_BULK_KEYS:
+            raise ValueError(f"At most {MAX_BULK_KEYS} keys per call")
+        return v
+
 class GenerateResponse(BaseModel):
     response: str
     cached: bool = False
     generation_time: float
     user_id: str
 
+class ChatMessage(BaseModel):
+    role: str
+    content: str = ""
+
+class ChatCompletionRequest(BaseModel):
+    model: Optional[str] = None
+    messages: List[ChatMessage]
+    max_tokens: int = Field(default=2048, ge=1, le=8192)
+    temperature: float = Field(default=0.1, ge=0.0, le=2.0)
+    top_p: float = Field(default=0.95, ge=0.1, le=1.0)
+    stop: Optional[Union[str, List[str]]] = None
+    n: int = Field(default=1, ge=1, le=MAX_SAMPLES)
+    best_of: Optional[int] = Field(default=None, ge=1, le=MAX_SAMPLES)
+    seed: Optional[int] = None
+
+    @validator('stop')
+    def validate_stop(cls, v):
+        return normalize_stop(v)
+
+    @validator('best_of')
+    def validate_best_of(cls, v, values):
+        if v is not None and v < values.get('n', 1):
+            raise ValueError('best_of must be at least n')
+        return v
+
+class ChatChoice(BaseModel):
+    index: int = 0
+    message: ChatMessage
+    finish_reason: str
+
+class ChatUsage(BaseModel):
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+
+class ChatCompletionResponse(BaseModel):
+    choices: List[ChatChoice]
+    model: str
+    usage: ChatUsage
+
+class CompletionRequest(BaseModel):
+    """Fill-in-the-middle request from an editor (prefix = code before the cursor)"""
+    prefix: str
+    suffix: str = ""
+    model: Optional[str] = None
+    max_tokens: int = Field(default=64, ge=1, le=512)
+    temperature: float = Field(default=0.0, ge=0.0, le=1.0)
+    mode: Literal["line", "block"] = "line"
+    stop: Optional[Union[str, List[str]]] = None
+
+    @validator('prefix', 'suffix')
+    def validate_text(cls, v):
+        return sanitize_input(v)
+
+    @validator('stop')
+    def validate_stop(cls, v):
+        return normalize_stop(v)
+
+class EmbeddingRequest(BaseModel):
+    input: Union[str, List[str]]
+    model: Optional[str] = None
+    encoding_format: Literal["float", "base64"] = "float"
+    user: Optional[str] = None
+
+    @validator('input')
+    def validate_input(cls, v):
+        inputs = [v] if isinstance(v, str) else v
+        if not inputs or len(inputs) > MAX_EMBEDDING_INPUTS:
+            raise ValueError(f"input must contain 1 to {MAX_EMBEDDING_INPUTS} entries")
+        return [sanitize_input(text) for text in inputs]
+
 # Security Headers Middleware
 @app.middleware("http")
 async def add_security_headers(request: Request, call_next):
     response = await call_next(request)
+    response.headers["X-Replica"] = REPLICA_ID
     response.headers["X-Content-Type-Options"] = "nosniff"
     response.headers["X-Frame-Options"] = "DENY"
     response.headers["X-XSS-Protection"] = "1; mode=block"
     response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
     response.headers["Content-Security-Policy"] = "default-src 'self'"
     response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+    response.headers.update(getattr(request.state, "rate_limit_headers", {}))
+    server_timing = getattr(request.state, "server_timing", None)
+    if server_timing:
+        response.headers["Server-Timing"] = format_server_timing(server_timing)
     return response
 
+@app.middleware("http")
+async def track_in_flight(request: Request, call_next):
+    if not request.url.path.startswith("/v1/"):
+        return await call_next(request)
+    qwen_api.in_flight += 1
+    try:
+        return await call_next(request)
+    finally:
+        qwen_api.in_flight -= 1
+
+def format_server_timing(timing: Dict) -> str:
+    """{"cache": "hit", "queue": 0.012} -> 'cache;desc=hit, queue;dur=12.0'"""
+    entries = []
+    for name, value in timing.items():
+        if isinstance(value, str):
+            entries.append(f"{name};desc={value}")
+        else:
+            entries.append(f"{name};dur={value * 1000:.1f}")
+    return ", ".join(entries)
+
+def select_adapter(requested: Optional[str], user_data: Dict) -> Optional[str]:
+    """LoRA adapter for a request: `model` if an adapter has that name, else the API key's own.
+
+    Other model names (base model aliases, whatever OpenAI clients send) mean
+    the key's default, None being the base model.
+    """
+    if requested and LORA_ADAPTER_DIR and "/" not in requested and os.path.isfile(
+        os.path.join(LORA_ADAPTER_DIR, requested, "adapter_config.json")
+    ):
+        return requested
+    return user_data.get("adapter")
+
+def record_usage(user_data: Dict, endpoint: str, result: Dict, latency: float, model: Optional[str] = None):
+    """Queue a usage event for a finished generation (model: adapter name if one was used)"""
+    usage_pipeline.record(
+        user_data,
+        endpoint=endpoint,
+        model=model or MODEL_ID,
+        prompt_tokens=result["prompt_tokens"],
+        completion_tokens=result["completion_tokens"],
+        latency=latency,
+        cached=result["cached"]
+    )
+
 # API Endpoints
 @app.post("/v1/generate", response_model=GenerateResponse)
-@limiter.limit("5/minute")
 async def generate_text(
     request: Request,
     data: GenerateRequest,
-    user_data: Dict = Depends(require_generate)
+    user_data: Dict = Depends(require_generate_quota)
 ):
     """Generate text completion"""
     start_time = time.time()
     
     try:
         REQUEST_COUNT.labels(endpoint="generate", status="started").inc()
+        adapter = select_adapter(None, user_data)
         
-        response = await qwen_api.generate_response(
+        result = await qwen_api.generate_response(
             prompt=data.prompt,
             max_tokens=data.max_tokens,
             temperature=data.temperature,
-            top_p=data.top_p
+            top_p=data.top_p,
+            stop=data.stop,
+            request=request,
+            adapter=adapter
         )
         
         generation_time = time.time() - start_time
         REQUEST_DURATION.observe(generation_time)
+        ENDPOINT_LATENCY.labels(endpoint="generate").observe(generation_time)
         REQUEST_COUNT.labels(endpoint="generate", status="success").inc()
         
         # Log for audit
         logger.info(f"Generation request from user {user_data['user_id']} - {generation_time:.2f}s")
+        record_usage(user_data, "generate", result, generation_time, adapter)
         
-        return GenerateResponse(
-            response=response,
-            generation_time=generation_time,
-            user_id=user_data["user_id"]
-        )
+        # Same shape as GenerateResponse, without re-validating/re-encoding the text
+        return FastJSONResponse({
+            "response": result["text_json"],
+            "cached": result["cached"],
+            "generation_time": generation_time,
+            "user_id": user_data["user_id"]
+        })
         
+    except HTTPException:
+        raise
     except Exception as e:
         REQUEST_COUNT.labels(endpoint="generate", status="error").inc()
         logger.error(f"Generation error for user {user_data['user_id']}: {e}")
         raise HTTPException(status_code=500, detail="Generation failed")
 
-@app.post("/v1/chat/completions")
-@limiter.limit("5/minute")
-async def chat_completions(
+@app.post("/v1/batch/generate")
+async def generate_batch(
     request: Request,
-    chat_request: dict,
+    batch: BatchGenerateRequest,
     user_data: Dict = Depends(require_generate)
+):
+    """Several /v1/generate requests in one call, generated concurrently.
+
+    Each prompt counts as one request for the rate limit and the daily
+    quota, so a batch can hold at most the tier's burst (bucket capacity)
+    of prompts. A failed prompt gets an error entry, the others still
+    succeed.
+    """
+    start_time = time.time()
+    items = batch.requests
+    capacity, period = rate_limiter.limit_for(user_data.get("tier", DEFAULT_TIER))
+    if len(items) > capacity:
+        # The bucket never holds more than capacity tokens, waiting would not help
+        raise HTTPException(
+            status_code=400,
+            detail=f"Batch of {len(items)} exceeds the rate limit of {capacity} requests per {period}s"
+        )
+    # requests_today already includes this call; JWT users have no daily quota
+    if "daily_limit" in user_data and (
+        user_data.get("requests_today", 0) - 1 + len(items) > user_data["daily_limit"]
+    ):
+        raise HTTPException(status_code=429, detail="Daily limit exceeded")
+    await rate_limiter.enforce(request, user_data, cost=len(items))
+    adapter = select_adapter(None, user_data)
+
+    async def run(item: GenerateRequest) -> Dict:
+        item_start = time.time()
+        result = await qwen_api.generate_response(
+            prompt=item.prompt,
+            max_tokens=item.max_tokens,
+            temperature=item.temperature,
+            top_p=item.top_p,
+            stop=item.stop,
+            request=request,
+            adapter=adapter,
+            cancel_event=cancel_event
+        )
+        record_usage(user_data, "batch", result, time.time() - item_start, adapter)
+        return result
+
+    REQUEST_COUNT.labels(endpoint="batch", status="started").inc()
+    # One disconnect watcher for the whole batch, its event stops every item
+    cancel_event = threading.Event()
+    watcher = asyncio.create_task(watch_disconnect(request, cancel_event))
+    try:
+        outcomes = await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+    finally:
+        watcher.cancel()
+    if cancel_event.is_set():
+        raise HTTPException(status_code=499, detail="Client closed request")
+    results = []
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, BaseException):
+            logger.error(f"Batch item {index} failed for user {user_data['user_id']}: {outcome}")
+            if isinstance(outcome, HTTPException):
+                results.append({"index": index, "status": outcome.status_code, "error": outcome.detail})
+            else:
+                results.append({"index": index, "status": 500, "error": "Generation failed"})
+        else:
+            results.append({
+                "index": index,
+                "response": outcome["text_json"],
+                "cached": outcome["cached"],
+                "finish_reason": outcome["finish_reason"]
+            })
+
+    generation_time = time.time() - start_time
+    ENDPOINT_LATENCY.labels(endpoint="batch").observe(generation_time)
+    failed = sum("error" in r for r in results)
+    REQUEST_COUNT.labels(endpoint="batch", status="error" if failed == len(results) else "success").inc()
+    logger.info(f"Batch of {len(items)} from user {user_data['user_id']} - {generation_time:.2f}s, {failed} failed")
+
+    return FastJSONResponse({
+        "results": results,
+        "generation_time": generation_time,
+        "user_id": user_data["user_id"]
+    })
+
+@app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
+async def chat_completions(
+    request: Request,
+    chat_request: ChatCompletionRequest,
+    user_data: Dict = Depends(require_generate_quota)
 ):
     """OpenAI-compatible chat endpoint"""
+    start_time = time.time()
     try:
-        messages = chat_request.get("messages", [])
+        messages = chat_request.messages
         if not messages:
             raise HTTPException(status_code=400, detail="No messages provided")
         
         # Extract the last user message
         user_message = ""
         for msg in reversed(messages):
-            if msg.get("role") == "user":
-                user_message = msg.get("content", "")
+            if msg.role == "user":
+                user_message = msg.content
                 break
         
         if not user_message:
@@ -356,33 +1314,136 @@ async def chat_completions(
         # Sanitize input
         user_message = sanitize_input(user_message)
         
-        response = await qwen_api.generate_response(
+        adapter = select_adapter(chat_request.model, user_data)
+        result = await qwen_api.generate_response(
             prompt=user_message,
-            max_tokens=chat_request.get("max_tokens", 2048),
-            temperature=chat_request.get("temperature", 0.1),
-            top_p=chat_request.get("top_p", 0.95)
+            max_tokens=chat_request.max_tokens,
+            temperature=chat_request.temperature,
+            top_p=chat_request.top_p,
+            stop=chat_request.stop,
+            request=request,
+            n=chat_request.n,
+            best_of=chat_request.best_of,
+            seed=chat_request.seed,
+            adapter=adapter
         )
+        latency = time.time() - start_time
+        ENDPOINT_LATENCY.labels(endpoint="chat").observe(latency)
+        record_usage(user_data, "chat", result, latency, adapter)
         
-        return {
+        return FastJSONResponse({
             "choices": [{
+                "index": index,
                 "message": {
                     "role": "assistant",
-                    "content": response
+                    "content": choice["text_json"]
                 },
-                "finish_reason": "stop"
-            }],
-            "model": "qwen2.5-coder-32b",
+                "finish_reason": choice["finish_reason"]
+            } for index, choice in enumerate(result.get("choices") or [result])],
+            "model": adapter or "qwen2.5-coder-32b",
             "usage": {
-                "prompt_tokens": len(user_message.split()),
-                "completion_tokens": len(response.split()),
-                "total_tokens": len(user_message.split()) + len(response.split())
+                "prompt_tokens": result["prompt_tokens"],
+                "completion_tokens": result["completion_tokens"],
+                "total_tokens": result["prompt_tokens"] + result["completion_tokens"]
             }
-        }
+        })
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Chat completion error for user {user_data['user_id']}: {e}")
         raise HTTPException(status_code=500, detail="Chat completion failed")
 
+@app.post("/v1/completions")
+async def fim_completions(
+    request: Request,
+    completion_request: CompletionRequest,
+    user_data: Dict = Depends(require_generate_quota)
+):
+    """Low-latency fill-in-the-middle completion for IDE autocomplete"""
+    start_time = time.time()
+    try:
+        stop = FIM_STOPS[completion_request.mode] + (completion_request.stop or [])
+        adapter = select_adapter(completion_request.model, user_data)
+        result = await qwen_api.complete_fim(
+            prefix=completion_request.prefix,
+            suffix=completion_request.suffix,
+            max_tokens=completion_request.max_tokens,
+            temperature=completion_request.temperature,
+            stop=stop,
+            request=request,
+            adapter=adapter
+        )
+        latency = time.time() - start_time
+        ENDPOINT_LATENCY.labels(endpoint="completions").observe(latency)
+        record_usage(user_data, "completions", result, latency, adapter)
+
+        return FastJSONResponse({
+            "object": "text_completion",
+            "created": int(start_time),
+            "model": adapter or completion_request.model or MODEL_ID,
+            "choices": [{
+                "index": 0,
+                "text": result["text_json"],
+                "finish_reason": result["finish_reason"]
+            }],
+            "usage": {
+                "prompt_tokens": result["prompt_tokens"],
+                "completion_tokens": result["completion_tokens"],
+                "total_tokens": result["prompt_tokens"] + result["completion_tokens"]
+            }
+        })
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Completion error for user {user_data['user_id']}: {e}")
+        raise HTTPException(status_code=500, detail="Completion failed")
+
+def decode_embedding(vector: str) -> List[float]:
+    """base64 little-endian float32 -> list of floats"""
+    values = array("f", base64.b64decode(vector))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tolist()
+
+@app.post("/v1/embeddings")
+async def create_embeddings(
+    embedding_request: EmbeddingRequest,
+    user_data: Dict = Depends(require_generate_quota)
+):
+    """OpenAI-compatible embeddings (pooled hidden states of the loaded model)"""
+    start_time = time.time()
+    try:
+        result = await qwen_api.get_embeddings(embedding_request.input)
+        record_usage(
+            user_data, "embeddings", {**result, "completion_tokens": 0}, time.time() - start_time
+        )
+
+        if embedding_request.encoding_format == "base64":
+            embeddings = result["vectors"]
+        else:
+            embeddings = [decode_embedding(vector) for vector in result["vectors"]]
+
+        return FastJSONResponse({
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": index, "embedding": embedding}
+                for index, embedding in enumerate(embeddings)
+            ],
+            "model": embedding_request.model or MODEL_ID,
+            "usage": {
+                "prompt_tokens": result["prompt_tokens"],
+                "total_tokens": result["prompt_tokens"]
+            }
+        })
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Embedding error for user {user_data['user_id']}: {e}")
+        raise HTTPException(status_code=500, detail="Embedding failed")
+
 # Admin endpoints
 @app.post("/admin/create-api-key")
 async def create_api_key(
@@ -393,11 +1454,13 @@ async def create_api_key(
     try:
         user_id = key_request.get("user_id")
         permissions = key_request.get("permissions", ["generate"])
+        tier = key_request.get("tier", "standard")
+        adapter = key_request.get("adapter")
         
         if not user_id:
             raise HTTPException(status_code=400, detail="user_id required")
         
-        api_key = await api_key_manager.create_api_key(user_id, permissions)
+        api_key = await api_key_manager.create_api_key(user_id, permissions, tier, adapter)
         
         logger.info(f"API key created for {user_id} by admin {user_data['user_id']}")
         
@@ -405,6 +1468,8 @@ async def create_api_key(
             "api_key": api_key,
             "user_id": user_id,
             "permissions": permissions,
+            "tier": tier,
+            "adapter": adapter,
             "created_by": user_data["user_id"]
         }
         
@@ -412,14 +1477,111 @@ async def create_api_key(
         logger.error(f"API key creation error: {e}")
         raise HTTPException(status_code=500, detail="Failed to create API key")
 
+@app.post("/admin/api-keys/bulk")
+async def create_api_keys_bulk(
+    bulk_request: BulkAPIKeyRequest,
+    user_data: Dict = Depends(require_admin)
+):
+    """Create up to MAX_BULK_KEYS API keys in one call (Admin only)"""
+    try:
+        created = await api_key_manager.create_api_keys_bulk([spec.dict() for spec in bulk_request.keys])
+    except Exception as e:
+        logger.error(f"Bulk API key creation error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to create API keys")
+
+    logger.info(f"{len(created)} API keys created by admin {user_data['user_id']}")
+    return {"keys": created, "created_by": user_data["user_id"]}
+
+@app.post("/admin/api-keys/revoke")
+async def revoke_api_keys(
+    revoke_request: RevokeAPIKeysRequest,
+    user_data: Dict = Depends(require_admin)
+):
+    """Revoke keys by hash, or all keys of a user (Admin only)"""
+    key_hashes = revoke_request.key_hashes
+    user_id = revoke_request.user_id
+    if not key_hashes and not user_id:
+        raise HTTPException(status_code=400, detail="key_hashes or user_id required")
+
+    try:
+        revoked = await api_key_manager.revoke_api_keys(key_hashes)
+        if user_id:
+            revoked += await api_key_manager.revoke_user_keys(user_id)
+    except Exception as e:
+        logger.error(f"API key revocation error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to revoke API keys")
+
+    logger.info(f"{revoked} API keys revoked by admin {user_data['user_id']}")
+    return {"revoked": revoked, "revoked_by": user_data["user_id"]}
+
+@app.get("/admin/api-keys")
+async def list_api_keys(
+    user_id: Optional[str] = None,
+    cursor: str = "",
+    limit: int = 100,
+    user_data: Dict = Depends(require_admin)
+):
+    """List API keys page by page (Admin only)"""
+    if not 1 <= limit <= MAX_BULK_KEYS:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_BULK_KEYS}")
+
+    try:
+        return await api_key_manager.list_api_keys(user_id=user_id, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"API key listing error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to list API keys")
+
+@app.get("/admin/cache/export")
+async def export_cache(
+    limit: Optional[int] = None,
+    user_data: Dict = Depends(require_admin)
+):
+    """Export the response cache as a gzipped file (Admin only)"""
+    try:
+        payload = await qwen_api.export_cache(limit)
+    except Exception as e:
+        logger.error(f"Cache export error: {e}")
+        raise HTTPException(status_code=500, detail="Cache export failed")
+
+    logger.info(f"Cache exported by admin {user_data['user_id']}")
+    return Response(
+        payload,
+        media_type="application/gzip",
+        headers={"Content-Disposition": "attachment; filename=qwen-cache.jsonl.gz"}
+    )
+
+@app.post("/admin/cache/import")
+async def import_cache(
+    request: Request,
+    user_data: Dict = Depends(require_admin)
+):
+    """Import a file produced by /admin/cache/export (Admin only)"""
+    try:
+        imported = await qwen_api.import_cache(await request.body())
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cache file: {e}")
+    except Exception as e:
+        logger.error(f"Cache import error: {e}")
+        raise HTTPException(status_code=500, detail="Cache import failed")
+
+    logger.info(f"{imported} cache entries imported by admin {user_data['user_id']}")
+    return {
+        "imported": imported,
+        "memory_cache_size": len(qwen_api.memory_cache)
+    }
+
 # Health and monitoring
 @app.get("/health")
 async def health_check():
     """Public health check"""
     return {
         "status": "healthy",
-        "model_loaded": qwen_api.model is not None,
+        "model_loaded": qwen_api.ready,
         "device": qwen_api.device,
+        "replica": REPLICA_ID,
+        "load": qwen_api.load(),
         "timestamp": time.time()
     }
 
@@ -427,13 +1589,14 @@ async def health_check():
 async def get_stats(user_data: Dict = Depends(verify_token)):
     """User statistics"""
     try:
-        redis_client = await qwen_api.get_redis()
-        redis_connected = await redis_client.ping()
+        redis_connected = await (await qwen_api.get_cache()).ping()
     except:
         redis_connected = False
     
     gpu_info = None
-    if torch.cuda.is_available():
+    # Only meaningful where the model (and thereby torch) is loaded
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
         gpu_info = {
             "name": torch.cuda.get_device_name(0),
             "memory_allocated": torch.cuda.memory_allocated(0),
@@ -441,27 +1604,59 @@ async def get_stats(user_data: Dict = Depends(verify_token)):
             "memory_total": torch.cuda.get_device_properties(0).total_memory
         }
     
+    try:
+        usage = await usage_pipeline.get_user_usage(user_data["user_id"])
+    except Exception as e:
+        logger.warning(f"Usage rollup read error: {e}")
+        usage = None
+    
     return {
         "user_id": user_data["user_id"],
         "requests_today": user_data.get("requests_today", 0),
+        "usage": usage,
         "daily_limit": user_data.get("daily_limit", 1000),
         "cache_size": len(qwen_api.memory_cache),
         "redis_connected": redis_connected,
         "device": qwen_api.device,
-        "gpu_info": gpu_info
+        "gpu_info": gpu_info,
+        "memory": {
+            "pressure_level": memory_monitor.level,
+            "generation_concurrency": qwen_api.generation_slots.limit
+        }
     }
 
 @app.get("/admin/metrics")
 async def metrics(user_data: Dict = Depends(require_admin)):
    """Prometheus metrics (Admin only)"""
+   if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+       # Aggregate over all HTTP worker processes
+       registry = CollectorRegistry()
+       multiprocess.MultiProcessCollector(registry)
+       return Response(generate_latest(registry), media_type="text/plain")
    return Response(generate_latest(), media_type="text/plain")
 
 if __name__ == "__main__":
    import uvicorn
-   uvicorn.run(
-       "api_server:app",
-       host="0.0.0.0",
-       port=8000,
-       workers=1,
-       log_level="info"
-   )
+
+   workers = int(os.getenv("API_WORKERS", "1"))
+   inference_process = None
+   if workers > 1:
+       # One model-owning inference process, N lightweight HTTP workers
+       os.environ.setdefault("INFERENCE_SOCKET", "/tmp/qwen-inference.sock")
+       os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="qwen-metrics-"))
+       inference_process = subprocess.Popen(
+           [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "inference_worker.py")]
+       )
+
+   try:
+       uvicorn.run(
+           "api_server:app",
+           host="0.0.0.0",
+           port=8000,
+           workers=workers,
+           log_level="info"
+       )
+   finally:
+       if inference_process:
+           inference_process.terminate()
+           inference_process.wait()
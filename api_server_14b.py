@@ -1,7 +1,5 @@
 # ~/qwen-api/api_server_14b.py
 import asyncio
-import hashlib
-import json
 import logging
 import os
 import time
@@ -17,39 +15,47 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 from auth import verify_token, require_generate
+from cache_keys import build_cache_key, template_version
 
 # Logging Setup
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Verwende 14B Modell statt 32B
+MODEL_ID = os.getenv("MODEL_ID", "Qwen/Qwen2.5-Coder-14B-Instruct")
+MODEL_REVISION = os.getenv("MODEL_REVISION", "main")
+
 class QwenAPI14B:
     def __init__(self):
         self.model = None
         self.tokenizer = None
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.memory_cache = TTLCache(maxsize=500, ttl=3600)  # Smaller cache for 14B
+        self.chat_template_version = ""
         
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     async def load_model(self):
         """Load Qwen 2.5 14B Coder model"""
         try:
-            # Verwende 14B Modell statt 32B
-            model_path = "Qwen/Qwen2.5-Coder-14B-Instruct"
+            model_path = MODEL_ID
             
             logger.info(f"Loading Qwen 2.5 Coder 14B on {self.device}")
             
             # Load tokenizer
             self.tokenizer = AutoTokenizer.from_pretrained(
                 model_path,
+                revision=MODEL_REVISION,
                 trust_remote_code=True,
                 cache_dir="/app/models"
             )
+            self.chat_template_version = template_version(self.tokenizer.chat_template)
             
             # Load 14B model with optimizations for smaller GPU memory
             self.model = AutoModelForCausalLM.from_pretrained(
                 model_path,
                 device_map="auto",
                 torch_dtype=torch.bfloat16,  # Use bfloat16 for memory efficiency
+                revision=MODEL_REVISION,
                 trust_remote_code=True,
                 cache_dir="/app/models",
                 low_cpu_mem_usage=True,
@@ -66,10 +72,15 @@ class QwenAPI14B:
             logger.error(f"Error loading Qwen 2.5 Coder 14B: {e}")
             raise
 
-    def get_cache_key(self, prompt: str, **kwargs) -> str:
-        """Generate cache key from prompt and parameters"""
-        cache_data = {"prompt": prompt, **kwargs}
-        return hashlib.md5(json.dumps(cache_data, sort_keys=True).encode()).hexdigest()
+    def get_cache_key(self, token_ids, **params) -> Optional[str]:
+        """Canonical cache key for a tokenized prompt, None if not cacheable"""
+        return build_cache_key(
+            MODEL_ID,
+            MODEL_REVISION,
+            self.chat_template_version,
+            token_ids,
+            **params
+        )
 
     @torch.inference_mode()
     async def generate_response(
@@ -81,26 +92,27 @@ class QwenAPI14B:
     ) -> str:
         """Generate response with Qwen 2.5 14B"""
         
+        # Prepare input für 14B Modell
+        messages = [{"role": "user", "content": prompt}]
+        text = self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        )
+        inputs = self.tokenizer(text, return_tensors="pt")
+
         cache_key = self.get_cache_key(
-            prompt=prompt,
+            inputs.input_ids[0],
             max_tokens=max_tokens,
             temperature=temperature,
             top_p=top_p
         )
         
         # Check cache first
-        if cache_key in self.memory_cache:
+        if cache_key and cache_key in self.memory_cache:
             logger.info("Cache hit")
             return self.memory_cache[cache_key]
 
         try:
-            # Prepare input für 14B Modell
-            messages = [{"role": "user", "content": prompt}]
-            text = self.tokenizer.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=True
-            )
-            
-            inputs = self.tokenizer(text, return_tensors="pt").to(self.device)
+            inputs = inputs.to(self.device)
             
             # Generate with 14B optimizations
             with torch.cuda.amp.autocast():
@@ -123,7 +135,8 @@ class QwenAPI14B:
             )
             
             # Store in cache
-            self.memory_cache[cache_key] = response
+            if cache_key:
+                self.memory_cache[cache_key] = response
             
             return response
             
@@ -8,10 +8,13 @@ from typing import Dict, List, Optional
 from fastapi import HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-import redis.asyncio as redis
-from redis.asyncio import Redis
 import os
 import logging
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
 
 logger = logging.getLogger(__name__)
 
@@ -20,43 +23,234 @@ JWT_SECRET = os.getenv("JWT_SECRET", secrets.token_hex(32))
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
+# Auth pool (API keys and usage), apart from the possibly sharded response cache.
+# AUTH_REDIS_SENTINELS ("host:26379,host2:26379") follows the master of the
+# replicated AUTH_REDIS_MASTER set through Sentinel failovers; else
+# AUTH_REDIS_URL; else db 1 of the `redis` host.
+AUTH_REDIS_SENTINELS = os.getenv("AUTH_REDIS_SENTINELS", "")
+AUTH_REDIS_MASTER = os.getenv("AUTH_REDIS_MASTER", "qwen-auth")
+AUTH_REDIS_URL = os.getenv("AUTH_REDIS_URL", "")
+
+# API key indexes (db 1): all key hashes, and key hashes per user
+KEY_INDEX = "apikeys:index"
+USER_KEYS_PREFIX = "user_keys:"
+# Key hashes are sha256 hex digests, the global listing cursor is one of them
+KEY_HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+# Set once backfill_key_indexes has indexed the keys created before the indexes
+KEY_INDEX_BACKFILLED = "apikeys:index:backfilled"
+
 security = HTTPBearer()
 
 class APIKeyManager:
     def __init__(self):
-        self.redis_client: Optional[Redis] = None
+        self.redis_client: Optional["Redis"] = None
         
-    async def get_redis(self) -> Redis:
+    async def get_redis(self) -> "Redis":
         if not self.redis_client:
+            # Imported here so tools that only hash keys or sign tokens skip redis
+            import redis.asyncio as redis
+
             password = os.getenv("REDIS_PASSWORD", "")
-            self.redis_client = redis.Redis(
-                host='redis', 
-                port=6379, 
-                db=1, 
-                password=password,
-                decode_responses=True
-            )
+            if AUTH_REDIS_SENTINELS:
+                from redis.asyncio.sentinel import Sentinel
+
+                sentinels = [(host, int(port)) for host, port in
+                             (address.strip().rsplit(":", 1) for address in AUTH_REDIS_SENTINELS.split(","))]
+                self.redis_client = Sentinel(sentinels, sentinel_kwargs={"password": password or None}).master_for(
+                    AUTH_REDIS_MASTER, db=1, password=password or None, decode_responses=True
+                )
+            elif AUTH_REDIS_URL:
+                self.redis_client = redis.Redis.from_url(
+                    AUTH_REDIS_URL, password=password or None, decode_responses=True
+                )
+            else:
+                self.redis_client = redis.Redis(
+                    host='redis', 
+                    port=6379, 
+                    db=1, 
+                    password=password,
+                    decode_responses=True
+                )
         return self.redis_client
         
-    async def create_api_key(self, user_id: str, permissions: Optional[List[str]] = None) -> str:
-        """Create hashed API key"""
+    @staticmethod
+    def _new_key_record(user_id: str, permissions: Optional[List[str]], tier: str, adapter: Optional[str] = None):
+        """Generate a raw key plus its hash and stored metadata.
+
+        adapter is the LoRA adapter the key's requests use unless they name
+        another model.
+        """
         raw_key = secrets.token_hex(32)
         hashed_key = hashlib.sha256(raw_key.encode()).hexdigest()
         
         key_data = {
             "user_id": user_id,
             "permissions": ",".join(permissions or ["generate"]),
+            "tier": tier,
             "created_at": datetime.utcnow().isoformat(),
             "requests_today": "0",
             "daily_limit": "1000",
             "last_reset": datetime.utcnow().date().isoformat()
         }
+        if adapter:
+            key_data["adapter"] = adapter
+        return raw_key, hashed_key, key_data
+
+    @staticmethod
+    def _queue_key_writes(pipe, hashed_key: str, key_data: Dict):
+        """Key hash plus both secondary indexes, queued on a MULTI pipeline"""
+        pipe.hset(f"apikey:{hashed_key}", mapping=key_data)
+        pipe.sadd(f"{USER_KEYS_PREFIX}{key_data['user_id']}", hashed_key)
+        pipe.zadd(KEY_INDEX, {hashed_key: 0})
+
+    async def create_api_key(
+        self,
+        user_id: str,
+        permissions: Optional[List[str]] = None,
+        tier: str = "standard",
+        adapter: Optional[str] = None
+    ) -> str:
+        """Create hashed API key"""
+        raw_key, hashed_key, key_data = self._new_key_record(user_id, permissions, tier, adapter)
         
         redis_client = await self.get_redis()
-        await redis_client.hset(f"apikey:{hashed_key}", mapping=key_data)  # type: ignore
+        async with redis_client.pipeline(transaction=True) as pipe:
+            self._queue_key_writes(pipe, hashed_key, key_data)
+            await pipe.execute()
         
         logger.info(f"Created API key for user: {user_id}")
         return raw_key
+
+    async def create_api_keys_bulk(self, requests: List[Dict]) -> List[Dict]:
+        """Create many keys in one pipelined transaction.
+
+        Each request needs user_id and may set permissions, tier and adapter.
+        """
+        created = []
+        redis_client = await self.get_redis()
+        async with redis_client.pipeline(transaction=True) as pipe:
+            for spec in requests:
+                tier = spec.get("tier", "standard")
+                raw_key, hashed_key, key_data = self._new_key_record(
+                    spec["user_id"], spec.get("permissions"), tier, spec.get("adapter")
+                )
+                self._queue_key_writes(pipe, hashed_key, key_data)
+                created.append({
+                    "api_key": raw_key,
+                    "key_hash": hashed_key,
+                    "user_id": spec["user_id"],
+                    "permissions": key_data["permissions"].split(","),
+                    "tier": tier,
+                    "adapter": spec.get("adapter")
+                })
+            await pipe.execute()
+
+        logger.info(f"Created {len(created)} API keys in bulk")
+        return created
+
+    async def backfill_key_indexes(self, batch: int = 1000) -> int:
+        """Index the keys created before KEY_INDEX and the per-user sets existed.
+
+        One SCAN over apikey:* per database, skipped once it has completed.
+        Re-running it is harmless. Returns the number of keys newly indexed.
+        """
+        redis_client = await self.get_redis()
+        if await redis_client.exists(KEY_INDEX_BACKFILLED):
+            return 0
+
+        added, cursor = 0, 0
+        while True:
+            cursor, keys = await redis_client.scan(cursor=cursor, match="apikey:*", count=batch)
+            if keys:
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    for key in keys:
+                        pipe.hget(key, "user_id")
+                    owners = await pipe.execute()
+                async with redis_client.pipeline(transaction=True) as pipe:
+                    for key, user_id in zip(keys, owners):
+                        if user_id:
+                            hashed_key = key[len("apikey:"):]
+                            pipe.sadd(f"{USER_KEYS_PREFIX}{user_id}", hashed_key)
+                            pipe.zadd(KEY_INDEX, {hashed_key: 0})
+                    results = await pipe.execute()
+                # zadd replies (every second one) count the keys not indexed before
+                added += sum(results[1::2])
+            if not int(cursor):
+                break
+
+        await redis_client.set(KEY_INDEX_BACKFILLED, datetime.utcnow().isoformat())
+        logger.info(f"Backfilled the API key indexes with {added} keys")
+        return added
+
+    async def revoke_api_keys(self, key_hashes: List[str]) -> int:
+        """Delete keys by hash and drop them from both indexes"""
+        if not key_hashes:
+            return 0
+        redis_client = await self.get_redis()
+
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for hashed_key in key_hashes:
+                pipe.hget(f"apikey:{hashed_key}", "user_id")
+            owners = await pipe.execute()
+
+        async with redis_client.pipeline(transaction=True) as pipe:
+            for hashed_key, user_id in zip(key_hashes, owners):
+                pipe.delete(f"apikey:{hashed_key}")
+                pipe.zrem(KEY_INDEX, hashed_key)
+                if user_id:
+                    pipe.srem(f"{USER_KEYS_PREFIX}{user_id}", hashed_key)
+            await pipe.execute()
+
+        revoked = sum(1 for user_id in owners if user_id)
+        logger.info(f"Revoked {revoked} API keys")
+        return revoked
+
+    async def revoke_user_keys(self, user_id: str) -> int:
+        """Revoke every key of a user via the per-user index"""
+        redis_client = await self.get_redis()
+        key_hashes = list(await redis_client.smembers(f"{USER_KEYS_PREFIX}{user_id}"))
+        return await self.revoke_api_keys(key_hashes)
+
+    async def list_api_keys(self, user_id: Optional[str] = None, cursor: str = "", limit: int = 100) -> Dict:
+        """Cursor-paginated key listing, O(page size) regardless of key count.
+
+        With user_id the per-user set is scanned, otherwise the global index
+        is walked in key-hash order. Pass the returned next_cursor to get the
+        following page; it is None after the last page. ValueError for a
+        cursor that is not one of ours.
+        """
+        if cursor and not (cursor.isdigit() if user_id else KEY_HASH_PATTERN.fullmatch(cursor)):
+            raise ValueError(f"Invalid cursor: {cursor!r}")
+        redis_client = await self.get_redis()
+
+        if user_id:
+            scan_cursor, key_hashes = await redis_client.sscan(
+                f"{USER_KEYS_PREFIX}{user_id}", cursor=int(cursor or 0), count=limit
+            )
+            next_cursor = str(scan_cursor) if int(scan_cursor) else None
+        else:
+            start = f"({cursor}" if cursor else "-"
+            key_hashes = await redis_client.zrangebylex(KEY_INDEX, start, "+", start=0, num=limit)
+            next_cursor = key_hashes[-1] if len(key_hashes) == limit else None
+
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for hashed_key in key_hashes:
+                pipe.hgetall(f"apikey:{hashed_key}")
+            records = await pipe.execute()
+
+        keys = [
+            {
+                "key_hash": hashed_key,
+                "user_id": data["user_id"],
+                "permissions": data["permissions"].split(","),
+                "tier": data.get("tier", "standard"),
+                "adapter": data.get("adapter"),
+                "created_at": data.get("created_at"),
+                "requests_today": int(data.get("requests_today", 0))
+            }
+            for hashed_key, data in zip(key_hashes, records) if data
+        ]
+        return {"keys": keys, "next_cursor": next_cursor}
     
     async def verify_api_key(self, api_key: str) -> Dict:
         """Verify and get API key data"""
@@ -70,6 +264,7 @@ class APIKeyManager:
             return {
                 "user_id": "admin",
                 "permissions": ["admin", "generate", "read"],
+                "tier": "admin",
                 "requests_today": 0,
                 "daily_limit": 10000
             }
@@ -77,6 +272,7 @@ class APIKeyManager:
             return {
                 "user_id": "api_user", 
                 "permissions": ["generate", "read"],
+                "tier": "standard",
                 "requests_today": 0,
                 "daily_limit": 1000
             }
@@ -84,6 +280,7 @@ class APIKeyManager:
             return {
                 "user_id": "readonly_user",
                 "permissions": ["read"],
+                "tier": "readonly",
                 "requests_today": 0,
                 "daily_limit": 5000
             }
@@ -102,10 +299,16 @@ class APIKeyManager:
         # Reset daily counter if new day
         today = datetime.utcnow().date().isoformat()
         if key_data.get("last_reset") != today:
-            await redis_client.hset(f"apikey:{hashed_key}", mapping={  # type: ignore
-                "requests_today": "0",
-                "last_reset": today
-            })
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(f"apikey:{hashed_key}", mapping={
+                    "requests_today": "0",
+                    "last_reset": today
+                })
+                # Once a day per key: also indexes keys written by servers predating
+                # the indexes after backfill_key_indexes ran
+                pipe.sadd(f"{USER_KEYS_PREFIX}{key_data['user_id']}", hashed_key)
+                pipe.zadd(KEY_INDEX, {hashed_key: 0})
+                await pipe.execute()
             key_data["requests_today"] = "0"
         
         # Check daily limit
@@ -118,21 +321,30 @@ class APIKeyManager:
                 detail="Daily limit exceeded"
             )
         
-        # Increment request counter
-        await redis_client.hincrby(f"apikey:{hashed_key}", "requests_today", 1)  # type: ignore
+        # requests_today is incremented asynchronously by the usage pipeline
+        # (usage_events.py), keeping the write off the request path
         
         return {
             "user_id": key_data["user_id"],
             "permissions": key_data["permissions"].split(","),
+            "tier": key_data.get("tier", "standard"),
+            "adapter": key_data.get("adapter"),
+            "key_hash": hashed_key,
             "requests_today": requests_today + 1,
             "daily_limit": daily_limit
         }
 
-    async def create_jwt_token(self, user_id: str, permissions: Optional[List[str]] = None) -> str:
+    async def create_jwt_token(
+        self,
+        user_id: str,
+        permissions: Optional[List[str]] = None,
+        tier: str = "standard"
+    ) -> str:
         """Create JWT token"""
         payload = {
             "user_id": user_id,
             "permissions": permissions or ["generate"],
+            "tier": tier,
             "exp": datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS),
             "iat": datetime.utcnow()
         }
@@ -151,6 +363,7 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
             return {
                 "user_id": payload["user_id"],
                 "permissions": payload["permissions"],
+                "tier": payload.get("tier", "standard"),
                 "token_type": "jwt"
             }
         else:
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_affinity_router.py
+"""
+Benchmark: round-robin vs cache-affinity routing over local API replicas
+
+    python bench_affinity_router.py
+    python bench_affinity_router.py --replicas 4 --sessions 16 --requests 320
+
+Starts --replicas API server processes (tiny stand-in model on CPU,
+continuous-batching engine with a KV pool sized for its share of the
+sessions) that share one Redis (fakeredis over TCP), and runs the same
+workload through affinity_router.py once per policy, with fresh replicas
+and an empty Redis each time. Each session has a long context (a file, a
+system prompt) followed by one of a few questions, so requests of a session
+share a prompt prefix and some repeat exactly (response cache hits).
+Reported: latency (prompt prefill saved by KV prefix reuse shows here),
+response cache hits and how requests spread over the replicas. Also shows how many keys move when
+a replica leaves the hash ring.
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import random
+import socket
+import threading
+import time
+from collections import Counter
+
+import fakeredis
+import httpx
+
+from affinity_router import AffinityRouter, create_app
+from hash_ring import HashRing
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_replica(port: int, redis_port: int, replica_id: str, pool_blocks: int, concurrency: int):
+    """One API server process on the stand-in model (multiprocessing target)"""
+    logging.getLogger().setLevel(logging.WARNING)
+    import redis.asyncio as redis
+    import uvicorn
+
+    import api_server
+    from cache_keys import template_version
+    from generation_engine import GenerationEngine
+    from memory_monitor import AdjustableSemaphore
+    from paged_kv import PagedKVPool
+    from rate_limit import parse_tier_limits
+    from replay_traffic import load_stand_in
+
+    api_server.REPLICA_ID = replica_id
+    model, tokenizer = load_stand_in(None)
+    qwen_api = api_server.qwen_api
+    qwen_api.model, qwen_api.tokenizer, qwen_api.device = model, tokenizer, "cpu"
+    qwen_api.chat_template_version = template_version(tokenizer.chat_template)
+    qwen_api.generation_slots = AdjustableSemaphore(concurrency)
+    qwen_api.engine = GenerationEngine(model, tokenizer, "cpu", pool=PagedKVPool(model, pool_blocks, 16),
+                                       max_sequences=concurrency)
+    qwen_api.engine.start()
+    api_server.rate_limiter.limits = parse_tier_limits("standard=1000000/second")
+
+    async def main():
+        qwen_api.redis_client = redis.Redis(host="127.0.0.1", port=redis_port, db=0, decode_responses=True)
+        api_server.api_key_manager.redis_client = redis.Redis(host="127.0.0.1", port=redis_port, db=1,
+                                                               decode_responses=True)
+        api_server.usage_pipeline.start()
+        # The model is already in place, the app's lifespan would load MODEL_ID
+        config = uvicorn.Config(api_server.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning")
+        await uvicorn.Server(config).serve()
+
+    asyncio.run(main())
+
+
+def workload(args):
+    rng = random.Random(0)
+    words = ["def", "return", "value", "self", "import", "class", "for", "in", "range", "if", "else", "data"]
+    contexts = [
+        f"# file {s}\n" + " ".join(rng.choice(words) for _ in range(args.context // 5))
+        for s in range(args.sessions)
+    ]
+    questions = [f"\n\nQuestion {q}: what does this code do?" for q in range(args.questions)]
+    return [contexts[rng.randrange(args.sessions)] + rng.choice(questions) for _ in range(args.requests)]
+
+
+async def run_policy(policy: str, args, prompts, redis_port: int, redis_server) -> dict:
+    fakeredis.FakeStrictRedis(server=redis_server).flushall()
+    ctx = multiprocessing.get_context("spawn")
+    # Room for a bit more than a replica's share of the sessions
+    blocks_per_prompt = math.ceil((args.context + 64 + args.max_tokens) / 16)
+    pool_blocks = (math.ceil(1.25 * args.sessions / args.replicas) + 2) * blocks_per_prompt
+    ports = [free_port() for _ in range(args.replicas)]
+    processes = [
+        ctx.Process(target=serve_replica, args=(port, redis_port, f"replica-{i}", pool_blocks, args.concurrency),
+                    daemon=True)
+        for i, port in enumerate(ports)
+    ]
+    for p in processes:
+        p.start()
+
+    router = AffinityRouter([f"http://127.0.0.1:{port}" for port in ports], policy=policy)
+    try:
+        await router.start()
+        while not all(r.healthy for r in router.replicas.values()):
+            await asyncio.sleep(0.5)
+            await router.check_all()
+
+        import redis.asyncio as redis
+        from auth import APIKeyManager
+
+        manager = APIKeyManager()
+        manager.redis_client = redis.Redis(host="127.0.0.1", port=redis_port, db=1, decode_responses=True)
+        api_key = await manager.create_api_key("bench", tier="standard")
+
+        transport = httpx.ASGITransport(app=create_app(router))
+        headers = {"Authorization": f"Bearer {api_key}"}
+        latencies, hits, replicas, routing = [], 0, Counter(), Counter()
+        queue = list(enumerate(prompts))
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://localhost", timeout=None) as client:
+            async def worker():
+                nonlocal hits
+                while queue:
+                    _, prompt = queue.pop(0)
+                    started = time.perf_counter()
+                    response = await client.post("/v1/generate", headers=headers, json={
+                        "prompt": prompt, "max_tokens": args.max_tokens, "temperature": 0.0
+                    })
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - started)
+                    hits += "cache;desc=hit" in response.headers.get("server-timing", "")
+                    replicas[response.headers["x-replica"]] += 1
+                    routing[response.headers["x-routing"]] += 1
+
+            begin = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - begin
+    finally:
+        await router.stop()
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.join()
+
+    latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[int(len(latencies) * 0.95)],
+        "hits": hits,
+        "replicas": dict(sorted(replicas.items())),
+        "routing": dict(routing),
+    }
+
+
+def key_movement(replicas: int, keys: int = 20000) -> float:
+    """Share of keys that change replica when the last replica leaves the ring"""
+    urls = [f"http://replica-{i}" for i in range(replicas)]
+    before, after = HashRing(urls), HashRing(urls[:-1])
+    sample = [f"key-{i}" for i in range(keys)]
+    return sum(before.owner(k) != after.owner(k) for k in sample) / keys
+
+
+async def main_async(args):
+    prompts = workload(args)
+    redis_port = free_port()
+    fake_server = fakeredis.TcpFakeServer(("127.0.0.1", redis_port), server_type="redis")
+    threading.Thread(target=fake_server.serve_forever, daemon=True).start()
+
+    print(f"{args.replicas} replicas, {args.sessions} sessions x {args.questions} questions, "
+          f"{args.requests} requests of ~{args.context} prompt tokens, {args.concurrency} clients")
+    print(f"{'policy':12s} {'time':>7s} {'p50':>8s} {'p95':>8s} {'cache hits':>11s}  requests per replica / routing")
+    for policy in ("round_robin", "affinity"):
+        r = await run_policy(policy, args, prompts, redis_port, fake_server.fake_server)
+        print(f"{policy:12s} {r['elapsed']:6.2f}s {r['p50'] * 1000:6.0f}ms {r['p95'] * 1000:6.0f}ms {r['hits']:11d}  "
+              f"{list(r['replicas'].values())} {r['routing']}")
+    print(f"Keys moved when one of {args.replicas} replicas leaves the ring: "
+          f"{key_movement(args.replicas):.1%} (ideal {1 / args.replicas:.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--sessions", type=int, default=12)
+    parser.add_argument("--questions", type=int, default=6, help="distinct questions per session context")
+    parser.add_argument("--requests", type=int, default=240)
+    parser.add_argument("--context", type=int, default=1500, help="session context in characters (= tokens)")
+    parser.add_argument("--max-tokens", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=6, help="concurrent clients")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_cache_key.py
+"""
+Benchmark: cache key cost for long prompts (legacy MD5/JSON vs canonical key)
+
+    python bench_cache_key.py [--chars 50000] [--iterations 200]
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import string
+import time
+
+import cache_keys
+
+
+def legacy_key(prompt: str, **kwargs) -> str:
+    """Key scheme used before cache_keys.py"""
+    cache_data = {"prompt": prompt, **kwargs}
+    return hashlib.md5(json.dumps(cache_data, sort_keys=True).encode()).hexdigest()
+
+
+def timed(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chars", type=int, default=50000)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    prompt = "".join(rng.choice(string.printable) for _ in range(args.chars))
+    # Roughly 4 characters per token for source code
+    token_ids = [rng.randrange(151643) for _ in range(args.chars // 4)]
+    params = {"max_tokens": 2048, "temperature": 0.0, "top_p": 0.95, "stop": []}
+
+    legacy = timed(lambda: legacy_key(prompt, **params), args.iterations)
+    canonical = timed(
+        lambda: cache_keys.build_cache_key("Qwen/Qwen2.5-Coder-32B-Instruct", "main", "0" * 8, token_ids, **params),
+        args.iterations
+    )
+
+    backend = "xxh3_128" if cache_keys.xxhash is not None else "blake2b (install xxhash for xxh3)"
+    print(f"Prompt: {args.chars} chars, {len(token_ids)} tokens, hash backend: {backend}")
+    print(f"  legacy md5(json.dumps(prompt)) : {legacy:8.1f} µs/key")
+    print(f"  canonical token-ID key         : {canonical:8.1f} µs/key")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_chunked_prefill.py
+"""
+Benchmark: inter-token latency of running requests while a long prompt arrives
+
+    python bench_chunked_prefill.py
+    python bench_chunked_prefill.py --long-tokens 12000 --chunks 0 256 512 1024
+
+A few short requests decode on the generation engine (tiny stand-in model,
+CPU); once they are running, one long prompt is submitted. Reported per
+prefill chunk size (0 = whole prompt in one step, the unchunked behaviour):
+inter-token latency of the short requests while the long prompt is being
+prefilled, their latency before it arrived, and the long request's time to
+first token.
+"""
+
+import argparse
+import random
+import threading
+import time
+
+from generation_engine import GenerationEngine
+from paged_kv import PagedKVPool
+from replay_traffic import load_stand_in
+
+
+class TimedEngine(GenerationEngine):
+    """Records when each request got a new token"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_times = {}
+
+    def _finish_step(self, batch, logits):
+        now = time.perf_counter()
+        for request in batch:
+            if request.table.length == len(request.tokens):
+                self.token_times.setdefault(id(request), []).append(now)
+        super()._finish_step(batch, logits)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def run(model, tokenizer, args, chunk: int) -> dict:
+    unchunked = chunk == 0
+    engine = TimedEngine(
+        model, tokenizer, "cpu", pool=PagedKVPool.for_memory(model, 0.5),
+        step_tokens=10**9 if unchunked else max(args.step_tokens, args.short + chunk),
+        chunk_tokens=10**9 if unchunked else chunk
+    )
+    engine.start()
+    rng = random.Random(0)
+    shorts = [
+        engine.submit([rng.randint(32, 126) for _ in range(64)], threading.Event(),
+                      max_tokens=args.short_tokens, temperature=0.0, top_p=1.0, stop=[])
+        for _ in range(args.short)
+    ]
+    time.sleep(args.warmup)
+    long_prompt = [rng.randint(32, 126) for _ in range(args.long_tokens)]
+    submitted = time.perf_counter()
+    long_future = engine.submit(long_prompt, threading.Event(), max_tokens=1, temperature=0.0, top_p=1.0, stop=[])
+    long_future.result()
+    first_token = time.perf_counter()
+    for future in shorts:
+        future.result()
+    engine.stop()
+
+    before, during = [], []
+    for times in engine.token_times.values():
+        if len(times) > 200:
+            continue  # not a short request
+        for previous, current in zip(times, times[1:]):
+            if current <= submitted:
+                before.append(current - previous)
+            elif previous < first_token:
+                during.append(current - previous)
+    return {"ttft": first_token - submitted, "before": before, "during": during}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--short", type=int, default=6, help="concurrently decoding short requests")
+    parser.add_argument("--short-tokens", type=int, default=150, help="tokens each short request generates")
+    parser.add_argument("--long-tokens", type=int, default=12000, help="prompt tokens of the long request")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[0, 256, 512, 1024])
+    parser.add_argument("--step-tokens", type=int, default=0, help="step budget (default: short requests + chunk)")
+    parser.add_argument("--warmup", type=float, default=0.5, help="seconds of decoding before the long prompt")
+    args = parser.parse_args()
+
+    model, tokenizer = load_stand_in(None)
+    print(f"{args.short} short requests decoding, one {args.long_tokens}-token prompt arrives")
+    print(f"{'chunk':>7s} {'ITL before p50':>15s} {'ITL during p50':>15s} {'p99':>9s} {'max':>9s} {'long TTFT':>10s}")
+    for chunk in args.chunks:
+        r = run(model, tokenizer, args, chunk)
+        print(f"{chunk or 'none':>7} {percentile(r['before'], 0.5) * 1000:13.1f}ms "
+              f"{percentile(r['during'], 0.5) * 1000:13.1f}ms {percentile(r['during'], 0.99) * 1000:7.1f}ms "
+              f"{max(r['during'], default=0) * 1000:7.1f}ms {r['ttft'] * 1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_client.py
+"""
+Benchmark: qwen_client.py vs a requests.post per call (test_api.py)
+
+    python bench_client.py
+    python bench_client.py --requests 256 --concurrency 16 --no-tls
+
+Starts an API server process (tiny stand-in model on CPU, continuous-
+batching engine, fakeredis over TCP) behind TLS with a throwaway
+self-signed certificate, as clients reach it through nginx. Each mode
+sends --requests distinct prompts (no response cache hits):
+
+naive     requests.post one after the other, a new TLS connection each
+client    QwenClient.generate one after the other, pooled keep-alive
+async     AsyncQwenClient.generate, --concurrency calls at a time
+batcher   Batcher.generate for all prompts at once (/v1/batch/generate)
+
+Also checks against a mock transport that 429 answers are retried after
+their Retry-After and that chat_stream() reassembles an SSE stream.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import fakeredis
+import httpx
+import requests
+
+from qwen_client import AsyncQwenClient, Batcher, QwenClient
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def self_signed_cert(directory: str):
+    certfile, keyfile = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+        "-addext", "subjectAltName=DNS:localhost", "-keyout", keyfile, "-out", certfile
+    ], check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def serve_api(port: int, redis_port: int, certfile, keyfile, concurrency: int):
+    """API server process on the stand-in model (multiprocessing target)"""
+    import redis.asyncio as redis
+    import uvicorn
+
+    import api_server
+    from cache_keys import template_version
+    from generation_engine import GenerationEngine
+    from memory_monitor import AdjustableSemaphore
+    from paged_kv import PagedKVPool
+    from rate_limit import parse_tier_limits
+    from replay_traffic import load_stand_in
+
+    logging.getLogger().setLevel(logging.WARNING)
+    model, tokenizer = load_stand_in(None)
+    qwen_api = api_server.qwen_api
+    qwen_api.model, qwen_api.tokenizer, qwen_api.device = model, tokenizer, "cpu"
+    qwen_api.chat_template_version = template_version(tokenizer.chat_template)
+    qwen_api.generation_slots = AdjustableSemaphore(concurrency)
+    qwen_api.engine = GenerationEngine(model, tokenizer, "cpu", pool=PagedKVPool(model, 64 * concurrency, 16),
+                                       max_sequences=concurrency)
+    qwen_api.engine.start()
+    api_server.rate_limiter.limits = parse_tier_limits("standard=1000000/second")
+
+    async def main():
+        # Every prompt of the batches in flight reads the cache at once
+        qwen_api.redis_client = redis.Redis(host="127.0.0.1", port=redis_port, db=0, decode_responses=True,
+                                            max_connections=1000)
+        api_server.api_key_manager.redis_client = redis.Redis(host="127.0.0.1", port=redis_port, db=1,
+                                                               decode_responses=True)
+        api_server.usage_pipeline.start()
+        # The model is already in place, the app's lifespan would load MODEL_ID
+        config = uvicorn.Config(api_server.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning",
+                                ssl_certfile=certfile, ssl_keyfile=keyfile)
+        await uvicorn.Server(config).serve()
+
+    asyncio.run(main())
+
+
+def prompts(mode: str, count: int):
+    return [f"# {mode} request {i}\ndef add_{i}(a, b):" for i in range(count)]
+
+
+def run_naive(base_url, api_key, verify, args):
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    for prompt in prompts("naive", args.requests):
+        response = requests.post(f"{base_url}/v1/generate", headers=headers, verify=verify, timeout=60,
+                                 json={"prompt": prompt, "max_tokens": args.max_tokens, "temperature": 0.0})
+        response.raise_for_status()
+
+
+def run_client(base_url, api_key, verify, args):
+    with QwenClient(base_url, api_key, verify=verify) as client:
+        for prompt in prompts("client", args.requests):
+            client.generate(prompt, max_tokens=args.max_tokens, temperature=0.0)
+
+
+async def run_async(base_url, api_key, verify, args):
+    async with AsyncQwenClient(base_url, api_key, max_connections=args.concurrency, verify=verify) as client:
+        queue = prompts("async", args.requests)
+
+        async def worker():
+            while queue:
+                await client.generate(queue.pop(), max_tokens=args.max_tokens, temperature=0.0)
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+
+async def run_batcher(base_url, api_key, verify, args):
+    async with AsyncQwenClient(base_url, api_key, verify=verify) as client:
+        batcher = Batcher(client, max_batch=args.batch)
+        await asyncio.gather(*(
+            batcher.generate(prompt, max_tokens=args.max_tokens, temperature=0.0)
+            for prompt in prompts("batcher", args.requests)
+        ))
+        await batcher.close()
+
+
+def check_retry_after():
+    """Seconds QwenClient took over a 429 with Retry-After: 1 followed by a 200"""
+    answers = [
+        httpx.Response(429, headers={"Retry-After": "1"}, json={"detail": "Rate limit exceeded"}),
+        httpx.Response(200, json={"response": "ok"}),
+    ]
+    transport = httpx.MockTransport(lambda request: answers.pop(0))
+    with QwenClient("http://mock", "key", transport=transport) as client:
+        start = time.perf_counter()
+        result = client.generate("hi")
+    return time.perf_counter() - start, result["response"]
+
+
+async def check_stream():
+    words = ["def ", "add", "(a, b):", "\n    return a + b"]
+    body = "".join(
+        f"data: {json.dumps({'choices': [{'index': 0, 'delta': {'content': w}}]})}\n\n" for w in words
+    ) + "data: [DONE]\n\n"
+    transport = httpx.MockTransport(lambda request: httpx.Response(
+        200, headers={"content-type": "text/event-stream"}, content=body.encode()
+    ))
+    async with AsyncQwenClient("http://mock", "key", transport=transport) as client:
+        chunks = [c async for c in client.chat_stream([{"role": "user", "content": "add"}])]
+    return chunks == words, len(chunks)
+
+
+async def create_key(redis_port: int) -> str:
+    import redis.asyncio as redis
+    from auth import APIKeyManager
+
+    manager = APIKeyManager()
+    manager.redis_client = redis.Redis(host="127.0.0.1", port=redis_port, db=1, decode_responses=True)
+    api_key = await manager.create_api_key("bench", tier="standard")
+    await manager.redis_client.aclose()
+    return api_key
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=128, help="prompts per mode")
+    parser.add_argument("--max-tokens", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=8, help="server generation slots, async client tasks")
+    parser.add_argument("--batch", type=int, default=32, help="Batcher max_batch")
+    parser.add_argument("--no-tls", action="store_true", help="plain HTTP (no handshake to save)")
+    parser.add_argument("--modes", default="naive,client,async,batcher")
+    args = parser.parse_args()
+
+    seconds, response = check_retry_after()
+    print(f"retry: 429 with Retry-After: 1 -> {response!r} after {seconds:.2f}s")
+    ok, chunks = asyncio.run(check_stream())
+    print(f"stream: {chunks} SSE chunks reassembled {'correctly' if ok else 'WRONG'}")
+
+    redis_port = free_port()
+    fake_server = fakeredis.TcpFakeServer(("127.0.0.1", redis_port), server_type="redis")
+    threading.Thread(target=fake_server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = (None, None) if args.no_tls else self_signed_cert(directory)
+        port = free_port()
+        base_url = f"{'http' if args.no_tls else 'https'}://localhost:{port}"
+        verify = certfile or True
+        server = multiprocessing.get_context("spawn").Process(
+            target=serve_api, args=(port, redis_port, certfile, keyfile, args.concurrency), daemon=True
+        )
+        server.start()
+        try:
+            api_key = asyncio.run(create_key(redis_port))
+            while True:
+                try:
+                    httpx.get(f"{base_url}/health", verify=verify)
+                    break
+                except httpx.TransportError:
+                    time.sleep(0.5)
+            # Compiles the model's kernels for the batch sizes the modes use
+            asyncio.run(run_batcher(base_url, api_key, verify, argparse.Namespace(**{**vars(args), "requests": 16})))
+
+            print(f"{args.requests} requests per mode, max_tokens {args.max_tokens}, "
+                  f"{'plain HTTP' if args.no_tls else 'TLS'}")
+            print(f"{'mode':8s} {'time':>8s} {'req/s':>8s} {'speedup':>8s}")
+            runs = {"naive": run_naive, "client": run_client, "async": run_async, "batcher": run_batcher}
+            baseline = None
+            for mode in args.modes.split(","):
+                start = time.perf_counter()
+                result = runs[mode](base_url, api_key, verify, args)
+                if asyncio.iscoroutine(result):
+                    asyncio.run(result)
+                elapsed = time.perf_counter() - start
+                baseline = baseline or elapsed
+                print(f"{mode:8s} {elapsed:7.2f}s {args.requests / elapsed:8.1f} {baseline / elapsed:7.1f}x")
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_cpu_inference.py
+"""
+Benchmark: CPU-only decode throughput, default settings vs tuned CPU mode
+
+    python bench_cpu_inference.py                       # Qwen2.5-Coder-0.5B-Instruct
+    python bench_cpu_inference.py --tiny                # random tiny Qwen2, no download
+    python bench_cpu_inference.py --modes baseline tuned int8
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM
+
+import cpu_tuning
+
+TINY_CONFIG = dict(
+    vocab_size=151936,
+    hidden_size=256,
+    intermediate_size=1024,
+    num_hidden_layers=4,
+    num_attention_heads=8,
+    num_key_value_heads=2,
+    max_position_embeddings=4096,
+)
+
+
+def load(args, dtype, attn_implementation):
+    if args.tiny:
+        torch.manual_seed(0)
+        config = AutoConfig.for_model("qwen2", **TINY_CONFIG)
+        return AutoModelForCausalLM.from_config(
+            config, torch_dtype=dtype, attn_implementation=attn_implementation
+        ).eval()
+    return AutoModelForCausalLM.from_pretrained(
+        args.model, torch_dtype=dtype, attn_implementation=attn_implementation, low_cpu_mem_usage=True
+    ).eval()
+
+
+def build(args, mode):
+    if mode == "baseline":
+        # What QwenAPI did on CPU before the CPU execution mode
+        model = load(args, torch.bfloat16, "eager")
+        return model, lambda **kw: _generate(model, torch.cuda.amp.autocast(), **kw)
+
+    cpu_tuning.configure_cpu_runtime()
+    dtype_mode = "int8" if mode == "int8" else cpu_tuning.CPU_DTYPE
+    model = load(args, cpu_tuning.cpu_load_dtype(dtype_mode), "sdpa")
+    model = cpu_tuning.optimize_cpu_model(model, mode=dtype_mode, compile_model=not args.no_compile)
+    return model, lambda **kw: _generate(model, torch.autocast("cpu", enabled=False), **kw)
+
+
+def _generate(model, autocast, input_ids, new_tokens):
+    with torch.inference_mode(), autocast:
+        return model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="Qwen/Qwen2.5-Coder-0.5B-Instruct")
+    parser.add_argument("--tiny", action="store_true", help="random tiny Qwen2 instead of --model")
+    parser.add_argument("--modes", nargs="+", default=["baseline", "tuned"], choices=["baseline", "tuned", "int8"])
+    parser.add_argument("--prompt-tokens", type=int, default=256)
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--no-compile", action="store_true")
+    args = parser.parse_args()
+
+    input_ids = torch.randint(100, 20000, (1, args.prompt_tokens))
+    print(f"Model: {'tiny Qwen2' if args.tiny else args.model}, "
+          f"{args.prompt_tokens} prompt + {args.new_tokens} new tokens, {args.runs} runs")
+
+    for mode in args.modes:
+        model, generate = build(args, mode)
+        generate(input_ids=input_ids, new_tokens=8)  # warmup / compile
+
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            generate(input_ids=input_ids, new_tokens=args.new_tokens)
+            timings.append(time.perf_counter() - start)
+
+        best = min(timings)
+        print(f"  {mode:9s}: {best:6.2f}s  {args.new_tokens / best:7.1f} tok/s  "
+              f"(threads={torch.get_num_threads()}, dtype={next(model.parameters()).dtype})")
+        del model
+
+
+if __name__ == "__main__":
+    main()
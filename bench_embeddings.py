@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_embeddings.py
+"""
+Benchmark: embedding throughput on CPU, one forward per input vs batched
+
+    python bench_embeddings.py --tiny
+    python bench_embeddings.py --tiny --inputs 512 --max-length 1024
+
+sequential: one forward pass per input (what a naive endpoint would do)
+arrival:    batches of EMBEDDING_BATCH_SIZE in request order, padded to the longest
+bucketed:   model_runtime.embed_tokens (length-sorted batches, token budget)
+"""
+
+import argparse
+import random
+import time
+
+import torch
+
+import cpu_tuning
+import model_runtime
+from bench_cpu_inference import load
+
+
+def arrival_batches(lengths):
+    size = model_runtime.EMBEDDING_BATCH_SIZE
+    return [list(range(i, min(i + size, len(lengths)))) for i in range(0, len(lengths), size)]
+
+
+def run(model, token_lists, mode):
+    if mode == "bucketed":
+        return model_runtime.embed_tokens(model, "cpu", token_lists, pad_token_id=0)
+    batching = model_runtime.embedding_batches
+    if mode == "sequential":
+        model_runtime.embedding_batches = lambda lengths: [[i] for i in range(len(lengths))]
+    else:
+        model_runtime.embedding_batches = arrival_batches
+    try:
+        return model_runtime.embed_tokens(model, "cpu", token_lists, pad_token_id=0)
+    finally:
+        model_runtime.embedding_batches = batching
+
+
+def padded_tokens(token_lists, batches):
+    return sum(len(batch) * max(len(token_lists[i]) for i in batch) for batch in batches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="Qwen/Qwen2.5-Coder-0.5B-Instruct")
+    parser.add_argument("--tiny", action="store_true", help="random tiny Qwen2 instead of --model")
+    parser.add_argument("--inputs", type=int, default=256)
+    parser.add_argument("--min-length", type=int, default=8)
+    parser.add_argument("--max-length", type=int, default=512)
+    parser.add_argument("--modes", nargs="+", default=["sequential", "arrival", "bucketed"],
+                        choices=["sequential", "arrival", "bucketed"])
+    args = parser.parse_args()
+
+    cpu_tuning.configure_cpu_runtime()
+    model = load(args, torch.float32, "sdpa")
+    random.seed(0)
+    token_lists = [
+        [random.randint(100, 20000) for _ in range(random.randint(args.min_length, args.max_length))]
+        for _ in range(args.inputs)
+    ]
+    real_tokens = sum(len(ids) for ids in token_lists)
+    print(f"Model: {'tiny Qwen2' if args.tiny else args.model}, {args.inputs} inputs, "
+          f"{args.min_length}-{args.max_length} tokens ({real_tokens} total)")
+
+    lengths = [len(ids) for ids in token_lists]
+    padding = {
+        "sequential": real_tokens,
+        "arrival": padded_tokens(token_lists, arrival_batches(lengths)),
+        "bucketed": padded_tokens(token_lists, model_runtime.embedding_batches(lengths)),
+    }
+
+    reference = None
+    for mode in args.modes:
+        run(model, token_lists[:8], mode)  # warmup
+        start = time.perf_counter()
+        vectors = run(model, token_lists, mode)
+        elapsed = time.perf_counter() - start
+        print(f"  {mode:10s}: {elapsed:6.2f}s  {args.inputs / elapsed:7.1f} inputs/s  "
+              f"{real_tokens / elapsed:9.0f} tokens/s  padding {padding[mode] / real_tokens - 1:6.1%}")
+
+        decoded = torch.stack([torch.frombuffer(bytearray(__import__("base64").b64decode(v)), dtype=torch.float32)
+                               for v in vectors])
+        if reference is None:
+            reference = decoded
+        else:
+            print(f"{'':14s}max abs diff vs {args.modes[0]}: {(decoded - reference).abs().max().item():.2e}")
+
+
+if __name__ == "__main__":
+    main()
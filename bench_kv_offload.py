@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_kv_offload.py
+"""
+Benchmark: multi-turn sessions with evicted prefix KV recomputed vs restored
+
+    python bench_kv_offload.py
+    python bench_kv_offload.py --sessions 32 --context 1500 --turns 3 --pool-blocks 400
+
+Tiny stand-in model on CPU. Every session has a long context (system
+prompt, file, history) and comes back for several turns, each turn's
+prompt extending the previous one by the answer and a new question.
+Sessions take turns round-robin and the device pool only holds a few of
+them, so a session's prefix blocks are evicted before its next turn.
+Compared: recompute (no offload), host RAM tier, small host RAM tier
+spilling to a disk tier. Reported: prompt tokens prefilled, time, blocks
+restored per tier and the engine's restore / recompute cost estimates;
+greedy output must match the recompute run.
+"""
+
+import argparse
+import random
+import tempfile
+import threading
+import time
+
+from generation_engine import GenerationEngine
+from kv_offload import KV_RESTORED, TieredKVStore
+from paged_kv import PagedKVPool
+from replay_traffic import load_stand_in
+
+
+def restored(tier: str) -> float:
+    return KV_RESTORED.labels(tier=tier)._value.get()
+
+
+def run(model, tokenizer, args, host_blocks: int, disk_blocks: int, disk_dir: str) -> dict:
+    pool = PagedKVPool(model, args.pool_blocks, 16)
+    offload = None
+    if host_blocks or disk_blocks:
+        offload = TieredKVStore(pool, host_blocks * pool.bytes_per_block / 2**30,
+                                disk_blocks * pool.bytes_per_block / 2**30, disk_dir)
+    engine = GenerationEngine(model, tokenizer, "cpu", pool=pool, offload=offload)
+    engine.start()
+
+    rng = random.Random(0)
+    contexts = [[rng.randint(32, 126) for _ in range(args.context)] for _ in range(args.sessions)]
+    before = {tier: restored(tier) for tier in ("host", "disk")}
+    prefilled, outputs = 0, []
+    start = time.perf_counter()
+    for _ in range(args.turns):
+        for context in contexts:
+            context += [rng.randint(32, 126) for _ in range(args.question)]
+            result = engine.generate(context, threading.Event(), max_tokens=args.answer, temperature=0.0,
+                                     top_p=1.0, stop=[], eos_token_ids=[-1])
+            prefilled += len(context) - result["prefix_tokens_reused"]
+            context += result["token_ids"]
+            outputs.append(result["token_ids"])
+    elapsed = time.perf_counter() - start
+    costs = dict(offload.restore_cost, recompute=offload.recompute_cost) if offload else {}
+    engine.stop()
+    return {
+        "seconds": elapsed,
+        "prefilled": prefilled,
+        "restored": {tier: restored(tier) - before[tier] for tier in before},
+        "costs": costs,
+        "outputs": outputs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=24)
+    parser.add_argument("--context", type=int, default=1500, help="initial context tokens per session")
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--question", type=int, default=40, help="new tokens per turn")
+    parser.add_argument("--answer", type=int, default=16, help="generated tokens per turn")
+    parser.add_argument("--pool-blocks", type=int, default=400, help="device pool (16-token blocks)")
+    parser.add_argument("--small-host-blocks", type=int, default=300, help="host tier in the host+disk setup")
+    args = parser.parse_args()
+
+    model, tokenizer = load_stand_in(None)
+    needed = args.sessions * -(-(args.context + args.turns * (args.question + args.answer)) // 16)
+    print(f"{args.sessions} sessions x {args.turns} turns, ~{needed} blocks of session KV, "
+          f"device pool {args.pool_blocks} blocks")
+    setups = {
+        "recompute": (0, 0),
+        "host RAM": (needed, 0),
+        "host + disk": (args.small_host_blocks, needed),
+    }
+    print(f"{'setup':12s} {'time':>7s} {'prefilled':>10s} {'restored host':>14s} {'disk':>6s}  "
+          f"cost per block (ms): host / disk / recompute")
+    reference = None
+    with tempfile.TemporaryDirectory() as disk_dir:
+        for name, (host_blocks, disk_blocks) in setups.items():
+            r = run(model, tokenizer, args, host_blocks, disk_blocks, disk_dir)
+            reference = reference or r["outputs"]
+            costs = " / ".join(
+                f"{r['costs'][k] * 1000:.3f}" if r["costs"].get(k) is not None else "-"
+                for k in ("host", "disk", "recompute")
+            )
+            print(f"{name:12s} {r['seconds']:6.2f}s {r['prefilled']:10d} {r['restored']['host']:14.0f} "
+                  f"{r['restored']['disk']:6.0f}  {costs}")
+            if r["outputs"] != reference:
+                print(f"  greedy output differs from recompute in "
+                      f"{sum(a != b for a, b in zip(r['outputs'], reference))}/{len(reference)} turns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_lora.py
+"""
+Benchmark: one base model serving LoRA adapters vs one server per adapter
+
+    python bench_lora.py
+    python bench_lora.py --adapters 4 --rank 16 --requests 48
+
+memory: bf16 weights of the Qwen2.5-Coder sizes with --adapters adapters
+    of --rank on all attention and MLP projections: a full server per
+    adapter vs one base model plus the adapters.
+engine: tiny stand-in model on CPU with random adapters written in PEFT
+    format. Checks greedy output of mixed-adapter batches against copies of
+    the model with the adapter merged into the weights, then runs the same
+    mixed requests through one engine per adapter (merged copies, all on
+    this CPU at once) and through one engine serving every adapter.
+"""
+
+import argparse
+import copy
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+import torch
+from safetensors.torch import save_file
+
+from generation_engine import GenerationEngine
+from lora_adapters import LORA_TARGET_MODULES, AdapterRegistry, attach_lora
+from paged_kv import PagedKVPool
+from replay_traffic import load_stand_in
+
+# (parameters, layers, hidden, intermediate, kv heads, head dim)
+QWEN_CONFIGS = {
+    "Qwen2.5-Coder-7B": (7.62e9, 28, 3584, 18944, 4, 128),
+    "Qwen2.5-Coder-14B": (14.77e9, 48, 5120, 13824, 8, 128),
+    "Qwen2.5-Coder-32B": (32.76e9, 64, 5120, 27648, 8, 128),
+}
+
+
+def adapter_params(layers, hidden, intermediate, kv_heads, head_dim, rank) -> int:
+    kv = kv_heads * head_dim
+    # r * (in + out) per projection: q, k, v, o, gate, up, down
+    per_layer = rank * (2 * hidden + 2 * (hidden + kv) + 2 * hidden + 3 * (hidden + intermediate))
+    return layers * per_layer
+
+
+def memory_report(args):
+    print(f"{args.adapters} adapters of rank {args.rank}, bf16 weights (KV cache not included):")
+    print(f"{'model':20s} {'base GiB':>9s} {'adapter MiB':>12s} {'separate GiB':>13s} {'multi-LoRA GiB':>15s}")
+    for name, (params, *shape) in QWEN_CONFIGS.items():
+        base = params * 2
+        adapter = adapter_params(*shape, args.rank) * 2
+        print(f"{name:20s} {base / 2**30:9.1f} {adapter / 2**20:12.1f} {args.adapters * base / 2**30:13.1f} "
+              f"{(base + args.adapters * adapter) / 2**30:15.1f}")
+
+
+def write_adapter(path: str, model, rank: int, seed: int):
+    """Random PEFT LoRA checkpoint for all target projections of model"""
+    generator = torch.Generator().manual_seed(seed)
+    tensors = {}
+    for name, module in model.named_modules():
+        if name.split(".")[-1] in LORA_TARGET_MODULES and isinstance(module, torch.nn.Linear):
+            out_features, in_features = module.weight.shape
+            prefix = f"base_model.model.{name}"
+            tensors[f"{prefix}.lora_A.weight"] = torch.randn(rank, in_features, generator=generator) / in_features ** 0.5
+            tensors[f"{prefix}.lora_B.weight"] = torch.randn(out_features, rank, generator=generator) * 0.05
+    os.makedirs(path, exist_ok=True)
+    save_file(tensors, os.path.join(path, "adapter_model.safetensors"))
+    with open(os.path.join(path, "adapter_config.json"), "w") as f:
+        json.dump({"peft_type": "LORA", "r": rank, "lora_alpha": 2 * rank, "target_modules": LORA_TARGET_MODULES}, f)
+
+
+def merged_copy(model, registry: AdapterRegistry, name: str):
+    """Plain model with the adapter folded into its weights (what a dedicated server would load)"""
+    adapter = registry.get(name)
+    merged = copy.deepcopy(model)
+    modules = dict(merged.named_modules())
+    with torch.no_grad():
+        for path, (a, b) in adapter.layers.items():
+            modules[path].weight += (a @ b * adapter.scaling).t()
+    return merged
+
+
+def best_of(repeat: int, run) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_engine(engine: GenerationEngine, requests, args):
+    """Submit (prompt, adapter) pairs, returns results in order"""
+    params = dict(max_tokens=args.max_new_tokens, temperature=0.0, top_p=1.0, stop=[], eos_token_ids=[-1])
+    futures = [engine.submit(prompt, threading.Event(), adapter=adapter, **params) for prompt, adapter in requests]
+    return [f.result() for f in futures]
+
+
+def engine_report(args):
+    model, tokenizer = load_stand_in(None)
+    base_bytes = sum(p.nbytes for p in model.parameters())
+    shared = copy.deepcopy(model)
+    attach_lora(shared)
+
+    with tempfile.TemporaryDirectory() as directory:
+        names = [f"team-{i}" for i in range(args.adapters)]
+        for i, name in enumerate(names):
+            write_adapter(os.path.join(directory, name), model, args.rank, seed=i)
+        registry = AdapterRegistry(shared, directory, max_resident=args.adapters)
+        merged = {name: merged_copy(model, registry, name) for name in names}
+        adapter_bytes = sum(a.nbytes for a in registry.resident.values())
+
+        rng = random.Random(0)
+        requests = [
+            ([rng.randint(32, 126) for _ in range(rng.randint(16, 200))], rng.choice(names))
+            for _ in range(args.requests)
+        ]
+
+        def pool(m):
+            return PagedKVPool(m, args.pool_blocks, 16)
+
+        # Mixed batches vs merged weights
+        engine = GenerationEngine(shared, tokenizer, "cpu", pool=pool(shared), max_sequences=args.requests)
+        engine.start()
+        check = requests[:8]
+        results = run_engine(engine, [(p, registry.get(n)) for p, n in check], args)
+        engine.stop()
+        matches = 0
+        for (prompt, name), result in zip(check, results):
+            with torch.inference_mode():
+                output = merged[name].generate(
+                    input_ids=torch.tensor([prompt]), attention_mask=torch.ones(1, len(prompt), dtype=torch.long),
+                    max_new_tokens=args.max_new_tokens, do_sample=False, eos_token_id=-1,
+                    pad_token_id=tokenizer.pad_token_id
+                )
+            matches += tokenizer.decode(output[0, len(prompt):], skip_special_tokens=True) == result["text"]
+        print(f"Greedy output of mixed-adapter batches identical to merged weights: {matches}/{len(check)}")
+
+        # One engine per adapter, running side by side
+        engines = {name: GenerationEngine(merged[name], tokenizer, "cpu", pool=pool(merged[name]),
+                                          max_sequences=args.requests) for name in names}
+        for e in engines.values():
+            e.start()
+
+        def separate_run():
+            threads = [
+                threading.Thread(target=run_engine, args=(engines[name], [(p, None) for p, n in requests if n == name], args))
+                for name in names
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        timings = {"separate engines": best_of(args.repeat, separate_run)}
+        for e in engines.values():
+            e.stop()
+
+        engine = GenerationEngine(shared, tokenizer, "cpu", pool=pool(shared), max_sequences=args.requests)
+        engine.start()
+        base_only = [(p, None) for p, _ in requests]
+        mixed = [(p, registry.get(n)) for p, n in requests]
+        timings["base model only"] = best_of(args.repeat, lambda: run_engine(engine, base_only, args))
+        timings["multi-LoRA"] = best_of(args.repeat, lambda: run_engine(engine, mixed, args))
+        engine.stop()
+
+    tokens = args.requests * args.max_new_tokens
+    kv_bytes = pool(model).bytes_per_block * args.pool_blocks
+    print(f"{args.requests} requests x {args.max_new_tokens} tokens over {args.adapters} adapters (rank {args.rank}):")
+    weights = {
+        "separate engines": (args.adapters * base_bytes, args.adapters),
+        "base model only": (base_bytes, 1),
+        "multi-LoRA": (base_bytes + adapter_bytes, 1),
+    }
+    for label, seconds in timings.items():
+        size, pools = weights[label]
+        print(f"  {label:18s} {seconds:6.2f}s {tokens / seconds:8.1f} tokens/s  "
+              f"weights {size / 2**20:6.2f} MiB + {pools} KV pool{'s' if pools > 1 else ''}")
+    print(f"  (one KV pool: {kv_bytes / 2**20:.2f} MiB, adapters {adapter_bytes / 2**20:.2f} MiB in total)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--adapters", type=int, default=4)
+    parser.add_argument("--rank", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per setup, best is reported")
+    parser.add_argument("--pool-blocks", type=int, default=1024, help="KV blocks per engine (tiny model)")
+    args = parser.parse_args()
+
+    memory_report(args)
+    engine_report(args)
+
+
+if __name__ == "__main__":
+    main()
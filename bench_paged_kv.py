@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_paged_kv.py
+"""
+Benchmark: concurrent sequences per GiB of KV memory, contiguous vs paged
+
+    python bench_paged_kv.py
+    python bench_paged_kv.py --pool-mb 8 --requests 64 --block-size 16
+
+capacity: sequences per GiB for the Qwen2.5-Coder sizes on a synthetic
+    request mix. "reserved" is the current path: a request's contiguous KV
+    grows up to prompt + max_tokens and has to be provisioned for that.
+    "paged" holds prompt + actual output, rounded up to whole blocks.
+engine: tiny stand-in model on CPU. Checks that greedy engine output
+    matches model.generate, then runs the same requests through one-at-a-time
+    generate and through the engine with a small block pool, and reports
+    the peak number of sequences the pool held at once.
+"""
+
+import argparse
+import random
+import threading
+import time
+
+import torch
+
+from generation_engine import GenerationEngine
+from paged_kv import PagedKVPool, kv_bytes_per_token
+from replay_traffic import load_stand_in
+
+# (layers, kv heads, head dim) of the served checkpoints, bf16 KV
+QWEN_CONFIGS = {
+    "Qwen2.5-Coder-0.5B": (24, 2, 64),
+    "Qwen2.5-Coder-7B": (28, 4, 128),
+    "Qwen2.5-Coder-14B": (48, 8, 128),
+    "Qwen2.5-Coder-32B": (64, 8, 128),
+}
+
+
+def request_mix(count: int, max_tokens: int, seed: int = 0):
+    """(prompt tokens, actual output tokens) with a long-tailed prompt length"""
+    rng = random.Random(seed)
+    return [
+        (min(int(rng.lognormvariate(6.5, 0.9)), 16000), min(int(rng.expovariate(1 / 250)) + 1, max_tokens))
+        for _ in range(count)
+    ]
+
+
+def capacity_report(args):
+    mix = request_mix(2000, args.max_tokens)
+    reserved = sum(p + args.max_tokens for p, _ in mix) / len(mix)
+    actual = sum(p + o for p, o in mix) / len(mix)
+    paged = sum(-(-(p + o) // args.block_size) * args.block_size for p, o in mix) / len(mix)
+    print(f"Request mix: mean prompt {sum(p for p, _ in mix) / len(mix):.0f}, "
+          f"mean output {sum(o for _, o in mix) / len(mix):.0f}, max_tokens {args.max_tokens}")
+    print(f"{'model':22s} {'KB/token':>9s} {'reserved':>10s} {'paged':>10s}  sequences per GiB")
+    for name, (layers, kv_heads, head_dim) in QWEN_CONFIGS.items():
+        per_token = 2 * layers * kv_heads * head_dim * 2
+        print(f"{name:22s} {per_token / 1024:9.0f} {2**30 / (reserved * per_token):10.1f} "
+              f"{2**30 / (paged * per_token):10.1f}  ({reserved / paged:.1f}x, "
+              f"block rounding {paged / actual - 1:.1%})")
+
+
+def check_outputs(model, tokenizer, args):
+    rng = random.Random(1)
+    prompts = [[rng.randint(0, 255) for _ in range(rng.randint(8, 200))] for _ in range(8)]
+    engine = GenerationEngine(model, tokenizer, "cpu", pool=PagedKVPool(model, 256, args.block_size))
+    engine.start()
+    futures = [engine.submit(p, threading.Event(), 32, 0.0, 1.0, []) for p in prompts]
+    matches = 0
+    for prompt, future in zip(prompts, futures):
+        with torch.inference_mode():
+            output = model.generate(
+                input_ids=torch.tensor([prompt]), attention_mask=torch.ones(1, len(prompt), dtype=torch.long),
+                max_new_tokens=32, do_sample=False, pad_token_id=tokenizer.pad_token_id
+            )
+        matches += tokenizer.decode(output[0, len(prompt):], skip_special_tokens=True) == future.result()["text"]
+    engine.stop()
+    print(f"Greedy output identical to model.generate: {matches}/{len(prompts)}")
+
+
+def engine_report(model, tokenizer, args):
+    rng = random.Random(2)
+    # Sampled bytes with "\n" as stop string: output lengths vary like real completions
+    requests = [[rng.randint(32, 126) for _ in range(rng.randint(32, 400))] for _ in range(args.requests)]
+    params = dict(max_tokens=args.max_new_tokens, temperature=1.0, top_p=1.0, stop=["\n"])
+    per_token = kv_bytes_per_token(model.config, torch.float32)
+
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    tokens = 0
+    for prompt in requests:
+        with torch.inference_mode():
+            output = model.generate(
+                input_ids=torch.tensor([prompt]), attention_mask=torch.ones(1, len(prompt), dtype=torch.long),
+                max_new_tokens=args.max_new_tokens, do_sample=True, temperature=1.0, top_p=1.0,
+                stop_strings=["\n"], tokenizer=tokenizer, pad_token_id=tokenizer.pad_token_id
+            )
+        tokens += output.shape[-1] - len(prompt)
+    sequential = time.perf_counter() - start
+    print(f"  one at a time (current path): {sequential:6.2f}s  {tokens / sequential:7.1f} tokens/s")
+
+    pool = PagedKVPool(model, int(args.pool_mb * 2**20 // (per_token * args.block_size)), args.block_size)
+    engine = GenerationEngine(model, tokenizer, "cpu", pool=pool, max_sequences=args.requests)
+    peak = {"running": 0, "blocks": 0}
+    done = threading.Event()
+
+    def watch():
+        while not done.is_set():
+            peak["running"] = max(peak["running"], len(engine.running))
+            peak["blocks"] = max(peak["blocks"], pool.allocator.num_blocks - pool.num_free)
+            time.sleep(0.002)
+
+    torch.manual_seed(0)
+    engine.start()
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    start = time.perf_counter()
+    results = [f.result() for f in [engine.submit(p, threading.Event(), **params) for p in requests]]
+    batched = time.perf_counter() - start
+    done.set()
+    watcher.join()
+    engine.stop()
+
+    tokens = sum(r["generated_tokens"] for r in results)
+    reserved = sum(len(p) + args.max_new_tokens for p in requests) / len(requests) * per_token
+    print(f"  paged engine:                 {batched:6.2f}s  {tokens / batched:7.1f} tokens/s")
+    print(f"  pool {args.pool_mb:.0f} MiB = {pool.allocator.num_blocks} blocks: peak {peak['running']} sequences "
+          f"at once ({peak['blocks']} blocks used); contiguous prompt+max_tokens reservations "
+          f"would fit {args.pool_mb * 2**20 / reserved:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--max-tokens", type=int, default=2048, help="client max_tokens in the capacity mix")
+    parser.add_argument("--requests", type=int, default=48)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--pool-mb", type=float, default=4.0, help="engine KV pool for the tiny model")
+    args = parser.parse_args()
+
+    capacity_report(args)
+    model, tokenizer = load_stand_in(None)
+    print("Tiny stand-in model on CPU:")
+    check_outputs(model, tokenizer, args)
+    engine_report(model, tokenizer, args)
+
+
+if __name__ == "__main__":
+    main()
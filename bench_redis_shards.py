@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_redis_shards.py
+"""
+Benchmark: response cache sharded over several Redis nodes
+
+    python bench_redis_shards.py
+    python bench_redis_shards.py --nodes 4 --entries 20000 --rtt-ms 0.5
+
+placement: how evenly cache keys spread over --nodes nodes and how many
+    move when a node is added or removed, consistent hashing vs key-hash
+    modulo node count.
+api: --nodes fakeredis servers on local TCP ports, each behind a proxy
+    adding --rtt-ms of round trip (nodes on other hosts), used through the
+    API's cache methods (store_in_cache, warm_cache, export/import).
+    Checks that warming picks the globally hottest keys from the per-node
+    rankings and that an export imports back completely; times multi-key
+    reads with one pipeline per node run concurrently vs node after node.
+"""
+
+import argparse
+import asyncio
+import random
+import socket
+import statistics
+import threading
+import time
+
+import fakeredis
+
+import api_server
+from cache_backend import CacheShards
+from cache_keys import fast_digest
+from hash_ring import HashRing, ring_hash
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def delay_proxy(port: int, rtt: float):
+    """TCP proxy to a local port adding rtt seconds per round trip"""
+    async def forward(reader, writer):
+        while data := await reader.read(65536):
+            await asyncio.sleep(rtt / 2)
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    async def handle(reader, writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", port)
+        replies = asyncio.create_task(forward(upstream_reader, writer))
+        await forward(reader, upstream_writer)
+        replies.cancel()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def cache_key(i: int) -> str:
+    return f"qwen:gen:{fast_digest(str(i).encode())}"
+
+
+def placement_report(args):
+    keys = [cache_key(i) for i in range(args.entries)]
+    nodes = [f"redis://cache-{i}:6379/0" for i in range(args.nodes)]
+    ring = HashRing(nodes)
+    counts = [0] * args.nodes
+    for key in keys:
+        counts[nodes.index(ring.owner(key))] += 1
+    print(f"placement: {args.entries} keys over {args.nodes} nodes: max/mean {max(counts) / statistics.mean(counts):.3f} "
+          f"(min {min(counts)}, max {max(counts)})")
+
+    for label, changed in (("node added", nodes + [f"redis://cache-{args.nodes}:6379/0"]), ("node removed", nodes[:-1])):
+        other = HashRing(changed)
+        moved_ring = sum(ring.owner(k) != other.owner(k) for k in keys) / len(keys)
+        moved_mod = sum(ring_hash(k) % len(nodes) != ring_hash(k) % len(changed) for k in keys) / len(keys)
+        ideal = 1 / max(len(nodes), len(changed))
+        print(f"  {label:12s} keys moved: ring {moved_ring:6.1%}  modulo {moved_mod:6.1%}  (ideal {ideal:.1%})")
+
+
+async def api_report(args):
+    servers, proxies, urls = [], [], []
+    for _ in range(args.nodes):
+        port = free_port()
+        server = fakeredis.TcpFakeServer(("127.0.0.1", port), server_type="redis")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        proxy, proxy_port = await delay_proxy(port, args.rtt_ms / 1000)
+        servers.append(server)
+        proxies.append(proxy)
+        urls.append(f"redis://127.0.0.1:{proxy_port}/0")
+
+    qwen_api = api_server.qwen_api
+    cache = CacheShards.from_urls(urls)
+    qwen_api.cache_shards = cache
+    qwen_api.memory_cache.clear()
+    print(f"api: {args.nodes} nodes, {args.rtt_ms}ms round trip each")
+
+    rng = random.Random(0)
+    keys = [cache_key(i) for i in range(args.entries)]
+    for i in range(0, len(keys), 32):
+        await asyncio.gather(*(qwen_api.store_in_cache(key, f"response {key}") for key in keys[i:i + 32]))
+    # Skewed hits, each key gets a distinct count so the expected top is unambiguous
+    hot = rng.sample(keys, args.warm * 2)
+    for rank, key in enumerate(hot):
+        await (await qwen_api.redis_for(key)).zincrby(api_server.CACHE_HITS_KEY, len(hot) - rank, key)
+    # Less the node's hit ranking
+    sizes = [await client.dbsize() - 1 for client in cache.clients.values()]
+    print(f"{sum(sizes)} entries stored, per node: {sizes}")
+
+    qwen_api.memory_cache.clear()
+    limit = min(args.warm, qwen_api.memory_cache.maxsize)
+    loaded = await qwen_api.warm_cache(limit)
+    expected = set(hot[:limit])
+    print(f"warm_cache loaded {loaded}, hottest {limit} over all nodes present: "
+          f"{len(expected & set(qwen_api.memory_cache))}/{limit}")
+
+    exported = await qwen_api.export_cache()
+    for client in cache.clients.values():
+        await client.flushdb()
+    imported = await qwen_api.import_cache(exported, warm=False)
+    ranked = await qwen_api.ranked_keys()
+    print(f"export/import: {imported} entries restored, {len(ranked)} ranked")
+
+    sample = rng.sample(keys, args.warm)
+
+    async def sequential():
+        for node_keys in cache.group(sample).values():
+            await cache.client_for(node_keys[0]).mget(node_keys)
+
+    for label, run in (("node after node", sequential), ("per-node concurrent", lambda: cache.mget(sample))):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            await run()
+            timings.append(time.perf_counter() - start)
+        print(f"  mget of {len(sample)} keys, {label:20s} {min(timings) * 1000:7.2f}ms")
+
+    for client in cache.clients.values():
+        await client.aclose()
+    for proxy in proxies:
+        proxy.close()
+        await proxy.wait_closed()
+    for server in servers:
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--entries", type=int, default=20000)
+    parser.add_argument("--warm", type=int, default=500, help="hot keys (warm_cache limit, mget sample size)")
+    parser.add_argument("--rtt-ms", type=float, default=0.5, help="added round trip to every node")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs, best is reported")
+    args = parser.parse_args()
+
+    placement_report(args)
+    asyncio.run(api_report(args))
+
+
+if __name__ == "__main__":
+    main()
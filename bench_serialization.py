@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_serialization.py
+"""
+Benchmark: per-response serialization cost, FastAPI default vs FastJSONResponse
+
+    python bench_serialization.py [--sizes 2000 16000] [--iterations 2000]
+"""
+
+import argparse
+import random
+import string
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from api_server import GenerateResponse
+from serialization import FastJSONResponse, RawJSON, decode_cache_record, dumps, encode_cache_record, orjson
+
+
+def timed(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def before(text: str) -> bytes:
+    """response_model validation + jsonable_encoder + stdlib json"""
+    model = GenerateResponse(response=text, generation_time=1.23, user_id="api_user")
+    return JSONResponse(jsonable_encoder(model)).body
+
+
+def after_miss(text: str) -> bytes:
+    return FastJSONResponse({
+        "response": RawJSON(dumps(text).decode()),
+        "cached": False,
+        "generation_time": 1.23,
+        "user_id": "api_user"
+    }).body
+
+
+def after_hit(record: str) -> bytes:
+    result = decode_cache_record(record)
+    return FastJSONResponse({
+        "response": result["text_json"],
+        "cached": True,
+        "generation_time": 1.23,
+        "user_id": "api_user"
+    }).body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 16000])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"JSON backend: {'orjson' if orjson is not None else 'stdlib json'}")
+    for size in args.sizes:
+        # Code-like text: quotes, newlines and backslashes need escaping
+        text = "".join(rng.choice(string.ascii_letters + ' \n\t"\\{}()') for _ in range(size))
+        record = encode_cache_record(text, finish_reason="stop", completion_tokens=size // 4)
+        assert before(text) == JSONResponse({"response": text, "cached": False,
+                                             "generation_time": 1.23, "user_id": "api_user"}).body
+
+        print(f"{size} char completion:")
+        print(f"  before (pydantic + jsonable_encoder + json) : {timed(lambda: before(text), args.iterations):7.1f} µs")
+        print(f"  FastJSONResponse, cache miss                : {timed(lambda: after_miss(text), args.iterations):7.1f} µs")
+        print(f"  FastJSONResponse, pre-serialized cache hit  : {timed(lambda: after_hit(record), args.iterations):7.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
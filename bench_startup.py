@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_startup.py
+"""
+Benchmark: import cost of the HTTP/auth layer vs the inference runtime
+
+    python bench_startup.py
+    python bench_startup.py --runs 5 --top 10
+
+Every target is imported in a fresh interpreter with -X importtime.
+"api_server + model_runtime" is what importing api_server used to cost
+before torch/transformers were moved behind model_runtime.
+"""
+
+import argparse
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+TARGETS = {
+    "auth": "import auth",
+    "api_server": "import api_server",
+    "api_server + model_runtime": "import api_server, model_runtime",
+}
+
+HEAVY = ("torch", "transformers", "redis")
+
+
+def import_profile(code: str) -> Tuple[float, List[Tuple[int, str]], Dict[str, bool]]:
+    """Total import seconds, direct imports of the target by cumulative us, heavy modules loaded"""
+    check = "import sys; print(','.join(m for m in %r if m in sys.modules))" % (HEAVY,)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"{code}; {check}"],
+        capture_output=True, text=True, check=True
+    )
+    total, children = 0, {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            total += int(cumulative)
+        elif depth == 1:
+            children[name.strip()] = children.get(name.strip(), 0) + int(cumulative)
+    loaded = set(filter(None, proc.stdout.strip().split(",")))
+    top = sorted(((us, name) for name, us in children.items()), reverse=True)
+    return total / 1e6, top, {m: m in loaded for m in HEAVY}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5, help="show the N most expensive top-level imports")
+    args = parser.parse_args()
+
+    for label, code in TARGETS.items():
+        runs = [import_profile(code) for _ in range(args.runs)]
+        best = min(runs, key=lambda r: r[0])
+        total, top, loaded = best
+        heavy = " ".join(f"{m}={'yes' if v else 'no'}" for m, v in loaded.items())
+        print(f"{label:28s} {total:6.2f}s  ({heavy})")
+        for us, name in top[:args.top]:
+            print(f"    {us / 1e6:6.2f}s  {name}")
+
+
+if __name__ == "__main__":
+    main()
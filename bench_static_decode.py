@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# ~/qwen-api/bench_static_decode.py
+"""
+Benchmark: dynamic-shape compile vs bucketed static KV cache, mixed prompt lengths
+
+    python bench_static_decode.py --tiny
+    python bench_static_decode.py --tiny --lengths 37 90 200 300 450
+"""
+
+import argparse
+import random
+import time
+
+import torch
+
+import cpu_tuning
+from bench_cpu_inference import load
+from static_decode import BucketedStaticDecoder, compiled_graph_count
+
+
+def build(args, mode):
+    model = load(args, torch.float32, "sdpa")
+    if mode == "dynamic":
+        # Current default path: forward compiled with dynamic shapes, DynamicCache
+        model = cpu_tuning.optimize_cpu_model(model, mode="float32", compile_model=True)
+        return lambda **kw: model.generate(**kw)
+    decoder = BucketedStaticDecoder(model, pad_token_id=0, compile_mode="default", buckets=args.buckets)
+    return lambda input_ids, attention_mask, **kw: decoder.generate(
+        {"input_ids": input_ids, "attention_mask": attention_mask}, **kw
+    )
+
+
+def run(generate, input_ids, new_tokens):
+    with torch.inference_mode():
+        return generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="Qwen/Qwen2.5-Coder-0.5B-Instruct")
+    parser.add_argument("--tiny", action="store_true", help="random tiny Qwen2 instead of --model")
+    parser.add_argument("--modes", nargs="+", default=["dynamic", "static"], choices=["dynamic", "static"])
+    parser.add_argument("--lengths", nargs="+", type=int, default=[37, 90, 150, 200, 300, 450])
+    parser.add_argument("--buckets", nargs="+", type=int, default=[256, 512, 1024])
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=24)
+    args = parser.parse_args()
+
+    cpu_tuning.configure_cpu_runtime()
+    random.seed(0)
+    lengths = [random.choice(args.lengths) for _ in range(args.requests)]
+    print(f"Model: {'tiny Qwen2' if args.tiny else args.model}, prompt lengths {sorted(set(lengths))}, "
+          f"{args.new_tokens} new tokens, {args.requests} requests")
+
+    for mode in args.modes:
+        generate = build(args, mode)
+        graphs_before = compiled_graph_count()
+
+        start = time.perf_counter()
+        for length in sorted(set(lengths)):  # warmup: every shape once
+            run(generate, torch.randint(100, 20000, (1, length)), args.new_tokens)
+        warmup = time.perf_counter() - start
+        graphs_warm = compiled_graph_count()
+
+        start = time.perf_counter()
+        for length in lengths:
+            run(generate, torch.randint(100, 20000, (1, length)), args.new_tokens)
+        steady = time.perf_counter() - start
+
+        ms_per_token = steady * 1000 / (args.requests * args.new_tokens)
+        print(f"  {mode:8s}: warmup {warmup:6.1f}s ({graphs_warm - graphs_before} graphs), "
+              f"steady {ms_per_token:6.2f} ms/token, recompiles in steady state: "
+              f"{compiled_graph_count() - graphs_warm}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# ~/qwen-api/cache_backend.py
+"""
+Response and embedding cache spread over one or more Redis nodes.
+
+CACHE_REDIS_NODES lists the nodes
+("redis://cache-1:6379/0,redis://cache-2:6379/0"); keys are placed on a
+consistent-hash ring (hash_ring.py), so cache capacity grows with the nodes
+and no single node takes all the traffic. Adding or removing one of N
+nodes moves about 1/N of the keys: those miss once and are recomputed,
+their old copies expire with their TTL. With CACHE_REDIS_NODES empty the
+cache is the single `redis` host (db 0), as before.
+
+Every key lives on one node, the hit ranking used for warming included:
+CACHE_HITS_KEY on a node ranks that node's keys. Multi-key operations
+group their keys by node and run one pipeline per node, all nodes at once.
+
+API keys, usage and rate-limit buckets are not sharded, they stay on the
+auth pool (auth.py).
+"""
+import asyncio
+import os
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from hash_ring import HashRing
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+CACHE_REDIS_NODES = [url.strip() for url in os.getenv("CACHE_REDIS_NODES", "").split(",") if url.strip()]
+CACHE_RING_VNODES = int(os.getenv("CACHE_RING_VNODES", "160"))
+
+
+class CacheShards:
+    """Redis clients by node name, keys routed to their owner on the ring"""
+
+    def __init__(self, clients: Dict[str, "Redis"], vnodes: int = CACHE_RING_VNODES):
+        self.clients = clients
+        self.ring = HashRing(list(clients), vnodes)
+
+    @classmethod
+    def from_urls(cls, urls: List[str], password: str = "") -> "CacheShards":
+        import redis.asyncio as redis
+
+        return cls({
+            url: redis.Redis.from_url(url, password=password or None, decode_responses=True) for url in urls
+        })
+
+    def client_for(self, key: str) -> "Redis":
+        return self.clients[self.ring.owner(key)]
+
+    def group(self, keys: Sequence[str]) -> Dict[str, List[str]]:
+        """Keys by owning node, in their original order"""
+        groups: Dict[str, List[str]] = {}
+        for key in keys:
+            groups.setdefault(self.ring.owner(key), []).append(key)
+        return groups
+
+    async def by_node(self, keys: Sequence[str], run: Callable[["Redis", List[str]], Awaitable]) -> List[Tuple[List[str], object]]:
+        """run(client, node_keys) for every node owning some of keys, concurrently"""
+        groups = self.group(keys)
+        results = await asyncio.gather(*(run(self.clients[node], node_keys) for node, node_keys in groups.items()))
+        return list(zip(groups.values(), results))
+
+    async def each(self, run: Callable[["Redis"], Awaitable]) -> List:
+        """run(client) on every node, concurrently"""
+        return await asyncio.gather(*(run(client) for client in self.clients.values()))
+
+    async def mget(self, keys: Sequence[str]) -> List[Optional[str]]:
+        values: Dict[str, Optional[str]] = {}
+        for node_keys, node_values in await self.by_node(keys, lambda client, node_keys: client.mget(node_keys)):
+            values.update(zip(node_keys, node_values))
+        return [values[key] for key in keys]
+
+    async def ping(self) -> bool:
+        return all(await self.each(lambda client: client.ping()))
@@ -0,0 +1,118 @@
+# ~/qwen-api/cache_keys.py
+"""
+Canonical response cache keys shared by all API servers.
+
+Keys are namespaced by model id, revision and chat-template version so
+servers for different models can share one Redis database, and are built
+from the token-ID sequence plus normalized sampling parameters.
+"""
+import hashlib
+import os
+import random
+import sys
+from array import array
+from typing import Dict, Iterable, Optional
+
+try:
+    import xxhash
+except ImportError:  # pragma: no cover - optional speedup
+    xxhash = None
+
+CACHE_KEY_PREFIX = "qwen:resp:v2"  # v2: values are serialization.py cache records
+EMBEDDING_KEY_PREFIX = "qwen:emb:v1"  # values: base64 little-endian float32 vectors
+
+# Number of cached variants for sampled (temperature > 0) requests.
+# 0 disables caching of sampled requests entirely.
+CACHE_SAMPLED_VARIANTS = int(os.getenv("CACHE_SAMPLED_VARIANTS", "1"))
+
+# Significant digits kept for float sampling parameters
+FLOAT_PRECISION = 6
+
+
+def fast_digest(data: bytes) -> str:
+    """128-bit non-cryptographic digest (xxh3 if available, else blake2b)"""
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def template_version(chat_template: Optional[str]) -> str:
+    """Short fingerprint of the tokenizer chat template"""
+    return fast_digest((chat_template or "").encode())[:8]
+
+
+def normalize_param(value):
+    """Canonical string form for a sampling parameter"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        value = float(f"{value:.{FLOAT_PRECISION}g}")
+        return repr(int(value)) if value.is_integer() else repr(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(normalize_param(v) for v in value) + "]"
+    return str(value)
+
+
+def canonical_params(params: Dict) -> bytes:
+    """Sorted key=value encoding of sampling parameters"""
+    return "&".join(f"{k}={normalize_param(params[k])}" for k in sorted(params)).encode()
+
+
+def token_bytes(token_ids: Iterable[int]) -> bytes:
+    """Packed little-endian uint32 encoding of a token-ID sequence.
+
+    The byte order is fixed so every server computes the same keys for a
+    shared Redis, whatever its platform.
+    """
+    if hasattr(token_ids, "numpy"):
+        # torch tensors: avoid a round trip through Python ints
+        return token_ids.cpu().numpy().astype("<u4").tobytes()
+    values = array("I", token_ids)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def is_sampled(params: Dict) -> bool:
+    return (params.get("temperature") or 0) > 0
+
+
+def build_cache_key(
+    model_id: str,
+    revision: str,
+    chat_template_version: str,
+    token_ids: Iterable[int],
+    variant: Optional[int] = None,
+    **params
+) -> Optional[str]:
+    """Build the Redis key for a request, or None if it must not be cached.
+
+    Sampled requests are cached as CACHE_SAMPLED_VARIANTS independent
+    variants; callers pick one with pick_variant(). Seeded requests are
+    deterministic and get exactly one entry; unseeded requests for several
+    samples (best_of > 1) are never cached, repeating them asks for new ones.
+    """
+    unseeded = is_sampled(params) and params.get("seed") is None
+    if unseeded:
+        if CACHE_SAMPLED_VARIANTS <= 0 or (params.get("best_of") or 1) > 1:
+            return None
+        if variant is None:
+            variant = pick_variant()
+
+    digest = fast_digest(canonical_params(params) + b"\x00" + token_bytes(token_ids))
+    key = f"{CACHE_KEY_PREFIX}:{model_id}@{revision}:{chat_template_version}:{digest}"
+    if variant is not None and unseeded:
+        key += f":s{variant}"
+    return key
+
+
+def build_embedding_key(model_id: str, revision: str, pooling: str, token_ids: Iterable[int]) -> str:
+    """Redis key for the embedding of one tokenized input"""
+    digest = fast_digest(token_bytes(token_ids))
+    return f"{EMBEDDING_KEY_PREFIX}:{model_id}@{revision}:{pooling}:{digest}"
+
+
+def pick_variant() -> int:
+    return random.randrange(max(CACHE_SAMPLED_VARIANTS, 1))
@@ -0,0 +1,86 @@
+# ~/qwen-api/completion_cache.py
+"""
+Greedy completions cached independently of max_tokens.
+
+Greedy (temperature 0) decoding is deterministic: the completion for
+max_tokens=M is the first M tokens of the completion for any larger limit,
+and a completion that ended on its own (EOS or stop string) is the answer
+for every larger limit. Greedy cache records therefore keep the generated
+token IDs and their key leaves out max_tokens. A shorter request is cut
+from the cached tokens, a longer one resumes decoding after them, so only
+the remainder is generated. With stop strings the last few cached tokens
+are decoded again, so the stop check also sees text spanning the seam.
+
+Torch-free, the HTTP workers use it with just the tokenizer.
+"""
+from typing import Dict, List
+
+from prometheus_client import Counter
+
+from serialization import RawJSON, dumps
+
+CACHE_SUBSUMED = Counter('qwen_cache_subsumed_total', 'Greedy requests served from a cached completion of another max_tokens', ['mode'])
+CACHE_RESUMED_TOKENS = Counter('qwen_cache_resumed_tokens_total', 'Completion tokens taken from the cache instead of decoded')
+
+
+def truncate_at_stop(text: str, stop: List[str]) -> str:
+    """Cut text at the earliest stop string (the stop string is not returned)"""
+    positions = [text.find(s) for s in stop if s and s in text]
+    return text[:min(positions)] if positions else text
+
+
+def covers(record: Dict, max_tokens: int) -> bool:
+    """True if a cached greedy completion answers max_tokens without decoding more"""
+    return record["finish_reason"] == "stop" or len(record["token_ids"]) >= max_tokens
+
+
+def resume_point(token_ids: List[int], stop: List[str]) -> List[int]:
+    """Cached tokens a longer request resumes after.
+
+    The cached text holds no stop string (it would have ended there), but one
+    may start in it and end in the new tokens. The decode only checks what it
+    generates, so it redoes an overlap as long as StopSequenceCriteria's window.
+    """
+    stop = [s for s in stop if s]
+    if not stop:
+        return token_ids
+    overlap = max(len(s) for s in stop) + 8
+    return token_ids[:max(0, len(token_ids) - overlap)]
+
+
+def fit_cached(tokenizer, record: Dict, max_tokens: int, stop: List[str]) -> Dict:
+    """Cut a covering cached record (decode_cache_record output) down to max_tokens"""
+    token_ids = record.pop("token_ids")
+    if len(token_ids) <= max_tokens:
+        return record
+    text = tokenizer.decode(token_ids[:max_tokens], skip_special_tokens=True)
+    cut = truncate_at_stop(text, stop)
+    record.update(
+        text_json=RawJSON(dumps(cut).decode()),
+        finish_reason="stop" if cut != text else "length",
+        completion_tokens=max_tokens
+    )
+    CACHE_SUBSUMED.labels(mode="truncated").inc()
+    return record
+
+
+def join_resumed(tokenizer, cached_ids: List[int], result: Dict, stop: List[str]) -> Dict:
+    """Generation result for the whole completion, from the cached tokens plus the resumed decode.
+
+    The text is decoded over both parts (a character may span the seam), and
+    a stop string that straddles it is applied here; the decode itself only
+    watches the new tokens.
+    """
+    token_ids = cached_ids + result["token_ids"]
+    text = tokenizer.decode(token_ids, skip_special_tokens=True)
+    cut = truncate_at_stop(text, stop)
+    CACHE_SUBSUMED.labels(mode="resumed").inc()
+    CACHE_RESUMED_TOKENS.inc(len(cached_ids))
+    return dict(
+        result,
+        text=cut,
+        token_ids=token_ids,
+        generated_tokens=len(token_ids),
+        stopped="stop_sequence" if cut != text else result["stopped"],
+        finish_reason="stop" if cut != text else result["finish_reason"]
+    )
@@ -0,0 +1,48 @@
+# ~/qwen-api/conftest.py
+"""
+pytest fixtures: the tiny stand-in model (replay_traffic.py) and the API
+server wired to it and to an empty fakeredis.
+
+Tests drive coroutines with asyncio.run(), one event loop per test, and
+call the app through httpx.ASGITransport (no lifespan, the model is set).
+"""
+import fakeredis
+import httpx
+import pytest
+
+
+@pytest.fixture(scope="session")
+def stand_in():
+    from replay_traffic import load_stand_in
+
+    return load_stand_in(None)
+
+
+@pytest.fixture
+def api(stand_in):
+    """api_server on the stand-in model, fakeredis and the default rate limits"""
+    import api_server
+    from cache_keys import template_version
+    from rate_limit import RATE_LIMITS, parse_tier_limits
+
+    qwen_api = api_server.qwen_api
+    qwen_api.model, qwen_api.tokenizer = stand_in
+    qwen_api.device = "cpu"
+    qwen_api.chat_template_version = template_version(qwen_api.tokenizer.chat_template)
+    server = fakeredis.FakeServer()
+    qwen_api.redis_client = fakeredis.aioredis.FakeRedis(server=server, db=0, decode_responses=True)
+    qwen_api.cache_shards = None
+    qwen_api.memory_cache.clear()
+    api_server.api_key_manager.redis_client = fakeredis.aioredis.FakeRedis(server=server, db=1, decode_responses=True)
+    api_server.rate_limiter.limits = parse_tier_limits(RATE_LIMITS)
+    api_server.usage_pipeline.buffer.clear()
+    yield api_server
+    qwen_api.model = qwen_api.tokenizer = None
+    qwen_api.redis_client = None
+    api_server.api_key_manager.redis_client = None
+    qwen_api.memory_cache.clear()
+    api_server.usage_pipeline.buffer.clear()
+
+
+def api_client(app) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://localhost", timeout=None)
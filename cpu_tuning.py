@@ -0,0 +1,114 @@
+# ~/qwen-api/cpu_tuning.py
+"""
+Execution settings for GPU-less nodes.
+
+Thread count and NUMA pinning are applied once per process before the model
+is loaded; dtype and compile choices depend on what the host CPU supports.
+"""
+import logging
+import os
+from typing import List, Optional, Set
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+CPU_THREADS = int(os.getenv("CPU_THREADS", "0"))  # 0 = all cores of the pinned set
+CPU_AFFINITY = os.getenv("CPU_AFFINITY", "")  # e.g. "0-15,32-47"
+NUMA_NODE = os.getenv("NUMA_NODE", "")  # pin to the cores of one NUMA node
+CPU_DTYPE = os.getenv("CPU_DTYPE", "auto")  # auto | bfloat16 | float32 | int8
+CPU_COMPILE = os.getenv("CPU_COMPILE", "1") == "1"
+
+NUMA_SYSFS = "/sys/devices/system/node"
+
+
+def parse_cpu_list(cpu_list: str) -> Set[int]:
+    """Parse the kernel cpulist format ("0-3,8,10-11")"""
+    cpus = set()
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def numa_node_cpus(node: int) -> Set[int]:
+    with open(os.path.join(NUMA_SYSFS, f"node{node}", "cpulist")) as f:
+        return parse_cpu_list(f.read())
+
+
+def cpu_flags() -> List[str]:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return line.split(":", 1)[1].split()
+    except OSError:
+        pass
+    return []
+
+
+def supports_bf16() -> bool:
+    """Native bf16 matmul kernels (AVX512-BF16 or AMX)"""
+    flags = cpu_flags()
+    return torch.backends.mkldnn.is_available() and ("avx512_bf16" in flags or "amx_bf16" in flags)
+
+
+def configure_cpu_runtime() -> int:
+    """Apply affinity and thread settings, return the thread count used"""
+    cpus: Optional[Set[int]] = None
+    if CPU_AFFINITY:
+        cpus = parse_cpu_list(CPU_AFFINITY)
+    elif NUMA_NODE:
+        cpus = numa_node_cpus(int(NUMA_NODE))
+
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+        logger.info(f"Pinned inference to CPUs {sorted(cpus)}")
+
+    available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    threads = CPU_THREADS or available
+    torch.set_num_threads(threads)
+    try:
+        # Decode is a sequence of small ops, inter-op parallelism only adds contention
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # already set, or parallel work has started
+
+    logger.info(f"CPU runtime: {threads} threads, capability {torch.backends.cpu.get_cpu_capability()}")
+    return threads
+
+
+def cpu_load_dtype(mode: str = CPU_DTYPE) -> torch.dtype:
+    """dtype to load weights in (int8 is applied after loading, on fp32)"""
+    if mode == "bfloat16":
+        return torch.bfloat16
+    if mode in ("float32", "int8"):
+        return torch.float32
+    return torch.bfloat16 if supports_bf16() else torch.float32
+
+
+def optimize_cpu_model(model, mode: str = CPU_DTYPE, compile_model: bool = CPU_COMPILE):
+    """Quantize (optional) and compile a loaded model for CPU decoding"""
+    if mode == "int8":
+        # Dynamic int8 quantization of all Linear layers (fbgemm/onednn kernels)
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info("Applied dynamic int8 quantization")
+        # Quantized linears break the graph at every layer, compiling only adds recompiles
+        compile_model = False
+
+    if compile_model and hasattr(torch, "compile"):
+        # Compile forward (what generate calls), with dynamic shapes so every
+        # new prompt length / KV length does not trigger a recompile
+        dynamo_config = torch._dynamo.config
+        # Private flag (layer_idx of the KV cache as an unspecialized int), absent in some releases
+        if hasattr(dynamo_config, "allow_unspec_int_on_nn_module"):
+            dynamo_config.allow_unspec_int_on_nn_module = True
+        model.forward = torch.compile(model.forward, dynamic=True)
+        logger.info("Compiled model forward for CPU")
+
+    return model
@@ -0,0 +1,494 @@
+# ~/qwen-api/generation_engine.py
+"""
+Continuous-batching generation engine on the paged KV cache (PAGED_KV_CACHE=1).
+
+One engine thread owns the model. Every step it admits waiting requests
+while pool blocks are free, prefills new prompts and advances all running
+sequences by one token in a single batched forward pass. Finished
+sequences hand their blocks back at once, so the number of concurrent
+sequences is bounded by the tokens actually held, not by per-request
+worst-case reservations.
+
+Long prompts are prefilled in chunks of at most PREFILL_CHUNK_TOKENS, and
+a step feeds at most ENGINE_STEP_TOKENS tokens: running sequences first,
+one token each, then prefill chunks. A 50k-character prompt therefore
+stretches over several steps instead of stalling everyone's decoding
+for the whole prefill.
+
+Full prompt blocks are indexed by content, so a prompt that starts with an
+already computed prefix (system prompt, file context) shares those blocks
+instead of prefilling them again. When the pool runs dry, unused prefix
+blocks are evicted first, then the most recently admitted sequence is
+preempted and recomputed later. With a tiered store (kv_offload.py)
+evicted prefix blocks are kept in host RAM or on disk and copied back when
+a prompt needs them again, if that is cheaper than prefilling them.
+
+Parallel samples (n/best_of) are one request until its prompt is
+computed; then the block table is forked once per extra sample, so the
+prompt is prefilled once and its blocks are shared copy-on-write.
+
+Requests for different LoRA adapters run in the same batch, each row with
+its own adapter (lora_adapters.activate); prefix blocks are indexed per
+adapter.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from prometheus_client import Counter, Gauge, Histogram
+
+from kv_offload import TieredKVStore
+from lora_adapters import LoRAAdapter, activate
+from model_runtime import StopSequenceCriteria, truncate_at_stop
+from paged_kv import BlockTable, OutOfBlocks, PagedCache, PagedKVPool
+from prefix_cache import PREFIX_LOOKUPS, PREFIX_TOKENS_REUSED
+
+logger = logging.getLogger(__name__)
+
+ENGINE_MAX_SEQUENCES = int(os.getenv("ENGINE_MAX_SEQUENCES", "16"))
+# Tokens fed per step (decode tokens + prefill chunks), keep above ENGINE_MAX_SEQUENCES
+ENGINE_STEP_TOKENS = int(os.getenv("ENGINE_STEP_TOKENS", "1024"))
+PREFILL_CHUNK_TOKENS = int(os.getenv("PREFILL_CHUNK_TOKENS", "512"))
+
+ENGINE_RUNNING = Gauge('qwen_engine_running_sequences', 'Sequences decoding in the generation engine', multiprocess_mode='max')
+ENGINE_WAITING = Gauge('qwen_engine_waiting_sequences', 'Sequences waiting for KV blocks', multiprocess_mode='max')
+ENGINE_PREEMPTIONS = Counter('qwen_engine_preemptions_total', 'Sequences preempted (recomputed later) for lack of KV blocks')
+ENGINE_STEP_SECONDS = Histogram(
+    'qwen_engine_step_seconds', 'Engine step duration (inter-token latency of running sequences)',
+    buckets=[0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+)
+ENGINE_PREFILL_TOKENS = Counter('qwen_engine_prefill_tokens_total', 'Prompt tokens prefilled by the engine')
+
+
+class SampleGroup:
+    """Results of the parallel samples of one submitted prompt"""
+
+    def __init__(self, samples: int, seed: Optional[int]):
+        self.results: List[Optional[Dict]] = [None] * samples
+        self.pending = samples
+        self.seed = seed
+        self.future: Future = Future()
+
+
+class EngineRequest:
+    def __init__(self, input_ids: List[int], cancel_event: threading.Event, max_tokens: int,
+                 temperature: float, top_p: float, stop_criteria: StopSequenceCriteria,
+                 eos_token_ids: List[int], group: SampleGroup, index: int = 0,
+                 adapter: Optional[LoRAAdapter] = None):
+        self.prompt_length = len(input_ids)
+        self.tokens = list(input_ids)
+        self.cancel_event = cancel_event
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop_criteria = stop_criteria
+        self.eos_token_ids = set(eos_token_ids)
+        self.table = BlockTable()
+        self.prefix_tokens_reused: Optional[int] = None  # set on first admission
+        self.indexed = False  # full prompt blocks added to the prefix index
+        self.group = group
+        self.index = index
+        self.adapter = adapter
+        # Siblings are created once the prompt is computed (never for a single sample)
+        self.forked = index > 0 or len(group.results) == 1
+        self.generator: Optional[torch.Generator] = None
+        self.logprob = 0.0
+
+    @property
+    def generated(self) -> List[int]:
+        return self.tokens[self.prompt_length:]
+
+    def sibling(self, index: int, table: BlockTable) -> "EngineRequest":
+        """Another sample of the same prompt, starting from a forked block table"""
+        request = EngineRequest(
+            self.tokens[:self.prompt_length], self.cancel_event, self.max_tokens, self.temperature, self.top_p,
+            StopSequenceCriteria(self.stop_criteria.tokenizer, self.stop_criteria.stop),
+            list(self.eos_token_ids), self.group, index, self.adapter
+        )
+        request.table = table
+        request.indexed = True
+        request.prefix_tokens_reused = self.prefix_tokens_reused
+        return request
+
+    def sample_generator(self, device) -> Optional[torch.Generator]:
+        """Per-sample RNG when the request is seeded (sample i uses seed + i)"""
+        if self.group.seed is not None and self.generator is None:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.group.seed + self.index)
+        return self.generator
+
+
+def sample_token(logits: torch.Tensor, seen: List[int], temperature: float, top_p: float,
+                 top_k: Optional[int] = None, repetition_penalty: float = 1.0,
+                 generator: Optional[torch.Generator] = None) -> Tuple[int, float]:
+    """Next token from last-position logits, in the order HF generate applies its processors.
+
+    Returns the token and its log-probability under the distribution it was drawn from.
+    """
+    if repetition_penalty != 1.0 and seen:
+        logits = logits.clone()
+        index = torch.tensor(seen, device=logits.device)
+        score = logits[index]
+        logits[index] = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+    if temperature <= 0:
+        token = int(logits.argmax())
+        return token, float(logits.log_softmax(dim=-1)[token])
+
+    logits = logits / temperature
+    if top_k:
+        threshold = torch.topk(logits, min(top_k, logits.shape[-1])).values[-1]
+        logits = logits.masked_fill(logits < threshold, float("-inf"))
+    if top_p < 1.0:
+        sorted_logits, order = torch.sort(logits)
+        cumulative = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        # Ascending order: drop the low tail whose mass is <= 1 - top_p, always keep the top token
+        remove = cumulative <= 1 - top_p
+        remove[-1] = False
+        logits = logits.masked_fill(remove.scatter(0, order, remove), float("-inf"))
+    logprobs = logits.log_softmax(dim=-1)
+    token = int(torch.multinomial(logprobs.exp(), 1, generator=generator))
+    return token, float(logprobs[token])
+
+
+class GenerationEngine:
+    def __init__(self, model, tokenizer, device: str, pool: Optional[PagedKVPool] = None,
+                 max_sequences: int = ENGINE_MAX_SEQUENCES, step_tokens: int = ENGINE_STEP_TOKENS,
+                 chunk_tokens: int = PREFILL_CHUNK_TOKENS, offload: Optional[TieredKVStore] = None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.pool = pool or PagedKVPool.for_memory(model)
+        self.max_sequences = max_sequences
+        self.step_tokens = step_tokens
+        self.chunk_tokens = chunk_tokens
+        self.offload = offload
+        self.input_device = model.get_input_embeddings().weight.device
+        # sdpa takes a boolean mask, eager an additive one
+        self.bool_mask = model.config._attn_implementation != "eager"
+
+        generation_config = model.generation_config
+        # Unset in the checkpoint config means generate's defaults (top_k 50)
+        self.top_k = generation_config.top_k if generation_config.top_k is not None else 50
+        self.repetition_penalty = getattr(generation_config, "repetition_penalty", None) or 1.0
+
+        self.waiting: deque = deque()
+        self.running: List[EngineRequest] = []
+        # Content hash of a full prompt block (chained over its prefix) -> pool block
+        self.prefix_blocks: "OrderedDict[int, int]" = OrderedDict()
+        self.condition = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = False
+
+    # Request side (any thread)
+
+    def submit(self, input_ids: List[int], cancel_event: threading.Event, max_tokens: int,
+               temperature: float, top_p: float, stop: List[str],
+               eos_token_ids: Optional[List[int]] = None, samples: int = 1,
+               seed: Optional[int] = None, adapter: Optional[LoRAAdapter] = None) -> Future:
+        """Queue a tokenized prompt, the future resolves to the generate_tokens result dict"""
+        group = SampleGroup(samples, seed)
+        request = EngineRequest(
+            input_ids, cancel_event, max_tokens, temperature, top_p,
+            StopSequenceCriteria(self.tokenizer, stop),
+            eos_token_ids or [self.tokenizer.eos_token_id], group, adapter=adapter
+        )
+        if self.offload is not None:
+            # Offloaded prompt blocks head for host RAM while the request waits
+            self.offload.prefetch(self._block_hashes(input_ids, adapter))
+        with self.condition:
+            self.waiting.append(request)
+            ENGINE_WAITING.set(len(self.waiting))
+            self.condition.notify()
+        return group.future
+
+    def generate(self, *args, **kwargs) -> Dict:
+        """Blocking submit"""
+        return self.submit(*args, **kwargs).result()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="generation-engine", daemon=True)
+        self.thread.start()
+        logger.info(f"Generation engine started (max {self.max_sequences} sequences, "
+                    f"{self.pool.allocator.num_blocks} KV blocks of {self.pool.block_size} tokens)")
+
+    def stop(self):
+        """Stop after the current step (running sequences are not finished)"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        if self.offload is not None:
+            self.offload.close()
+
+    def drop_prefix_blocks(self, keep: int = 0) -> bool:
+        """Forget all but the keep most recent prefix blocks, True if any were dropped"""
+        with self.condition:
+            dropped = False
+            while len(self.prefix_blocks) > keep:
+                _, block = self.prefix_blocks.popitem(last=False)
+                self.pool.allocator.release(block)
+                dropped = True
+            return dropped
+
+    # Engine thread
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not (self.waiting or self.running or self.stopped):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+            try:
+                self.step()
+            except Exception as e:
+                logger.error(f"Generation engine step failed: {e}")
+                with self.condition:
+                    for request in self.running:
+                        self.pool.free(request.table)
+                        if not request.group.future.done():
+                            request.group.future.set_exception(e)
+                    self.running = []
+
+    def step(self) -> bool:
+        """Admit, then feed one scheduled batch of tokens; False if there was nothing to run"""
+        with self.condition:
+            self._drop_cancelled()
+            self._admit()
+            plan = self._reserve(self._schedule())
+            ENGINE_RUNNING.set(len(self.running))
+            ENGINE_WAITING.set(len(self.waiting))
+        if not plan:
+            return False
+
+        started = time.perf_counter()
+        # Prefill chunks run on their own (no padding to the longest chunk),
+        # single-token rows (decodes, last prompt tokens) together
+        for request, count in plan:
+            if count > 1:
+                ENGINE_PREFILL_TOKENS.inc(count)
+                chunk_started = time.perf_counter()
+                self._finish_step([request], self._forward([(request, count)]))
+                if self.offload is not None:
+                    self.offload.observe_prefill(count, time.perf_counter() - chunk_started)
+        singles = [(r, count) for r, count in plan if count == 1]
+        if singles:
+            self._finish_step([r for r, _ in singles], self._forward(singles))
+        ENGINE_STEP_SECONDS.observe(time.perf_counter() - started)
+        return True
+
+    def _schedule(self) -> List[Tuple[EngineRequest, int]]:
+        """(sequence, tokens to feed) for this step within the step token budget"""
+        plan = [(r, 1) for r in self.running if len(r.tokens) - r.table.length == 1]
+        budget = self.step_tokens - len(plan)
+        for request in self.running:
+            pending = len(request.tokens) - request.table.length
+            if pending > 1 and budget > 0:
+                count = min(pending, self.chunk_tokens, budget)
+                plan.append((request, count))
+                budget -= count
+        return plan
+
+    def _forward(self, batch: List[Tuple[EngineRequest, int]]) -> torch.Tensor:
+        """Feed count uncomputed tokens per sequence, return last-position logits per row"""
+        queries = [r.tokens[r.table.length:r.table.length + count] for r, count in batch]
+        cache = PagedCache(self.pool, [r.table for r, _ in batch], [len(q) for q in queries])
+        width = max(len(q) for q in queries)
+        input_ids = torch.tensor([q + [0] * (width - len(q)) for q in queries], device=self.input_device)
+
+        mask = cache.attention_mask().to(self.input_device)
+        if not self.bool_mask:
+            mask = torch.zeros(mask.shape, dtype=self.pool.keys[0].dtype, device=mask.device).masked_fill(
+                ~mask, torch.finfo(self.pool.keys[0].dtype).min
+            )
+        masks = {"full_attention": mask, "sliding_attention": mask}
+
+        with torch.inference_mode(), torch.autocast(device_type=self.device, enabled=self.device == "cuda"), \
+                activate([r.adapter for r, _ in batch]):
+            hidden = self.model.model(
+                input_ids=input_ids,
+                position_ids=cache.position_ids().to(self.input_device),
+                attention_mask=masks,
+                past_key_values=cache,
+                use_cache=True
+            ).last_hidden_state
+            last = hidden[torch.arange(len(batch)), torch.tensor([len(q) - 1 for q in queries])]
+            logits = self.model.lm_head(last).float()
+        cache.commit()
+        return logits
+
+    def _finish_step(self, batch: List[EngineRequest], logits: torch.Tensor):
+        for request, row in zip(batch, logits):
+            if request.table.length < len(request.tokens):
+                continue  # prompt chunk, more of the prompt to come
+            if not request.indexed:
+                self._index_prompt(request)
+            if not request.forked:
+                # Prompt computed once, the other samples start from the same blocks and logits
+                for sibling in self._fork(request):
+                    self._sample(sibling, row)
+            self._sample(request, row)
+
+    def _fork(self, request: EngineRequest) -> List[EngineRequest]:
+        request.forked = True
+        with self.condition:
+            siblings = [
+                request.sibling(index, self.pool.fork(request.table))
+                for index in range(1, len(request.group.results))
+            ]
+            self.running.extend(siblings)
+        return siblings
+
+    def _sample(self, request: EngineRequest, row: torch.Tensor):
+        token, logprob = sample_token(row, request.tokens, request.temperature, request.top_p,
+                                      self.top_k, self.repetition_penalty, request.sample_generator(row.device))
+        request.tokens.append(token)
+        request.logprob += logprob
+        triggered = request.stop_criteria(torch.tensor([request.tokens[request.prompt_length - 1:]]), None)[0]
+        if token in request.eos_token_ids or triggered or len(request.generated) >= request.max_tokens:
+            self._complete(request)
+
+    def _complete(self, request: EngineRequest, stopped: Optional[str] = None):
+        with self.condition:
+            if request in self.running:
+                self.running.remove(request)
+            self.pool.free(request.table)
+        generated = request.generated
+        if stopped is None and request.stop_criteria.triggered:
+            stopped = "stop_sequence"
+        finish_reason = "length" if stopped is None and len(generated) >= request.max_tokens else "stop"
+        text = self.tokenizer.decode(generated, skip_special_tokens=True)
+        result = {
+            "text": truncate_at_stop(text, request.stop_criteria.stop),
+            "token_ids": generated,
+            "generated_tokens": len(generated),
+            "stopped": stopped,
+            "finish_reason": finish_reason,
+            "logprob": request.logprob
+        }
+
+        group = request.group
+        group.results[request.index] = result
+        # A sample group cancelled before it was forked has no siblings to wait for
+        group.pending -= 1 if request.forked else group.pending
+        if group.pending == 0 and not group.future.done():
+            reused = request.prefix_tokens_reused or 0
+            if len(group.results) == 1:
+                group.future.set_result(dict(result, prefix_tokens_reused=reused))
+            else:
+                choices = [r if r is not None else result for r in group.results]
+                group.future.set_result({"choices": choices, "prefix_tokens_reused": reused})
+
+    # Scheduling (called with the condition held)
+
+    def _drop_cancelled(self):
+        for request in [r for r in list(self.waiting) + self.running if r.cancel_event.is_set()]:
+            if request in self.waiting:
+                self.waiting.remove(request)
+            self._complete(request, stopped="disconnect")
+
+    def _block_hashes(self, tokens: List[int], adapter: Optional[LoRAAdapter] = None) -> List[int]:
+        # The chain starts at the adapter: its K/V differ from the base model's
+        size, hashes = self.pool.block_size, []
+        parent = adapter.name if adapter is not None else None
+        for start in range(0, len(tokens) - size + 1, size):
+            parent = hash((parent, tuple(tokens[start:start + size])))
+            hashes.append(parent)
+        return hashes
+
+    def _admit(self):
+        while self.waiting and len(self.running) < self.max_sequences:
+            request = self.waiting[0]
+            hashes = self._block_hashes(request.tokens, request.adapter)
+            shared = []
+            for block_hash in hashes:
+                block = self.prefix_blocks.get(block_hash)
+                if block is None:
+                    break
+                self.prefix_blocks.move_to_end(block_hash)
+                shared.append(self.pool.allocator.share(block))
+            if self.offload is not None:
+                shared += self._restore_offloaded(hashes[len(shared):])
+            # The last token is always computed, its logits start decoding
+            reused = min(len(shared) * self.pool.block_size, len(request.tokens) - 1)
+            request.table = BlockTable(shared, reused)
+
+            # One spare block per running sequence, so admitting does not force a preemption next step
+            needed = self.pool.blocks_needed(request.table, len(request.tokens) - reused) + len(self.running)
+            if needed > self.pool.num_free and not self._evict_prefix_blocks(needed - self.pool.num_free):
+                self.pool.free(request.table)
+                if not self.running:
+                    self.waiting.popleft()
+                    request.group.future.set_exception(OutOfBlocks(f"Prompt of {len(request.tokens)} tokens does not fit the KV pool"))
+                    continue
+                return
+
+            self.waiting.popleft()
+            if request.prefix_tokens_reused is None:
+                PREFIX_LOOKUPS.labels(result="hit" if reused else "miss").inc()
+                PREFIX_TOKENS_REUSED.inc(reused)
+                request.prefix_tokens_reused = reused
+            self.running.append(request)
+
+    def _reserve(self, plan: List[Tuple[EngineRequest, int]]) -> List[Tuple[EngineRequest, int]]:
+        """Blocks for the planned tokens, preempting the newest sequences if the pool is full"""
+        for request, count in plan:
+            while request in self.running:
+                try:
+                    self.pool.reserve(request.table, count)
+                    break
+                except OutOfBlocks:
+                    if not self._evict_prefix_blocks(1):
+                        self._preempt(self.running[-1])
+        return [(r, count) for r, count in plan if r in self.running]
+
+    def _preempt(self, request: EngineRequest):
+        """Free the blocks of a running sequence; it is recomputed from its tokens when readmitted"""
+        self.running.remove(request)
+        self.pool.free(request.table)
+        request.indexed = False
+        self.waiting.appendleft(request)
+        ENGINE_PREEMPTIONS.inc()
+
+    def _index_prompt(self, request: EngineRequest):
+        """Share the full prompt blocks of a sequence whose prompt is computed"""
+        request.indexed = True
+        prompt = request.tokens[:request.prompt_length]
+        with self.condition:
+            for index, block_hash in enumerate(self._block_hashes(prompt, request.adapter)):
+                if block_hash not in self.prefix_blocks:
+                    self.prefix_blocks[block_hash] = self.pool.allocator.share(request.table.blocks[index])
+
+    def _restore_offloaded(self, hashes: List[int]) -> List[int]:
+        """Copy offloaded prefix blocks back into the pool (while cheaper than recomputing), shared"""
+        blocks = []
+        for block_hash in self.offload.plan(hashes):
+            if not self.pool.num_free and not self._evict_prefix_blocks(1):
+                break
+            block = self.pool.allocator.allocate()
+            if not self.offload.restore(block_hash, self.pool, block):
+                self.pool.allocator.release(block)
+                break
+            self.prefix_blocks[block_hash] = block
+            blocks.append(self.pool.allocator.share(block))
+        return blocks
+
+    def _evict_prefix_blocks(self, count: int) -> bool:
+        """Free up to count blocks only the prefix index still holds, True if enough were freed"""
+        freed = 0
+        for block_hash, block in list(self.prefix_blocks.items()):
+            if freed >= count:
+                break
+            if self.pool.allocator.refs[block] == 1:
+                if self.offload is not None:
+                    self.offload.offload(block_hash, self.pool, block)
+                del self.prefix_blocks[block_hash]
+                self.pool.allocator.release(block)
+                freed += 1
+        return freed >= count
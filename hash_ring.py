@@ -0,0 +1,40 @@
+# ~/qwen-api/hash_ring.py
+"""
+Consistent-hash ring, shared by the replica router and the sharded cache.
+
+Every node owns the arcs before its vnodes points on the ring. A key
+belongs to the first point after its hash, so adding or removing one of N
+nodes only moves the keys of the arcs that node gains or loses (about 1/N).
+"""
+import bisect
+from typing import Iterator, List
+
+from cache_keys import fast_digest
+
+
+def ring_hash(value: str) -> int:
+    return int(fast_digest(value.encode())[:16], 16)
+
+
+class HashRing:
+    """Consistent-hash ring with vnodes points per node"""
+
+    def __init__(self, nodes: List[str], vnodes: int = 160):
+        self.points = sorted((ring_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.hashes = [h for h, _ in self.points]
+        self.size = len(set(nodes))
+
+    def owner(self, key: str) -> str:
+        return self.points[bisect.bisect(self.hashes, ring_hash(key)) % len(self.points)][1]
+
+    def walk(self, key: str) -> Iterator[str]:
+        """Every node once, in ring order starting at key"""
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        seen = set()
+        for i in range(len(self.points)):
+            node = self.points[(start + i) % len(self.points)][1]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == self.size:
+                    return
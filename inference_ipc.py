@@ -0,0 +1,203 @@
+# ~/qwen-api/inference_ipc.py
+"""
+Local IPC between the HTTP workers and the model-owning inference process.
+
+Every frame is a 4-byte big-endian length followed by a JSON object. Each
+HTTP worker keeps one Unix socket connection open and multiplexes its
+requests over it, matching responses by request id.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import struct
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_SOCKET = os.getenv("INFERENCE_SOCKET", "")
+CANCEL_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+Handler = Callable[[Dict, threading.Event], Awaitable[Dict]]
+
+
+class InferenceError(Exception):
+    """Error reported by (or about) the inference process"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Dict]:
+    """Read one frame, None on EOF (including a frame cut short by a dying peer)"""
+    try:
+        header = await reader.readexactly(HEADER.size)
+        (length,) = HEADER.unpack(header)
+        if length > MAX_FRAME_SIZE:
+            raise InferenceError(500, f"IPC frame too large: {length} bytes")
+        body = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return json.loads(body)
+
+
+def encode_frame(message: Dict) -> bytes:
+    body = json.dumps(message, separators=(",", ":")).encode()
+    return HEADER.pack(len(body)) + body
+
+
+class InferenceServer:
+    """Serves generation (and other model) requests for the process that owns the model"""
+
+    def __init__(self, handlers: Dict[str, Handler], socket_path: str = INFERENCE_SOCKET):
+        # op name -> handler, e.g. {"generate": ..., "embed": ...}
+        self.handlers = handlers
+        self.socket_path = socket_path
+
+    async def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+        logger.info(f"Inference IPC listening on {self.socket_path}")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        cancel_events: Dict[int, threading.Event] = {}
+        tasks = set()
+        write_lock = asyncio.Lock()
+
+        async def reply(message: Dict):
+            async with write_lock:
+                writer.write(encode_frame(message))
+                await writer.drain()
+
+        async def run(request_id: int, message: Dict, cancel_event: threading.Event):
+            try:
+                result = await self.handlers[message["op"]](message, cancel_event)
+                await reply({"id": request_id, "ok": True, "result": result})
+            except Exception as e:
+                status_code = getattr(e, "status_code", 500)
+                detail = getattr(e, "detail", str(e))
+                await reply({"id": request_id, "ok": False, "status": status_code, "detail": detail})
+            finally:
+                cancel_events.pop(request_id, None)
+
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                request_id = message["id"]
+                op = message.get("op")
+                if op in self.handlers:
+                    cancel_events[request_id] = threading.Event()
+                    task = asyncio.create_task(run(request_id, message, cancel_events[request_id]))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                elif op == "cancel":
+                    if request_id in cancel_events:
+                        cancel_events[request_id].set()
+                elif op == "ping":
+                    await reply({"id": request_id, "ok": True, "result": {"pid": os.getpid()}})
+                else:
+                    await reply({"id": request_id, "ok": False, "status": 400, "detail": f"Unknown op: {op}"})
+        except (ConnectionError, InferenceError) as e:
+            logger.warning(f"Inference IPC connection error: {e}")
+        finally:
+            # HTTP worker went away, nobody will read these results
+            for event in cancel_events.values():
+                event.set()
+            writer.close()
+
+
+class InferenceClient:
+    """HTTP worker side of the IPC channel"""
+
+    def __init__(self, socket_path: str = INFERENCE_SOCKET):
+        self.socket_path = socket_path
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.read_task: Optional[asyncio.Task] = None
+        self.ids = itertools.count(1)
+        self.connect_lock = asyncio.Lock()
+        self.write_lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        """(Re)connect; the socket only exists once the model is loaded"""
+        async with self.connect_lock:
+            if self.connected:
+                return
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path)
+            except (FileNotFoundError, ConnectionError) as e:
+                raise InferenceError(503, "Model not loaded yet") from e
+            self.read_task = asyncio.create_task(self._read_loop(self.reader))
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                future = self.pending.pop(message["id"], None)
+                if future and not future.done():
+                    future.set_result(message)
+        except Exception as e:
+            logger.warning(f"Inference IPC read error: {e}")
+        finally:
+            self.writer = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(InferenceError(503, "Inference process unavailable"))
+            self.pending.clear()
+
+    async def _send(self, message: Dict):
+        async with self.write_lock:
+            self.writer.write(encode_frame(message))
+            await self.writer.drain()
+
+    async def call(self, op: str, cancel_event: Optional[threading.Event] = None, **payload) -> Dict:
+        """Send a request and wait for its result.
+
+        If cancel_event gets set while waiting, a cancel frame is sent and
+        the (partial) result is still awaited.
+        """
+        await self.connect()
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        await self._send({"id": request_id, "op": op, **payload})
+
+        cancel_sent = False
+        while not future.done():
+            await asyncio.wait({future}, timeout=CANCEL_POLL_INTERVAL)
+            if cancel_event is not None and cancel_event.is_set() and not cancel_sent and not future.done():
+                await self._send({"id": request_id, "op": "cancel"})
+                cancel_sent = True
+
+        message = future.result()
+        if not message["ok"]:
+            raise InferenceError(message["status"], message["detail"])
+        return message["result"]
+
+    async def run_generation(self, input_ids, cancel_event: threading.Event, **params) -> Dict:
+        """Same contract as QwenAPI.run_generation, executed remotely"""
+        return await self.call("generate", cancel_event, input_ids=list(input_ids), params=params)
+
+    async def run_embeddings(self, token_lists) -> List[str]:
+        """Same contract as QwenAPI.run_embeddings, executed remotely"""
+        result = await self.call("embed", token_lists=[list(ids) for ids in token_lists])
+        return result["vectors"]
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# ~/qwen-api/inference_worker.py
+"""
+Model-owning inference process for multi-worker deployments.
+
+Loads the model once and serves generation requests from the HTTP workers
+over the INFERENCE_SOCKET Unix socket. Started by `api_server.py` when
+API_WORKERS > 1, or run on its own next to externally managed workers.
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Dict
+
+from api_server import memory_monitor, qwen_api
+from inference_ipc import INFERENCE_SOCKET, InferenceServer
+
+logger = logging.getLogger("inference_worker")
+
+
+async def handle_generate(message: Dict, cancel_event: threading.Event) -> Dict:
+    return await qwen_api.run_generation(message["input_ids"], cancel_event, **message["params"])
+
+
+async def handle_embed(message: Dict, cancel_event: threading.Event) -> Dict:
+    return {"vectors": await qwen_api.run_embeddings(message["token_lists"])}
+
+
+async def main():
+    if not INFERENCE_SOCKET:
+        raise SystemExit("INFERENCE_SOCKET must be set")
+
+    logger.info("Starting inference worker...")
+    await qwen_api.load_model()
+    qwen_api.register_shedders(memory_monitor)
+    memory_monitor.start()
+    # The socket only appears once the model is ready, HTTP workers answer 503 until then
+    await InferenceServer({"generate": handle_generate, "embed": handle_embed}, INFERENCE_SOCKET).serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,202 @@
+# ~/qwen-api/kv_offload.py
+"""
+Tiered store for prefix KV blocks the engine evicts from the device pool.
+
+Without it an evicted prompt prefix (an idle chat session, a file an editor
+will come back to) is gone and its next request prefills it from scratch.
+Here evicted blocks go to pinned host RAM (KV_HOST_CACHE_GB) and from
+there, when that fills up, to a memory-mapped file on local disk
+(KV_DISK_CACHE_GB under KV_DISK_CACHE_DIR). Each tier is an LRU of block
+content hashes, the same chained hashes as the engine's prefix index.
+
+When a request is submitted its blocks found on disk are prefetched into
+host RAM in the background, so by the time it is admitted they are one
+copy away from the device. The engine restores a block only while that is
+cheaper than recomputing it: restore time per block and tier and prefill
+time per token are measured as the engine runs (both are exported).
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import torch
+from prometheus_client import Counter, Gauge, Histogram
+
+from paged_kv import PagedKVPool
+
+logger = logging.getLogger(__name__)
+
+KV_HOST_CACHE_GB = float(os.getenv("KV_HOST_CACHE_GB", "0"))
+KV_DISK_CACHE_GB = float(os.getenv("KV_DISK_CACHE_GB", "0"))
+KV_DISK_CACHE_DIR = os.getenv("KV_DISK_CACHE_DIR", "/app/kv_cache")
+KV_OFFLOAD_ENABLED = KV_HOST_CACHE_GB > 0 or KV_DISK_CACHE_GB > 0
+
+# Weight of the newest measurement in the running cost estimates
+COST_SMOOTHING = 0.2
+
+KV_TIER_BLOCKS = Gauge('qwen_kv_offload_blocks', 'Prefix KV blocks held per offload tier', ['tier'], multiprocess_mode='max')
+KV_OFFLOADED = Counter('qwen_kv_offload_stored_total', 'Prefix KV blocks written to an offload tier', ['tier'])
+KV_RESTORED = Counter('qwen_kv_offload_restored_total', 'Prefix KV blocks copied back into the device pool', ['tier'])
+KV_PREFETCHED = Counter('qwen_kv_offload_prefetched_total', 'Blocks moved from disk to host RAM ahead of admission')
+KV_RESTORE_DECISIONS = Counter('qwen_kv_restore_decisions_total', 'Offloaded prefix blocks restored or recomputed', ['choice'])
+KV_RESTORE_SECONDS = Histogram(
+    'qwen_kv_restore_seconds', 'Time to copy one offloaded block back into the pool', ['tier'],
+    buckets=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5]
+)
+KV_BLOCK_COST = Gauge(
+    'qwen_kv_block_cost_seconds', 'Current estimate of getting one KV block back: restore per tier or recompute',
+    ['source'], multiprocess_mode='max'
+)
+
+
+class KVTier:
+    """LRU of block hashes over the slots of one preallocated tensor [slots, *block shape]"""
+
+    def __init__(self, name: str, storage: torch.Tensor):
+        self.name = name
+        self.storage = storage
+        self.slots: "OrderedDict[int, int]" = OrderedDict()
+        self.free = list(range(storage.shape[0]))
+
+    def __contains__(self, block_hash: int) -> bool:
+        return block_hash in self.slots
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def get(self, block_hash: int) -> torch.Tensor:
+        self.slots.move_to_end(block_hash)
+        return self.storage[self.slots[block_hash]]
+
+    def put(self, block_hash: int, data: torch.Tensor, spill: Optional["KVTier"] = None):
+        """Store a copy of data, the least recently used block moves to spill (or is dropped) when full"""
+        if block_hash in self.slots:
+            self.slots.move_to_end(block_hash)
+            return
+        if not self.free:
+            evicted, slot = self.slots.popitem(last=False)
+            if spill is not None:
+                spill.put(evicted, self.storage[slot])
+            self.free.append(slot)
+        slot = self.free.pop()
+        self.storage[slot].copy_(data)
+        self.slots[block_hash] = slot
+        KV_OFFLOADED.labels(tier=self.name).inc()
+        KV_TIER_BLOCKS.labels(tier=self.name).set(len(self.slots))
+
+
+class TieredKVStore:
+    def __init__(self, pool: PagedKVPool, host_gb: float = KV_HOST_CACHE_GB, disk_gb: float = KV_DISK_CACHE_GB,
+                 disk_dir: str = KV_DISK_CACHE_DIR):
+        self.block_shape = (len(pool.keys), 2, pool.block_size, pool.kv_heads, pool.head_dim)
+        dtype = pool.keys[0].dtype
+        host_blocks = int(host_gb * 2**30 // pool.bytes_per_block)
+        disk_blocks = int(disk_gb * 2**30 // pool.bytes_per_block)
+
+        self.tiers: List[KVTier] = []
+        if host_blocks:
+            # Pinned, so copies to and from the GPU run at full bandwidth
+            storage = torch.empty((host_blocks, *self.block_shape), dtype=dtype, pin_memory=torch.cuda.is_available())
+            self.tiers.append(KVTier("host", storage))
+        if disk_blocks:
+            os.makedirs(disk_dir, exist_ok=True)
+            path = os.path.join(disk_dir, f"kv-blocks-{os.getpid()}.bin")
+            numel = disk_blocks * int(torch.Size(self.block_shape).numel())
+            storage = torch.from_file(path, shared=True, size=numel, dtype=dtype).view(disk_blocks, *self.block_shape)
+            # The mapping stays valid, the file goes away with the process (also on a crash)
+            os.unlink(path)
+            self.tiers.append(KVTier("disk", storage))
+
+        # Seconds per block: restore per tier, recompute (None until measured)
+        self.restore_cost: Dict[str, Optional[float]] = {tier.name: None for tier in self.tiers}
+        self.recompute_cost: Optional[float] = None
+        self.block_size = pool.block_size
+        self.staging = torch.empty(self.block_shape, dtype=dtype)
+        self.lock = threading.Lock()
+        self.prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kv-prefetch")
+        logger.info(
+            f"KV offload: {host_blocks} blocks in host RAM, {disk_blocks} on disk "
+            f"({pool.bytes_per_block / 2**20:.2f} MiB per block)"
+        )
+
+    def _find(self, block_hash: int) -> Optional[KVTier]:
+        for tier in self.tiers:
+            if block_hash in tier:
+                return tier
+        return None
+
+    def offload(self, block_hash: int, pool: PagedKVPool, block: int):
+        """Keep a copy of a pool block the engine is about to evict"""
+        with self.lock:
+            tier = self._find(block_hash)
+            if tier is not None:
+                tier.get(block_hash)  # already offloaded earlier (restored, unchanged since): touch
+                return
+            pool.read_block(block, self.staging)
+            self.tiers[0].put(block_hash, self.staging, spill=self.tiers[1] if len(self.tiers) > 1 else None)
+
+    def plan(self, hashes: List[int]) -> List[int]:
+        """Leading hashes worth restoring: offloaded, and cheaper to copy back than to recompute"""
+        restore = []
+        with self.lock:
+            for block_hash in hashes:
+                tier = self._find(block_hash)
+                if tier is None:
+                    break
+                cost = self.restore_cost[tier.name]
+                # Unmeasured costs: restore, that is how they get measured
+                if cost is not None and self.recompute_cost is not None and cost > self.recompute_cost:
+                    KV_RESTORE_DECISIONS.labels(choice="recompute").inc()
+                    break
+                restore.append(block_hash)
+        return restore
+
+    def restore(self, block_hash: int, pool: PagedKVPool, block: int) -> bool:
+        """Copy an offloaded block into pool block, False if it was evicted meanwhile"""
+        with self.lock:
+            tier = self._find(block_hash)
+            if tier is None:
+                return False
+            started = time.perf_counter()
+            pool.write_block(block, tier.get(block_hash))
+            elapsed = time.perf_counter() - started
+            self.restore_cost[tier.name] = self._smooth(self.restore_cost[tier.name], elapsed)
+        KV_RESTORE_SECONDS.labels(tier=tier.name).observe(elapsed)
+        KV_BLOCK_COST.labels(source=tier.name).set(self.restore_cost[tier.name])
+        KV_RESTORED.labels(tier=tier.name).inc()
+        KV_RESTORE_DECISIONS.labels(choice="restore").inc()
+        return True
+
+    def observe_prefill(self, tokens: int, seconds: float):
+        """Prefill timing from the engine, the recompute side of the comparison"""
+        self.recompute_cost = self._smooth(self.recompute_cost, seconds / tokens * self.block_size)
+        KV_BLOCK_COST.labels(source="recompute").set(self.recompute_cost)
+
+    def prefetch(self, hashes: List[int]):
+        """Move the leading offloaded blocks of a prompt from disk to host RAM, in the background"""
+        if len(self.tiers) > 1:
+            self.prefetcher.submit(self._prefetch, hashes)
+
+    def _prefetch(self, hashes: List[int]):
+        host, disk = self.tiers
+        for block_hash in hashes:
+            with self.lock:
+                if block_hash in host:
+                    continue
+                if block_hash not in disk:
+                    return
+                # Staged: making room in host RAM may spill into the disk slot being read
+                self.staging.copy_(disk.get(block_hash))
+                host.put(block_hash, self.staging, spill=disk)
+            KV_PREFETCHED.inc()
+
+    @staticmethod
+    def _smooth(current: Optional[float], sample: float) -> float:
+        return sample if current is None else (1 - COST_SMOOTHING) * current + COST_SMOOTHING * sample
+
+    def close(self):
+        self.prefetcher.shutdown(wait=True)
@@ -0,0 +1,208 @@
+# ~/qwen-api/lora_adapters.py
+"""
+Multi-LoRA serving: per-team adapters on one resident base model.
+
+Adapters are PEFT LoRA checkpoints (adapter_config.json +
+adapter_model.safetensors), one directory per adapter under
+LORA_ADAPTER_DIR; the directory name is the name clients pass as `model`.
+They are loaded from disk on first use and at most LORA_MAX_RESIDENT stay
+in memory (least recently used goes first).
+
+Base weights are never merged. attach_lora() wraps the target Linear layers
+once; a wrapped layer computes x @ W for the whole batch and adds
+scaling * (x @ A) @ B to the rows of each active adapter. Requests for
+different adapters (and for the plain base model) therefore run in one
+batch. Which adapter a batch row uses is set per thread with activate().
+"""
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from prometheus_client import Counter, Gauge
+from safetensors.torch import load_file
+
+logger = logging.getLogger(__name__)
+
+LORA_ADAPTER_DIR = os.getenv("LORA_ADAPTER_DIR", "")
+LORA_MAX_RESIDENT = int(os.getenv("LORA_MAX_RESIDENT", "8"))
+LORA_TARGET_MODULES = os.getenv(
+    "LORA_TARGET_MODULES", "q_proj,k_proj,v_proj,o_proj,gate_proj,up_proj,down_proj"
+).split(",")
+
+LORA_RESIDENT = Gauge('qwen_lora_adapters_resident', 'LoRA adapters loaded in memory', multiprocess_mode='max')
+LORA_RESIDENT_BYTES = Gauge('qwen_lora_adapter_bytes', 'Memory held by resident LoRA adapters', multiprocess_mode='max')
+LORA_LOADS = Counter('qwen_lora_adapter_loads_total', 'LoRA adapters loaded from disk')
+LORA_EVICTIONS = Counter('qwen_lora_adapter_evictions_total', 'LoRA adapters dropped from memory (LRU)')
+
+# Adapter names are directory names, nothing that walks out of LORA_ADAPTER_DIR
+ADAPTER_NAME = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9._-]*$")
+# base_model.model.model.layers.0.self_attn.q_proj.lora_A[.default].weight
+PEFT_KEY = re.compile(r"^(?:base_model\.model\.)?(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$")
+
+_active = threading.local()
+
+
+class UnknownAdapter(Exception):
+    """No adapter of that name in LORA_ADAPTER_DIR"""
+
+
+class LoRAAdapter:
+    """Low-rank deltas of one adapter: module path -> (A^T [in, r], B^T [r, out])"""
+
+    def __init__(self, name: str, scaling: float, layers: Dict[str, Tuple[torch.Tensor, torch.Tensor]]):
+        self.name = name
+        self.scaling = scaling
+        self.layers = layers
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes + b.nbytes for a, b in self.layers.values())
+
+
+class LoRALinear(torch.nn.Module):
+    """Linear layer plus the deltas of whichever adapters are active for the batch rows"""
+
+    def __init__(self, base: torch.nn.Module, path: str):
+        super().__init__()
+        self.base = base
+        self.path = path
+
+    @property
+    def weight(self):
+        # Code that inspects the projection (device, dtype) sees the base layer
+        return self.base.weight
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = self.base(x)
+        for adapter, rows in getattr(_active, "groups", ()):
+            weights = adapter.layers.get(self.path)
+            if weights is None:
+                continue
+            a, b = weights
+            if rows is None:
+                out = out + (x.to(a.dtype) @ a @ b * adapter.scaling).to(out.dtype)
+            else:
+                rows = rows.to(x.device)
+                delta = x.index_select(0, rows).to(a.dtype) @ a @ b * adapter.scaling
+                out = out.index_add(0, rows, delta.to(out.dtype))
+        return out
+
+
+def attach_lora(model, targets: List[str] = LORA_TARGET_MODULES) -> int:
+    """Wrap the target Linear layers of every decoder layer, returns how many were wrapped"""
+    wrapped = 0
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if child_name in targets and not isinstance(child, LoRALinear):
+                setattr(module, child_name, LoRALinear(child, f"{name}.{child_name}" if name else child_name))
+                wrapped += 1
+    logger.info(f"LoRA: wrapped {wrapped} linear layers ({','.join(targets)})")
+    return wrapped
+
+
+@contextmanager
+def activate(adapters: List[Optional[LoRAAdapter]]):
+    """Use adapters[i] for batch row i (None = base model) in this thread's forward passes"""
+    groups = []
+    for adapter in {a for a in adapters if a is not None}:
+        if all(a is adapter for a in adapters):
+            groups.append((adapter, None))  # whole batch, no row selection
+        else:
+            groups.append((adapter, torch.tensor([i for i, a in enumerate(adapters) if a is adapter])))
+    previous = getattr(_active, "groups", ())
+    _active.groups = groups
+    try:
+        yield
+    finally:
+        _active.groups = previous
+
+
+def available_adapters(directory: str = LORA_ADAPTER_DIR) -> List[str]:
+    if not directory or not os.path.isdir(directory):
+        return []
+    return sorted(
+        name for name in os.listdir(directory)
+        if ADAPTER_NAME.match(name) and os.path.isfile(os.path.join(directory, name, "adapter_config.json"))
+    )
+
+
+def load_adapter(path: str, model, name: Optional[str] = None) -> LoRAAdapter:
+    """Read a PEFT LoRA checkpoint, deltas placed next to (and in the dtype of) the layers they patch"""
+    with open(os.path.join(path, "adapter_config.json")) as f:
+        config = json.load(f)
+    rank = config["r"]
+    alpha = config.get("lora_alpha", rank)
+    scaling = alpha / rank ** 0.5 if config.get("use_rslora") else alpha / rank
+
+    modules = {name: m for name, m in model.named_modules() if isinstance(m, LoRALinear)}
+    tensors = load_file(os.path.join(path, "adapter_model.safetensors"))
+    pairs: Dict[str, Dict[str, torch.Tensor]] = {}
+    for key, tensor in tensors.items():
+        match = PEFT_KEY.match(key)
+        if match:
+            pairs.setdefault(match.group(1), {})[match.group(2)] = tensor
+
+    layers, skipped = {}, 0
+    for module_path, pair in pairs.items():
+        module = modules.get(module_path)
+        if module is None or len(pair) != 2:
+            skipped += 1
+            continue
+        weight = getattr(module.base, "weight", None)
+        # Dynamically quantized linears expose weight() as a method
+        weight = weight() if callable(weight) else weight
+        dtype = weight.dtype if weight is not None and weight.dtype.is_floating_point else torch.float32
+        device = weight.device if weight is not None else torch.device("cpu")
+        layers[module_path] = (
+            pair["A"].t().contiguous().to(device=device, dtype=dtype),
+            pair["B"].t().contiguous().to(device=device, dtype=dtype),
+        )
+    if skipped:
+        logger.warning(f"LoRA adapter {path}: {skipped} modules not wrapped in the model, ignored")
+    return LoRAAdapter(name or os.path.basename(os.path.normpath(path)), scaling, layers)
+
+
+class AdapterRegistry:
+    """Adapters by name, loaded lazily, at most max_resident kept (LRU).
+
+    An evicted adapter stays alive until the requests holding it finish.
+    """
+
+    def __init__(self, model, directory: str = LORA_ADAPTER_DIR, max_resident: int = LORA_MAX_RESIDENT):
+        self.model = model
+        self.directory = directory
+        self.max_resident = max_resident
+        self.resident: "OrderedDict[str, LoRAAdapter]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def names(self) -> List[str]:
+        return available_adapters(self.directory)
+
+    def get(self, name: str) -> LoRAAdapter:
+        with self.lock:
+            adapter = self.resident.get(name)
+            if adapter is not None:
+                self.resident.move_to_end(name)
+                return adapter
+
+            path = os.path.join(self.directory, name)
+            if not ADAPTER_NAME.match(name) or not os.path.isfile(os.path.join(path, "adapter_config.json")):
+                raise UnknownAdapter(name)
+            adapter = load_adapter(path, self.model, name)
+            LORA_LOADS.inc()
+            logger.info(f"Loaded LoRA adapter {name} ({adapter.nbytes / 2**20:.1f} MiB, {len(adapter.layers)} layers)")
+
+            self.resident[name] = adapter
+            while len(self.resident) > self.max_resident:
+                evicted, _ = self.resident.popitem(last=False)
+                LORA_EVICTIONS.inc()
+                logger.info(f"Evicted LoRA adapter {evicted}")
+            LORA_RESIDENT.set(len(self.resident))
+            LORA_RESIDENT_BYTES.set(sum(a.nbytes for a in self.resident.values()))
+            return adapter
@@ -0,0 +1,177 @@
+# ~/qwen-api/memory_monitor.py
+"""
+Memory-pressure monitor with staged load shedding.
+
+A background task samples host memory (/proc/meminfo) and, where torch is
+loaded with CUDA, device memory. Above MEMORY_HIGH_WATERMARK registered
+shedders free caches and lower generation concurrency; above
+MEMORY_CRITICAL_WATERMARK they shed everything they can. Once usage falls
+back under MEMORY_LOW_WATERMARK they are called with level 0 to restore.
+"""
+import asyncio
+import logging
+import os
+import sys
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+MEMORY_MONITOR_INTERVAL = float(os.getenv("MEMORY_MONITOR_INTERVAL", "2.0"))
+MEMORY_LOW_WATERMARK = float(os.getenv("MEMORY_LOW_WATERMARK", "0.75"))
+MEMORY_HIGH_WATERMARK = float(os.getenv("MEMORY_HIGH_WATERMARK", "0.85"))
+MEMORY_CRITICAL_WATERMARK = float(os.getenv("MEMORY_CRITICAL_WATERMARK", "0.95"))
+
+# Pressure levels passed to shedders
+NORMAL, HIGH, CRITICAL = 0, 1, 2
+
+MEMORY_USED = Gauge('qwen_memory_used_ratio', 'Used fraction of memory', ['device'], multiprocess_mode='max')
+MEMORY_PRESSURE = Gauge('qwen_memory_pressure_level', '0 normal, 1 high, 2 critical', multiprocess_mode='max')
+SHED_ACTIONS = Counter('qwen_memory_shed_total', 'Load shedding actions taken under memory pressure', ['action'])
+OOM_RETRIES = Counter('qwen_oom_retries_total', 'Generations retried after running out of memory', ['outcome'])
+
+
+def host_memory_ratio() -> Optional[float]:
+    try:
+        with open("/proc/meminfo") as f:
+            info = {line.split(":")[0]: int(line.split()[1]) for line in f}
+        return 1 - info["MemAvailable"] / info["MemTotal"]
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def device_memory_ratio() -> Optional[float]:
+    # Never import torch just for monitoring (HTTP workers run without it)
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    free, total = torch.cuda.mem_get_info()
+    return 1 - free / total
+
+
+class AdjustableSemaphore:
+    """asyncio semaphore whose limit can be lowered and raised at runtime.
+
+    Priority waiters (the autocomplete lane) are admitted before any
+    normal waiter gets a free slot.
+    """
+
+    def __init__(self, limit: int):
+        self.capacity = limit  # configured limit, restored after pressure
+        self.limit = limit
+        self.active = 0
+        self.priority_waiting = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, priority: bool = False):
+        async with self.condition:
+            if priority:
+                self.priority_waiting += 1
+                try:
+                    await self.condition.wait_for(lambda: self.active < self.limit)
+                finally:
+                    self.priority_waiting -= 1
+            else:
+                await self.condition.wait_for(lambda: self.active < self.limit and not self.priority_waiting)
+            self.active += 1
+
+    async def release(self):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, priority: bool = False):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            await self.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
+
+    async def set_limit(self, limit: int):
+        async with self.condition:
+            self.limit = max(1, limit)
+            self.condition.notify_all()
+
+
+class MemoryMonitor:
+    def __init__(self, interval: float = MEMORY_MONITOR_INTERVAL):
+        self.interval = interval
+        self.level = NORMAL
+        # (action, shed(level) -> True if something was freed/lowered)
+        self.shedders: List[Tuple[str, Callable]] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def register(self, action: str, shed: Callable):
+        """shed(level) may be sync or async; it is called with NORMAL on recovery"""
+        self.shedders.append((action, shed))
+
+    def sample(self) -> Dict[str, float]:
+        usage = {}
+        for device, ratio in (("host", host_memory_ratio()), ("cuda", device_memory_ratio())):
+            if ratio is not None:
+                usage[device] = ratio
+                MEMORY_USED.labels(device=device).set(ratio)
+        return usage
+
+    def level_for(self, ratio: float) -> int:
+        if ratio >= MEMORY_CRITICAL_WATERMARK:
+            return CRITICAL
+        if ratio >= MEMORY_HIGH_WATERMARK:
+            return HIGH
+        # Hysteresis: stay shed until usage is clearly below the high watermark
+        if self.level > NORMAL and ratio >= MEMORY_LOW_WATERMARK:
+            return HIGH
+        return NORMAL
+
+    async def shed(self, level: int):
+        """Run all shedders for level (also used directly after an OOM)"""
+        for action, shed in self.shedders:
+            try:
+                result = shed(level)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                if result and level > NORMAL:
+                    SHED_ACTIONS.labels(action=action).inc()
+            except Exception as e:
+                logger.warning(f"Memory shedder {action} failed: {e}")
+
+    async def on_out_of_memory(self):
+        """An allocation already failed: shed everything until the next recovery"""
+        self.level = CRITICAL
+        MEMORY_PRESSURE.set(CRITICAL)
+        await self.shed(CRITICAL)
+
+    async def check(self) -> int:
+        usage = self.sample()
+        level = self.level_for(max(usage.values(), default=0.0))
+        if level != self.level:
+            logger.warning(f"Memory pressure level {self.level} -> {level} ({usage})")
+        if level > NORMAL or self.level > NORMAL:
+            await self.shed(level)
+        self.level = level
+        MEMORY_PRESSURE.set(level)
+        return level
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logger.warning(f"Memory monitor error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
@@ -0,0 +1,415 @@
+# ~/qwen-api/model_runtime.py
+"""
+torch/transformers side of the server: model loading and the decode call.
+
+api_server imports this module lazily (only in the process that loads a
+tokenizer or the model), so the HTTP, auth and admin layers start without
+paying for torch and transformers.
+"""
+import base64
+import copy
+import gc
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import (
+    AutoModelForCausalLM, AutoTokenizer, DynamicCache, LogitsProcessor, LogitsProcessorList, StoppingCriteria,
+    StoppingCriteriaList, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+)
+
+from completion_cache import truncate_at_stop
+from cpu_tuning import CPU_COMPILE, configure_cpu_runtime, cpu_load_dtype, optimize_cpu_model
+from lora_adapters import LORA_ADAPTER_DIR, LoRAAdapter, activate, attach_lora
+from paged_kv import PAGED_KV_CACHE
+from prefix_cache import PrefixKVCache
+from static_decode import STATIC_KV_CACHE, BucketedStaticDecoder
+
+logger = logging.getLogger(__name__)
+
+MODEL_CACHE_DIR = "/app/models"
+
+# Embedding batches: at most this many inputs and padded tokens per forward pass
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "16384"))
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """Stop as soon as any user supplied stop string appears in the output.
+
+    Only a tail window of new tokens is decoded per step, so the check stays
+    cheap no matter how long the completion gets. Rows of a batch (parallel
+    samples) stop independently.
+    """
+
+    def __init__(self, tokenizer, stop: List[str]):
+        self.tokenizer = tokenizer
+        self.stop = [s for s in stop if s]
+        # Taken from the first call, so left padding (static decoding) is covered
+        self.prompt_length = None
+        # Tokens can be shorter than one character, keep some slack
+        self.window = max((len(s) for s in self.stop), default=0) + 8
+        # row -> sequence length when its stop string appeared
+        self.stopped_at: Dict[int, int] = {}
+
+    @property
+    def triggered(self) -> bool:
+        return bool(self.stopped_at)
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[-1] - 1
+        if self.stop:
+            start = max(self.prompt_length, input_ids.shape[-1] - self.window)
+            for row in range(input_ids.shape[0]):
+                if row not in self.stopped_at:
+                    tail = self.tokenizer.decode(input_ids[row, start:], skip_special_tokens=True)
+                    if any(s in tail for s in self.stop):
+                        self.stopped_at[row] = input_ids.shape[-1]
+        stopped = [row in self.stopped_at for row in range(input_ids.shape[0])]
+        return torch.tensor(stopped, dtype=torch.bool, device=input_ids.device)
+
+
+class CancellationCriteria(StoppingCriteria):
+    """Abort the decode loop once the client has gone away"""
+
+    def __init__(self, cancel_event: threading.Event):
+        self.cancel_event = cancel_event
+
+    def __call__(self, input_ids, scores, **kwargs) -> torch.BoolTensor:
+        cancelled = self.cancel_event.is_set()
+        return torch.full((input_ids.shape[0],), cancelled, dtype=torch.bool, device=input_ids.device)
+
+
+class SeededSampling(LogitsProcessor):
+    """Sampling with one torch.Generator per row, for seeded requests.
+
+    torch.manual_seed would reseed the process-wide RNG that concurrent
+    generations draw from. Used with do_sample=False: the distribution is
+    warped and sampled here, and only the drawn token is left for argmax.
+    The drawn tokens' log-probabilities are kept, since generate's own
+    scores then carry none.
+    """
+
+    def __init__(self, generators: List[torch.Generator], temperature: float, top_p: float, top_k: Optional[int]):
+        self.generators = generators
+        self.warpers = LogitsProcessorList([TemperatureLogitsWarper(temperature)])
+        if top_k:
+            self.warpers.append(TopKLogitsWarper(top_k))
+        if top_p < 1.0:
+            self.warpers.append(TopPLogitsWarper(top_p))
+        self.logprobs: List[torch.Tensor] = []  # per step, one per row
+
+    def __call__(self, input_ids, scores) -> torch.FloatTensor:
+        logprobs = torch.log_softmax(self.warpers(input_ids, scores), dim=-1)
+        tokens = torch.cat([
+            torch.multinomial(logprobs[row].exp(), 1, generator=generator)
+            for row, generator in enumerate(self.generators)
+        ])
+        self.logprobs.append(logprobs.gather(1, tokens[:, None])[:, 0])
+        drawn = torch.full_like(scores, -float("inf"))
+        return drawn.scatter_(1, tokens[:, None], 0.0)
+
+
+def detect_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def pad_token_id(tokenizer) -> int:
+    if tokenizer.pad_token_id is not None:
+        return tokenizer.pad_token_id
+    return tokenizer.eos_token_id
+
+
+def is_out_of_memory(error: Exception) -> bool:
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    # CPU allocator failures are plain RuntimeErrors
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+def release_device_memory() -> bool:
+    """Return cached allocator blocks to the device, True on CUDA"""
+    gc.collect()
+    if not torch.cuda.is_available():
+        return False
+    torch.cuda.empty_cache()
+    return True
+
+
+def load_tokenizer(model_id: str, revision: str):
+    return AutoTokenizer.from_pretrained(
+        model_id,
+        revision=revision,
+        trust_remote_code=True,
+        cache_dir=MODEL_CACHE_DIR
+    )
+
+
+def load_model(model_id: str, revision: str, device: str, tokenizer) -> Tuple[object, Optional[BucketedStaticDecoder]]:
+    """Load the causal LM for device, returns (model, static decoder or None)"""
+    if device == "cpu":
+        return _load_cpu_model(model_id, revision, tokenizer)
+
+    # Load model with optimizations
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id,
+        device_map="auto",
+        torch_dtype=torch.bfloat16,
+        revision=revision,
+        trust_remote_code=True,
+        cache_dir=MODEL_CACHE_DIR,
+        low_cpu_mem_usage=True,
+        # flash_attention_2 does not work with a preallocated static cache or
+        # the per-sequence masks of the paged engine
+        attn_implementation="sdpa" if STATIC_KV_CACHE or PAGED_KV_CACHE else "flash_attention_2"
+    )
+
+    if LORA_ADAPTER_DIR:
+        # Adapter rows change every batch: no captured graphs, no compiled forward
+        attach_lora(model)
+        return model, None
+    if STATIC_KV_CACHE:
+        # Fixed shapes per bucket, so CUDA graphs can be captured
+        return model, BucketedStaticDecoder(model, pad_token_id(tokenizer), compile_mode="reduce-overhead")
+    if hasattr(torch, 'compile') and not PAGED_KV_CACHE:
+        # Compile model for faster inference (PyTorch 2.0+)
+        model = torch.compile(model)
+    return model, None
+
+
+def _load_cpu_model(model_id: str, revision: str, tokenizer):
+    """CPU execution mode: pinned threads, SDPA attention, bf16/int8 kernels"""
+    configure_cpu_runtime()
+    dtype = cpu_load_dtype()
+    logger.info(f"Loading model for CPU inference in {dtype}")
+
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id,
+        device_map="cpu",
+        torch_dtype=dtype,
+        revision=revision,
+        trust_remote_code=True,
+        cache_dir=MODEL_CACHE_DIR,
+        low_cpu_mem_usage=True,
+        attn_implementation="sdpa"
+    ).eval()
+    if STATIC_KV_CACHE:
+        # No faster than the dynamic-shape compile on CPU (static_decode.py)
+        logger.warning("STATIC_KV_CACHE is GPU-only, ignored in CPU mode")
+    model = optimize_cpu_model(model, compile_model=CPU_COMPILE and not (PAGED_KV_CACHE or LORA_ADAPTER_DIR))
+    if LORA_ADAPTER_DIR:
+        # After int8 quantization, the adapter deltas stay in float
+        attach_lora(model)
+    return model, None
+
+
+def generate_tokens(
+    model,
+    tokenizer,
+    device: str,
+    input_ids: List[int],
+    cancel_event: threading.Event,
+    max_tokens: int,
+    temperature: float,
+    top_p: float,
+    stop: List[str],
+    static_decoder: Optional[BucketedStaticDecoder] = None,
+    prefix_cache: Optional[PrefixKVCache] = None,
+    eos_token_ids: Optional[List[int]] = None,
+    samples: int = 1,
+    seed: Optional[int] = None,
+    adapter: Optional[LoRAAdapter] = None
+) -> Dict:
+    """Blocking decode of one tokenized prompt, run in a worker thread.
+
+    With prefix_cache (dynamic-cache path only) the prompt starts from the
+    KV state of the longest cached common prefix and is stored afterwards.
+
+    Returns text, token_ids (generated), generated_tokens, stopped
+    ("disconnect", "stop_sequence" or None), finish_reason and
+    prefix_tokens_reused. With samples > 1 the prompt is prefilled once and
+    the samples decode together as one batch (dynamic-cache path; the static
+    decoder runs them one after another); the result is {"choices": [...],
+    "prefix_tokens_reused"} and each choice carries its cumulative logprob.
+    With seed, sample i draws from its own generator seeded with seed + i.
+    adapter (a resident LoRA adapter) is applied on top of the base weights.
+    """
+    input_tensor = torch.tensor([input_ids], device=device)
+    adapter_name = adapter.name if adapter is not None else None
+    seeds = [seed + index for index in range(samples)] if seed is not None else None
+
+    with activate([adapter]):
+        reused = 0
+        final_cache = None
+        if static_decoder is not None:
+            choices = []
+            for index in range(samples):
+                choice, _ = _decode(
+                    model, tokenizer, device, input_tensor, cancel_event, max_tokens, temperature, top_p, stop,
+                    static_decoder, None, eos_token_ids, seeds[index:index + 1] if seeds else None,
+                    dict_output=False, scores=False
+                )
+                choices += choice
+                if cancel_event.is_set():
+                    break
+        else:
+            prompt_cache = None
+            if prefix_cache is not None:
+                prompt_cache, reused = prefix_cache.lookup(input_tensor[0], adapter_name)
+            if samples > 1:
+                # Prompt prefilled once, every sample continues from its KV state in one batch
+                prompt_cache = prefill_prompt(model, input_tensor, prompt_cache)
+                prompt_cache.batch_repeat_interleave(samples)
+            choices, final_cache = _decode(
+                model, tokenizer, device, input_tensor.repeat(samples, 1), cancel_event, max_tokens, temperature,
+                top_p, stop, None, prompt_cache, eos_token_ids, seeds,
+                dict_output=prefix_cache is not None or samples > 1, scores=samples > 1
+            )
+
+    if prefix_cache is not None and final_cache is not None and not cancel_event.is_set():
+        if samples > 1:
+            final_cache.batch_select_indices(torch.tensor([0], device=input_tensor.device))
+        prefix_cache.store(input_tensor[0], final_cache, adapter_name)
+
+    if samples == 1:
+        return dict(choices[0], prefix_tokens_reused=reused)
+    return {"choices": choices, "prefix_tokens_reused": reused}
+
+
+def prefill_prompt(model, input_tensor: torch.Tensor, cache=None):
+    """KV state of all prompt tokens but the last (generate needs its logits)"""
+    cache = cache if cache is not None else DynamicCache(config=model.config)
+    start = cache.get_seq_length()
+    if input_tensor.shape[-1] - 1 > start:
+        with torch.inference_mode():
+            model(input_ids=input_tensor[:, start:-1], past_key_values=cache, use_cache=True)
+    return cache
+
+
+def _decode(model, tokenizer, device, input_tensor, cancel_event, max_tokens, temperature, top_p, stop,
+            static_decoder, past_key_values, eos_token_ids, seeds: Optional[List[int]], dict_output: bool,
+            scores: bool) -> Tuple[List[Dict], object]:
+    """One completion per row of input_tensor, returns (choice dicts, final KV cache or None)"""
+    inputs = {"input_ids": input_tensor, "attention_mask": torch.ones_like(input_tensor)}
+    prompt_length = input_tensor.shape[-1]
+    eos_token_ids = eos_token_ids or [tokenizer.eos_token_id]
+
+    stop_criteria = StopSequenceCriteria(tokenizer, stop)
+    criteria = StoppingCriteriaList([stop_criteria, CancellationCriteria(cancel_event)])
+
+    sampling = {"temperature": temperature, "top_p": top_p, "do_sample": temperature > 0}
+    sampler = None
+    if seeds is not None and temperature > 0:
+        generators = [torch.Generator(device=input_tensor.device).manual_seed(seed) for seed in seeds]
+        sampler = SeededSampling(generators, temperature, top_p, model.generation_config.top_k)
+        sampling = {"do_sample": False, "logits_processor": LogitsProcessorList([sampler])}
+
+    if static_decoder is not None:
+        generate = lambda **kw: static_decoder.generate(inputs, **kw)
+    elif dict_output:
+        if past_key_values is not None:
+            inputs["past_key_values"] = past_key_values
+        generate = lambda **kw: model.generate(
+            **inputs, return_dict_in_generate=True, output_scores=scores and sampler is None, **kw
+        )
+    else:
+        generate = lambda **kw: model.generate(**inputs, **kw)
+
+    # Autocast only matters for CUDA; CPU weights are already in their target dtype
+    with torch.inference_mode(), torch.autocast(device_type=device, enabled=device == "cuda"):
+        outputs = generate(
+            stopping_criteria=criteria,
+            pad_token_id=tokenizer.eos_token_id,
+            eos_token_id=eos_token_ids,
+            max_new_tokens=max_tokens,
+            **sampling
+        )
+
+    final_cache, transition = None, None
+    if dict_output:
+        if scores and sampler is None:
+            # Log-probabilities under the distribution each token was drawn from
+            transition = model.compute_transition_scores(outputs.sequences, outputs.scores, normalize_logits=True)
+        final_cache = outputs.past_key_values
+        outputs = outputs.sequences
+    if sampler is not None and scores:
+        transition = torch.stack(sampler.logprobs, dim=1)
+
+    stopped = "disconnect" if cancel_event.is_set() else None
+    choices = []
+    for row in range(outputs.shape[0]):
+        token_ids = outputs[row, prompt_length:].tolist()
+        # Rows that finished early are padded (with EOS) to the longest one
+        if row in stop_criteria.stopped_at:
+            token_ids = token_ids[:stop_criteria.stopped_at[row] - prompt_length]
+        else:
+            ends = [i for i, token in enumerate(token_ids) if token in eos_token_ids]
+            token_ids = token_ids[:ends[0] + 1] if ends else token_ids
+        row_stopped = stopped or ("stop_sequence" if row in stop_criteria.stopped_at else None)
+        generated_tokens = len(token_ids)
+        text = tokenizer.decode(token_ids, skip_special_tokens=True)
+        choices.append({
+            "text": truncate_at_stop(text, stop),
+            "token_ids": token_ids,
+            "generated_tokens": generated_tokens,
+            "stopped": row_stopped,
+            "finish_reason": "length" if row_stopped is None and generated_tokens >= max_tokens else "stop",
+            "logprob": float(transition[row, :generated_tokens].sum()) if transition is not None else None
+        })
+    return choices, final_cache
+
+
+def embedding_batches(lengths: List[int]) -> List[List[int]]:
+    """Group input indices by length so each batch pads as little as possible"""
+    batches, batch = [], []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted ascending, so the new input sets the padded width
+        width = max(lengths[index], 1)
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or (len(batch) + 1) * width > EMBEDDING_BATCH_TOKENS):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_tokens(model, device: str, token_lists: List[List[int]], pad_token_id: int, pooling: str = "mean") -> List[str]:
+    """Pooled, L2-normalized hidden states for tokenized inputs.
+
+    Runs the decoder stack only (no LM head, no generation), in
+    length-sorted batches. Returns base64 little-endian float32 vectors in
+    input order.
+    """
+    # Qwen2ForCausalLM.model is the transformer without the vocab projection
+    backbone = model.model
+    vectors: List[Optional[str]] = [None] * len(token_lists)
+
+    for batch in embedding_batches([len(ids) for ids in token_lists]):
+        lengths = [len(token_lists[i]) for i in batch]
+        width = max(lengths)
+        input_ids = torch.full((len(batch), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        for row, (index, length) in enumerate(zip(batch, lengths)):
+            input_ids[row, :length] = torch.tensor(token_lists[index])
+            attention_mask[row, :length] = 1
+        input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+
+        with torch.inference_mode(), torch.autocast(device_type=device, enabled=device == "cuda"):
+            hidden = backbone(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state.float()
+
+        if pooling == "last":
+            pooled = hidden[torch.arange(len(batch), device=hidden.device), attention_mask.sum(dim=1) - 1]
+        else:
+            mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        pooled = torch.nn.functional.normalize(pooled, dim=-1).cpu().numpy().astype("<f4")
+
+        for row, index in enumerate(batch):
+            vectors[index] = base64.b64encode(pooled[row].tobytes()).decode()
+
+    return vectors
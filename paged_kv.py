@@ -0,0 +1,253 @@
+# ~/qwen-api/paged_kv.py
+"""
+Paged KV cache: fixed-size blocks drawn from one preallocated pool.
+
+HF generate keeps one contiguous K/V tensor per request that grows by
+concatenation, so memory is reserved per request and only comes back when
+the request ends. Here every sequence owns a block table that maps its token
+positions to KV_BLOCK_SIZE-token blocks of a shared pool. Memory is committed
+one block at a time, any freed block can be reused by any sequence, and at
+most one partly filled block per sequence is wasted.
+
+Blocks are reference counted. Forked sequences (parallel samples) and cached
+prompt prefixes share blocks; a shared block is copied before it is written.
+"""
+import logging
+import os
+from collections import deque
+from typing import List, Optional
+
+import torch
+from prometheus_client import Counter, Gauge
+from transformers.cache_utils import Cache
+
+logger = logging.getLogger(__name__)
+
+PAGED_KV_CACHE = os.getenv("PAGED_KV_CACHE", "0") == "1"
+KV_BLOCK_SIZE = int(os.getenv("KV_BLOCK_SIZE", "16"))
+# Size of the preallocated pool (per process, all layers, keys and values)
+KV_CACHE_MEMORY_GB = float(os.getenv("KV_CACHE_MEMORY_GB", "1"))
+
+KV_BLOCKS_TOTAL = Gauge('qwen_kv_blocks_total', 'Blocks in the paged KV pool', multiprocess_mode='max')
+KV_BLOCKS_USED = Gauge('qwen_kv_blocks_used', 'Paged KV blocks referenced by sequences or the prefix index', multiprocess_mode='max')
+KV_BLOCK_COPIES = Counter('qwen_kv_block_copies_total', 'Shared KV blocks copied before a write (copy-on-write)')
+
+
+class OutOfBlocks(Exception):
+    """The pool has no free block left"""
+
+
+class BlockAllocator:
+    """Free list and reference counts of the pool blocks"""
+
+    def __init__(self, num_blocks: int):
+        self.num_blocks = num_blocks
+        self.free_blocks = deque(range(num_blocks))
+        self.refs = [0] * num_blocks
+        KV_BLOCKS_TOTAL.set(num_blocks)
+
+    @property
+    def num_free(self) -> int:
+        return len(self.free_blocks)
+
+    def allocate(self) -> int:
+        if not self.free_blocks:
+            raise OutOfBlocks()
+        block = self.free_blocks.popleft()
+        self.refs[block] = 1
+        KV_BLOCKS_USED.set(self.num_blocks - self.num_free)
+        return block
+
+    def share(self, block: int) -> int:
+        self.refs[block] += 1
+        return block
+
+    def release(self, block: int) -> bool:
+        """Drop one reference, True if the block went back to the free list"""
+        self.refs[block] -= 1
+        if self.refs[block] > 0:
+            return False
+        self.free_blocks.append(block)
+        KV_BLOCKS_USED.set(self.num_blocks - self.num_free)
+        return True
+
+
+class BlockTable:
+    """Blocks of one sequence, in position order, and how many positions hold KV"""
+
+    def __init__(self, blocks: Optional[List[int]] = None, length: int = 0):
+        self.blocks = blocks or []
+        self.length = length
+
+
+def kv_bytes_per_token(config, dtype: torch.dtype) -> int:
+    """Keys and values of one token over all layers"""
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    itemsize = torch.empty((), dtype=dtype).element_size()
+    return 2 * config.num_hidden_layers * config.num_key_value_heads * head_dim * itemsize
+
+
+class PagedKVPool:
+    def __init__(self, model, num_blocks: int, block_size: int = KV_BLOCK_SIZE):
+        config = model.config
+        self.block_size = block_size
+        self.kv_heads = config.num_key_value_heads
+        self.head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        self.allocator = BlockAllocator(num_blocks)
+
+        param = next(model.parameters())
+        dtype = param.dtype if param.dtype.is_floating_point else torch.float32
+        # Layers may be spread over several GPUs (device_map="auto"), keep each layer's KV next to it
+        devices = [layer.self_attn.k_proj.weight.device for layer in model.model.layers]
+        shape = (num_blocks * block_size, self.kv_heads, self.head_dim)
+        # Flat per layer: row block * block_size + offset holds one position
+        self.keys = [torch.zeros(shape, dtype=dtype, device=device) for device in devices]
+        self.values = [torch.zeros(shape, dtype=dtype, device=device) for device in devices]
+        self.bytes_per_block = kv_bytes_per_token(config, dtype) * block_size
+        logger.info(
+            f"Paged KV pool: {num_blocks} blocks of {block_size} tokens "
+            f"({num_blocks * self.bytes_per_block / 2**30:.2f} GiB)"
+        )
+
+    @classmethod
+    def for_memory(cls, model, memory_gb: float = KV_CACHE_MEMORY_GB, block_size: int = KV_BLOCK_SIZE) -> "PagedKVPool":
+        param = next(model.parameters())
+        dtype = param.dtype if param.dtype.is_floating_point else torch.float32
+        block_bytes = kv_bytes_per_token(model.config, dtype) * block_size
+        return cls(model, max(1, int(memory_gb * 2**30 // block_bytes)), block_size)
+
+    @property
+    def num_free(self) -> int:
+        return self.allocator.num_free
+
+    def blocks_for(self, tokens: int) -> int:
+        return -(-tokens // self.block_size)
+
+    def fork(self, table: BlockTable, length: Optional[int] = None) -> BlockTable:
+        """New table sharing the blocks that cover the first length positions"""
+        length = table.length if length is None else length
+        blocks = [self.allocator.share(b) for b in table.blocks[:self.blocks_for(length)]]
+        return BlockTable(blocks, length)
+
+    def free(self, table: BlockTable):
+        for block in table.blocks:
+            self.allocator.release(block)
+        table.blocks, table.length = [], 0
+
+    def blocks_needed(self, table: BlockTable, new_tokens: int) -> int:
+        """Free blocks reserve(table, new_tokens) would take"""
+        needed = max(self.blocks_for(table.length + new_tokens) - len(table.blocks), 0)
+        if self._shared_tail(table) is not None:
+            needed += 1  # the shared, partly filled block gets copied
+        return needed
+
+    def _shared_tail(self, table: BlockTable) -> Optional[int]:
+        """Index of the partly filled block the next position goes to, if other tables share it"""
+        index = table.length // self.block_size
+        if table.length % self.block_size and self.allocator.refs[table.blocks[index]] > 1:
+            return index
+        return None
+
+    def reserve(self, table: BlockTable, new_tokens: int):
+        """Make room for new_tokens positions after table.length (all or nothing)"""
+        if self.blocks_needed(table, new_tokens) > self.num_free:
+            raise OutOfBlocks()
+        index = self._shared_tail(table)
+        if index is not None:
+            self._copy_on_write(table, index)
+        while len(table.blocks) < self.blocks_for(table.length + new_tokens):
+            table.blocks.append(self.allocator.allocate())
+
+    def _copy_on_write(self, table: BlockTable, index: int):
+        shared = table.blocks[index]
+        block = self.allocator.allocate()
+        src = slice(shared * self.block_size, (shared + 1) * self.block_size)
+        dst = slice(block * self.block_size, (block + 1) * self.block_size)
+        for keys, values in zip(self.keys, self.values):
+            keys[dst] = keys[src]
+            values[dst] = values[src]
+        self.allocator.release(shared)
+        table.blocks[index] = block
+        KV_BLOCK_COPIES.inc()
+
+    def read_block(self, block: int, out: torch.Tensor):
+        """Copy the K/V of one block, all layers, into out [layers, 2, block_size, kv_heads, head_dim]"""
+        rows = slice(block * self.block_size, (block + 1) * self.block_size)
+        for layer, (keys, values) in enumerate(zip(self.keys, self.values)):
+            out[layer, 0].copy_(keys[rows])
+            out[layer, 1].copy_(values[rows])
+
+    def write_block(self, block: int, data: torch.Tensor):
+        """Inverse of read_block"""
+        rows = slice(block * self.block_size, (block + 1) * self.block_size)
+        for layer, (keys, values) in enumerate(zip(self.keys, self.values)):
+            keys[rows].copy_(data[layer, 0])
+            values[rows].copy_(data[layer, 1])
+
+    def slots(self, table: BlockTable, start: int, end: int) -> torch.Tensor:
+        """Flat pool rows of positions start..end-1"""
+        positions = torch.arange(start, end)
+        blocks = torch.tensor(table.blocks, dtype=torch.long)[positions // self.block_size]
+        return blocks * self.block_size + positions % self.block_size
+
+
+class PagedCache(Cache):
+    """Cache view for one forward pass over a batch of sequences.
+
+    Row i feeds query_lengths[i] new tokens (right padded to the longest) on
+    top of tables[i].length cached positions. update() writes the new K/V
+    into the pool and returns each row's full K/V, right padded;
+    attention_mask() masks padding and enforces causality per row.
+    Call commit() after the forward pass.
+    """
+
+    def __init__(self, pool: PagedKVPool, tables: List[BlockTable], query_lengths: List[int]):
+        super().__init__(layers=[])
+        self.pool = pool
+        self.tables = tables
+        self.query_lengths = query_lengths
+        self.past_lengths = [t.length for t in tables]
+        self.width = max(p + q for p, q in zip(self.past_lengths, query_lengths))
+        query_width = max(query_lengths)
+
+        # Padded key positions read row 0 of the pool, the mask hides them
+        read = torch.zeros((len(tables), self.width), dtype=torch.long)
+        for row, (table, q) in enumerate(zip(tables, query_lengths)):
+            read[row, :table.length + q] = pool.slots(table, 0, table.length + q)
+        self.read_slots = read
+        self.write_slots = torch.cat([
+            pool.slots(table, table.length, table.length + q) for table, q in zip(tables, query_lengths)
+        ])
+        self.query_valid = torch.arange(query_width)[None, :] < torch.tensor(query_lengths)[:, None]
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int, *args, **kwargs):
+        keys, values = self.pool.keys[layer_idx], self.pool.values[layer_idx]
+        device = keys.device
+        valid = self.query_valid.to(device)
+        write = self.write_slots.to(device)
+        # [batch, heads, query, dim] -> [batch, query, heads, dim], valid positions only
+        keys[write] = key_states.transpose(1, 2)[valid].to(keys.dtype)
+        values[write] = value_states.transpose(1, 2)[valid].to(values.dtype)
+        read = self.read_slots.to(device)
+        return keys[read].transpose(1, 2), values[read].transpose(1, 2)
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        return max(self.past_lengths)
+
+    def get_mask_sizes(self, query_length: int, layer_idx: int = 0):
+        return self.width, 0
+
+    def position_ids(self) -> torch.Tensor:
+        query_width = max(self.query_lengths)
+        return torch.tensor(self.past_lengths)[:, None] + torch.arange(query_width)[None, :]
+
+    def attention_mask(self) -> torch.Tensor:
+        """[batch, 1, query, key] boolean mask, True where attention is allowed"""
+        keys = torch.arange(self.width)[None, None, :]
+        positions = self.position_ids()[:, :, None]
+        lengths = torch.tensor([p + q for p, q in zip(self.past_lengths, self.query_lengths)])[:, None, None]
+        return ((keys <= positions) & (keys < lengths))[:, None]
+
+    def commit(self):
+        for table, q in zip(self.tables, self.query_lengths):
+            table.length += q
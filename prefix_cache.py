@@ -0,0 +1,107 @@
+# ~/qwen-api/prefix_cache.py
+"""
+Reuse of prompt KV state across requests that share a token prefix.
+
+Autocomplete requests for the same file repeat most of the file context:
+the FIM prompt starts with the code before the cursor, which only changes
+near its end while the user types. The KV cache of a finished prompt is
+kept in a small LRU; a new prompt starts from a copy of the entry with the
+longest common token prefix, so only the changed tail is prefilled.
+Entries are per LoRA adapter, whose keys and values differ from the base
+model's for the same tokens.
+"""
+import copy
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import torch
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+PREFIX_CACHE_ENTRIES = int(os.getenv("PREFIX_CACHE_ENTRIES", "16"))
+# Shorter matches are not worth the copy
+PREFIX_CACHE_MIN_TOKENS = int(os.getenv("PREFIX_CACHE_MIN_TOKENS", "64"))
+
+PREFIX_TOKENS_REUSED = Counter('qwen_prefix_cache_reused_tokens_total', 'Prompt tokens served from cached KV state')
+PREFIX_LOOKUPS = Counter('qwen_prefix_cache_lookups_total', 'Prefix cache lookups', ['result'])
+
+
+def common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    n = min(a.shape[-1], b.shape[-1])
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+def crop_cache(cache, length: int):
+    """Drop cached positions beyond length (in place)"""
+    extra = cache.get_seq_length() - length
+    if extra > 0:
+        cache.crop(-extra)
+    return cache
+
+
+class PrefixKVCache:
+    def __init__(self, max_entries: int = PREFIX_CACHE_ENTRIES, min_tokens: int = PREFIX_CACHE_MIN_TOKENS):
+        self.max_entries = max_entries
+        self.min_tokens = min_tokens
+        # id -> (prompt token ids, KV cache covering them, adapter name or None)
+        self.entries: "OrderedDict[int, Tuple[torch.Tensor, object, Optional[str]]]" = OrderedDict()
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lookup(self, input_ids: torch.Tensor, adapter: Optional[str] = None) -> Tuple[Optional[object], int]:
+        """Private copy of the best matching KV cache and the number of tokens it covers.
+
+        At least the last prompt token is always left to prefill, generate
+        needs its logits.
+        """
+        input_ids = input_ids.cpu()
+        with self.lock:
+            best_id, best_length = None, 0
+            for entry_id, (tokens, _, entry_adapter) in self.entries.items():
+                if entry_adapter != adapter:
+                    continue
+                length = common_prefix_length(tokens, input_ids)
+                if length > best_length:
+                    best_id, best_length = entry_id, length
+            best_length = min(best_length, input_ids.shape[-1] - 1)
+            if best_id is None or best_length < self.min_tokens:
+                PREFIX_LOOKUPS.labels(result="miss").inc()
+                return None, 0
+            self.entries.move_to_end(best_id)
+            cache = copy.deepcopy(self.entries[best_id][1])
+
+        PREFIX_LOOKUPS.labels(result="hit").inc()
+        PREFIX_TOKENS_REUSED.inc(best_length)
+        return crop_cache(cache, best_length), best_length
+
+    def store(self, input_ids: torch.Tensor, cache, adapter: Optional[str] = None):
+        """Keep the KV state of a prompt (cache may extend past it, it is cropped)"""
+        input_ids = input_ids.cpu()
+        if input_ids.shape[-1] < self.min_tokens:
+            return
+        crop_cache(cache, input_ids.shape[-1])
+        with self.lock:
+            # An entry that is a prefix of the new prompt adds nothing
+            for entry_id, (tokens, _, entry_adapter) in list(self.entries.items()):
+                if entry_adapter == adapter and common_prefix_length(tokens, input_ids) == tokens.shape[-1]:
+                    del self.entries[entry_id]
+            self.entries[self.next_id] = (input_ids, cache, adapter)
+            self.next_id += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def trim(self, keep: int) -> bool:
+        """Drop all but the keep most recently used entries, True if any were dropped"""
+        with self.lock:
+            dropped = len(self.entries) > keep
+            while len(self.entries) > keep:
+                self.entries.popitem(last=False)
+            return dropped
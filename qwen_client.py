@@ -0,0 +1,377 @@
+# ~/qwen-api/qwen_client.py
+"""
+Python client for the Qwen API, blocking (QwenClient) and asyncio
+(AsyncQwenClient), instead of a requests.post per call as in test_api.py.
+
+    with QwenClient("https://your-domain.com", api_key) as client:
+        print(client.generate("Write a factorial function")["response"])
+
+    async with AsyncQwenClient() as client:           # QWEN_API_URL, QWEN_API_KEY
+        async for text in client.chat_stream([{"role": "user", "content": "Hi"}]):
+            print(text, end="")
+
+A client keeps a pool of keep-alive connections (HTTP/2 when the h2
+package is installed), so the TLS handshake is paid once per connection,
+not per request; share one client between threads or tasks. 429, 502, 503
+and 504 answers and failed connects are retried, after Retry-After when
+the server sends one (rate limit, memory shedding), else after an
+exponential backoff with jitter.
+
+Bulk prompts: generate_batch() sends them to /v1/batch/generate, up to
+MAX_BATCH per request. Batcher does the same for generate() calls made
+concurrently from many tasks, collecting them for a few milliseconds.
+
+chat_stream() reads server-sent events ("data: {...}" lines up to
+"data: [DONE]", OpenAI chunk format); a server answering with a plain JSON
+completion gives a single chunk.
+"""
+import asyncio
+import email.utils
+import importlib.util
+import json
+import os
+import random
+import time
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Union
+
+import httpx
+
+QWEN_API_URL = os.getenv("QWEN_API_URL", "http://localhost:8000")
+QWEN_API_KEY = os.getenv("QWEN_API_KEY", "")
+CLIENT_MAX_CONNECTIONS = int(os.getenv("QWEN_CLIENT_MAX_CONNECTIONS", "20"))
+CLIENT_TIMEOUT = float(os.getenv("QWEN_CLIENT_TIMEOUT", "600"))
+CLIENT_MAX_RETRIES = int(os.getenv("QWEN_CLIENT_MAX_RETRIES", "4"))
+# Longest wait before a retry, Retry-After included
+CLIENT_MAX_RETRY_WAIT = float(os.getenv("QWEN_CLIENT_MAX_RETRY_WAIT", "60"))
+# Prompts per /v1/batch/generate request: at most the server's MAX_BATCH_REQUESTS
+# and the key's rate-limit burst (bigger batches get a 400)
+MAX_BATCH = int(os.getenv("QWEN_CLIENT_MAX_BATCH", "64"))
+
+HTTP2 = importlib.util.find_spec("h2") is not None
+RETRY_STATUSES = {429, 502, 503, 504}
+# Raised before the request reached the server (or on a pooled connection it had closed)
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+BACKOFF_BASE = 0.5
+
+
+class QwenAPIError(Exception):
+    def __init__(self, status_code: int, detail):
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+def retry_after(response: httpx.Response) -> Optional[float]:
+    """Seconds asked for by a Retry-After header (delay or HTTP date), None without one"""
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def raise_for_error(response: httpx.Response):
+    if response.status_code < 400:
+        return
+    try:
+        detail = response.json().get("detail", response.text)
+    except ValueError:
+        detail = response.text
+    raise QwenAPIError(response.status_code, detail)
+
+
+class SSEDecoder:
+    """Server-sent event lines in, the data of each complete event out"""
+
+    def __init__(self):
+        self.data: List[str] = []
+
+    def feed(self, line: str) -> Optional[str]:
+        if line:
+            if line.startswith("data:"):
+                self.data.append(line[5:].lstrip(" "))
+            return None
+        event, self.data = "\n".join(self.data), []
+        return event or None
+
+
+def chunk_text(event: str) -> str:
+    """Text of an OpenAI-style stream chunk (delta) or full completion (message/text)"""
+    choice = (json.loads(event).get("choices") or [{}])[0]
+    return (choice.get("delta") or choice.get("message") or {}).get("content") or choice.get("text") or ""
+
+
+class _ClientBase:
+    def __init__(self, base_url: Optional[str], api_key: Optional[str], max_retries: int):
+        self.base_url = (base_url or QWEN_API_URL).rstrip("/")
+        self.headers = {"Authorization": f"Bearer {api_key or QWEN_API_KEY}"}
+        self.max_retries = max_retries
+
+    def client_options(self, max_connections: int, timeout: float, **options) -> Dict:
+        return {
+            "base_url": self.base_url,
+            "headers": self.headers,
+            "http2": HTTP2,
+            "limits": httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            "timeout": httpx.Timeout(timeout, connect=10.0),
+            **options,
+        }
+
+    def retry_delay(self, attempt: int, response: Optional[httpx.Response]) -> Optional[float]:
+        """Wait before retry number attempt + 1, None to give up"""
+        if attempt >= self.max_retries:
+            return None
+        if response is not None:
+            if response.status_code not in RETRY_STATUSES:
+                return None
+            asked = retry_after(response)
+            if asked is not None:
+                return min(asked, CLIENT_MAX_RETRY_WAIT)
+        return min(BACKOFF_BASE * 2 ** attempt, CLIENT_MAX_RETRY_WAIT) * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def batch_body(prompts: Iterable[Union[str, Dict]], options: Dict) -> List[Dict]:
+        return [{**options, **(p if isinstance(p, dict) else {"prompt": p})} for p in prompts]
+
+
+class QwenClient(_ClientBase):
+    """Blocking client, safe to share between threads"""
+
+    def __init__(self, base_url: Optional[str] = None, api_key: Optional[str] = None, *,
+                 max_connections: int = CLIENT_MAX_CONNECTIONS, timeout: float = CLIENT_TIMEOUT,
+                 max_retries: int = CLIENT_MAX_RETRIES, **httpx_options):
+        super().__init__(base_url, api_key, max_retries)
+        self.http = httpx.Client(**self.client_options(max_connections, timeout, **httpx_options))
+
+    def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = self.http.request(method, path, **kwargs)
+            except RETRY_ERRORS:
+                delay = self.retry_delay(attempt, None)
+                if delay is None:
+                    raise
+            else:
+                delay = self.retry_delay(attempt, response) if response.status_code >= 400 else None
+                if delay is None:
+                    raise_for_error(response)
+                    return response
+            time.sleep(delay)
+            attempt += 1
+
+    def post(self, path: str, body: Dict) -> Dict:
+        return self.request("POST", path, json=body).json()
+
+    def generate(self, prompt: str, **options) -> Dict:
+        return self.post("/v1/generate", {"prompt": prompt, **options})
+
+    def generate_batch(self, prompts: Iterable[Union[str, Dict]], **options) -> List[Dict]:
+        """/v1/batch/generate results in prompt order; failed prompts have status and error"""
+        items = self.batch_body(prompts, options)
+        results = []
+        for start in range(0, len(items), MAX_BATCH):
+            results += self.post("/v1/batch/generate", {"requests": items[start:start + MAX_BATCH]})["results"]
+        return results
+
+    def chat(self, messages: List[Dict], **options) -> Dict:
+        return self.post("/v1/chat/completions", {"messages": messages, **options})
+
+    def chat_stream(self, messages: List[Dict], **options) -> Iterator[str]:
+        """Completion text as it arrives"""
+        body = {"messages": messages, "stream": True, **options}
+        attempt = 0
+        while True:
+            with self.http.stream("POST", "/v1/chat/completions", json=body) as response:
+                delay = self.retry_delay(attempt, response) if response.status_code >= 400 else None
+                if delay is None:
+                    if response.status_code >= 400:
+                        response.read()
+                        raise_for_error(response)
+                    if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                        yield chunk_text(response.read())
+                        return
+                    decoder = SSEDecoder()
+                    for line in response.iter_lines():
+                        event = decoder.feed(line)
+                        if event == "[DONE]":
+                            return
+                        if event:
+                            yield chunk_text(event)
+                    return
+            time.sleep(delay)
+            attempt += 1
+
+    def complete(self, prefix: str, suffix: str = "", **options) -> Dict:
+        return self.post("/v1/completions", {"prefix": prefix, "suffix": suffix, **options})
+
+    def embed(self, input: Union[str, List[str]], **options) -> Dict:
+        return self.post("/v1/embeddings", {"input": input, **options})
+
+    def health(self) -> Dict:
+        return self.request("GET", "/health").json()
+
+    def close(self):
+        self.http.close()
+
+    def __enter__(self) -> "QwenClient":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncQwenClient(_ClientBase):
+    """asyncio client, one per event loop"""
+
+    def __init__(self, base_url: Optional[str] = None, api_key: Optional[str] = None, *,
+                 max_connections: int = CLIENT_MAX_CONNECTIONS, timeout: float = CLIENT_TIMEOUT,
+                 max_retries: int = CLIENT_MAX_RETRIES, **httpx_options):
+        super().__init__(base_url, api_key, max_retries)
+        self.http = httpx.AsyncClient(**self.client_options(max_connections, timeout, **httpx_options))
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = await self.http.request(method, path, **kwargs)
+            except RETRY_ERRORS:
+                delay = self.retry_delay(attempt, None)
+                if delay is None:
+                    raise
+            else:
+                delay = self.retry_delay(attempt, response) if response.status_code >= 400 else None
+                if delay is None:
+                    raise_for_error(response)
+                    return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def post(self, path: str, body: Dict) -> Dict:
+        return (await self.request("POST", path, json=body)).json()
+
+    async def generate(self, prompt: str, **options) -> Dict:
+        return await self.post("/v1/generate", {"prompt": prompt, **options})
+
+    async def generate_batch(self, prompts: Iterable[Union[str, Dict]], **options) -> List[Dict]:
+        """/v1/batch/generate results in prompt order; failed prompts have status and error.
+
+        Requests of MAX_BATCH prompts each, sent concurrently.
+        """
+        items = self.batch_body(prompts, options)
+        replies = await asyncio.gather(*(
+            self.post("/v1/batch/generate", {"requests": items[start:start + MAX_BATCH]})
+            for start in range(0, len(items), MAX_BATCH)
+        ))
+        return [result for reply in replies for result in reply["results"]]
+
+    async def chat(self, messages: List[Dict], **options) -> Dict:
+        return await self.post("/v1/chat/completions", {"messages": messages, **options})
+
+    async def chat_stream(self, messages: List[Dict], **options) -> AsyncIterator[str]:
+        """Completion text as it arrives"""
+        body = {"messages": messages, "stream": True, **options}
+        attempt = 0
+        while True:
+            async with self.http.stream("POST", "/v1/chat/completions", json=body) as response:
+                delay = self.retry_delay(attempt, response) if response.status_code >= 400 else None
+                if delay is None:
+                    if response.status_code >= 400:
+                        await response.aread()
+                        raise_for_error(response)
+                    if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                        yield chunk_text(await response.aread())
+                        return
+                    decoder = SSEDecoder()
+                    async for line in response.aiter_lines():
+                        event = decoder.feed(line)
+                        if event == "[DONE]":
+                            return
+                        if event:
+                            yield chunk_text(event)
+                    return
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def complete(self, prefix: str, suffix: str = "", **options) -> Dict:
+        return await self.post("/v1/completions", {"prefix": prefix, "suffix": suffix, **options})
+
+    async def embed(self, input: Union[str, List[str]], **options) -> Dict:
+        return await self.post("/v1/embeddings", {"input": input, **options})
+
+    async def health(self) -> Dict:
+        return (await self.request("GET", "/health")).json()
+
+    async def close(self):
+        await self.http.aclose()
+
+    async def __aenter__(self) -> "AsyncQwenClient":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class Batcher:
+    """generate() calls from concurrent tasks, sent together through /v1/batch/generate.
+
+    A batch goes out when it has max_batch prompts or max_delay seconds
+    after its first one. Each call gets its own result, or QwenAPIError for
+    its prompt alone.
+    """
+
+    def __init__(self, client: AsyncQwenClient, max_batch: int = MAX_BATCH, max_delay: float = 0.01):
+        self.client = client
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending: List = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.sending = set()
+
+    async def generate(self, prompt: str, **options) -> Dict:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(({"prompt": prompt, **options}, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.create_task(self._send(batch))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+
+    async def _send(self, batch: List):
+        try:
+            reply = await self.client.post("/v1/batch/generate", {"requests": [item for item, _ in batch]})
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, reply["results"]):
+            if future.done():
+                continue
+            if "error" in result:
+                future.set_exception(QwenAPIError(result.get("status", 500), result["error"]))
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        """Send what is pending and wait for the batches in flight"""
+        self.flush()
+        if self.sending:
+            await asyncio.gather(*self.sending, return_exceptions=True)
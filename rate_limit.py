@@ -0,0 +1,129 @@
+# ~/qwen-api/rate_limit.py
+"""
+Distributed token-bucket rate limiter in Redis.
+
+Buckets are keyed by authenticated user and tier, so limits hold per client
+and across all workers and replicas. Each check is a single atomic Lua
+script call (one round trip) using the Redis server clock.
+"""
+import logging
+import math
+import os
+import re
+from typing import Awaitable, Callable, Dict, Tuple
+
+from fastapi import HTTPException, Request, status
+
+logger = logging.getLogger(__name__)
+
+# tier=requests/period pairs, period one of second, minute, hour, day
+RATE_LIMITS = os.getenv(
+    "RATE_LIMITS",
+    "standard=5/minute,readonly=30/minute,admin=60/minute"
+)
+DEFAULT_TIER = "standard"
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+# KEYS[1] bucket; ARGV capacity, refill per ms, cost
+# Returns {allowed, remaining, retry_after_ms, reset_ms}
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = math.ceil((cost - tokens) / rate)
+end
+
+local reset = math.ceil((capacity - tokens) / rate)
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], reset + 1000)
+return {allowed, math.floor(tokens), retry_after, reset}
+"""
+
+
+def parse_limit(limit: str) -> Tuple[int, int]:
+    """'5/minute' -> (5, 60)"""
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(second|minute|hour|day)\s*", limit)
+    if not match:
+        raise ValueError(f"Invalid rate limit: {limit!r}")
+    return int(match.group(1)), PERIODS[match.group(2)]
+
+
+def parse_tier_limits(spec: str) -> Dict[str, Tuple[int, int]]:
+    """'standard=5/minute,admin=60/minute' -> {tier: (requests, seconds)}"""
+    limits = {}
+    for entry in spec.split(","):
+        if entry.strip():
+            tier, limit = entry.split("=", 1)
+            limits[tier.strip()] = parse_limit(limit)
+    return limits
+
+
+class RedisRateLimiter:
+    def __init__(self, get_redis: Callable[[], Awaitable], limits: str = RATE_LIMITS):
+        # Not the cache shards: a bucket must not move (and refill) when a cache node is added or lost
+        self.get_redis = get_redis
+        self.limits = parse_tier_limits(limits)
+        self.script = None
+
+    def limit_for(self, tier: str) -> Tuple[int, int]:
+        return self.limits.get(tier) or self.limits[DEFAULT_TIER]
+
+    async def check(self, user_id: str, tier: str, cost: int = 1) -> Dict:
+        """Consume cost tokens, returning allowed flag and header values"""
+        capacity, period = self.limit_for(tier)
+        key = f"ratelimit:{tier}:{user_id}"
+        redis_client = await self.get_redis()
+        if self.script is None:
+            # redis-py caches the SHA and falls back to EVAL after a script flush
+            self.script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+        allowed, remaining, retry_after_ms, reset_ms = await self.script(
+            keys=[key],
+            args=[capacity, capacity / (period * 1000), cost],
+            client=redis_client
+        )
+        return {
+            "allowed": bool(allowed),
+            "limit": capacity,
+            "remaining": int(remaining),
+            "retry_after": math.ceil(int(retry_after_ms) / 1000),
+            "reset": math.ceil(int(reset_ms) / 1000)
+        }
+
+    async def enforce(self, request: Request, user_data: Dict, cost: int = 1):
+        """Raise 429 when over the limit; headers are left on request.state"""
+        try:
+            result = await self.check(user_data["user_id"], user_data.get("tier", DEFAULT_TIER), cost)
+        except Exception as e:
+            # Fail open: an unavailable limiter must not take the API down
+            logger.warning(f"Rate limiter unavailable: {e}")
+            return
+
+        headers = {
+            "X-RateLimit-Limit": str(result["limit"]),
+            "X-RateLimit-Remaining": str(result["remaining"]),
+            "X-RateLimit-Reset": str(result["reset"])
+        }
+        request.state.rate_limit_headers = headers
+
+        if not result["allowed"]:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Rate limit exceeded",
+                headers={**headers, "Retry-After": str(result["retry_after"])}
+            )
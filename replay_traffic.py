@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# ~/qwen-api/replay_traffic.py
+"""
+Offline replay of captured request logs against an in-process API server
+
+    python replay_traffic.py traffic.jsonl                   # recorded pace (1x)
+    python replay_traffic.py traffic.jsonl --speed 10        # 10x faster
+    python replay_traffic.py traffic.jsonl --closed-loop 8   # 8 clients back to back
+    python replay_traffic.py --synthetic 200 --tenants 5     # generated trace
+
+One JSON object per line:
+
+    {"ts": 1718000000.25, "user": "team-a", "endpoint": "/v1/chat/completions",
+     "messages": [{"role": "user", "content": "..."}], "max_tokens": 256,
+     "temperature": 0.1, "top_p": 0.95, "stop": ["\\n\\n"]}
+
+endpoint defaults to /v1/generate (which takes "prompt" instead of
+"messages"); ts is seconds, only differences between lines matter.
+
+The server runs the real request path (auth, rate limiter, caches, usage
+pipeline) on fakeredis. The model is a random tiny Qwen2 with a byte-level
+tokenizer unless --model points at a local checkpoint, so latencies are only
+comparable between runs with the same model and settings.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+import fakeredis
+import httpx
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, PreTrainedTokenizerFast
+
+import api_server
+from cache_keys import template_version
+from generation_engine import GenerationEngine
+from memory_monitor import AdjustableSemaphore
+from paged_kv import PagedKVPool
+from prefix_cache import PrefixKVCache
+from rate_limit import parse_tier_limits
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<|fim_prefix|>", "<|fim_suffix|>", "<|fim_middle|>"]
+
+
+def tiny_tokenizer() -> PreTrainedTokenizerFast:
+    """Byte-level tokenizer without merges (one token per byte)"""
+    alphabet = pre_tokenizers.ByteLevel.alphabet()
+    vocab = {token: index for index, token in enumerate(sorted(alphabet))}
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    wrapped = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|im_end|>", pad_token="<|endoftext|>")
+    wrapped.add_special_tokens({"additional_special_tokens": SPECIAL_TOKENS})
+    wrapped.chat_template = CHAT_TEMPLATE
+    return wrapped
+
+
+def load_stand_in(model_path: Optional[str]):
+    if model_path:
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32).eval()
+        return model, tokenizer
+
+    tokenizer = tiny_tokenizer()
+    torch.manual_seed(0)
+    config = AutoConfig.for_model(
+        "qwen2",
+        vocab_size=len(tokenizer),
+        hidden_size=128,
+        intermediate_size=512,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=65536,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32, attn_implementation="sdpa").eval()
+    return model, tokenizer
+
+
+def load_trace(path: str) -> List[Dict]:
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda e: e.get("ts", 0))
+    return entries
+
+
+def synthetic_trace(count: int, tenants: int, rate: float, fim_share: float = 0.0, seed: int = 0) -> List[Dict]:
+    """Poisson arrivals, skewed tenants, popular prompts repeat (cache hits).
+
+    fim_share of the requests are autocomplete calls typing through one file.
+    """
+    rng = random.Random(seed)
+    popular = [f"def function_{i}(x):\n    # complete this\n" for i in range(20)]
+    source = "".join(f"def helper_{i}(value):\n    return value * {i}\n\n" for i in range(40))
+    weights = [1 / (t + 1) for t in range(tenants)]
+    ts, trace, cursor = 0.0, [], len(source) // 2
+    for i in range(count):
+        ts += rng.expovariate(rate)
+        if rng.random() < fim_share:
+            cursor = min(len(source), cursor + rng.randint(1, 12))
+            trace.append({
+                "ts": ts,
+                "user": "editor",
+                "endpoint": "/v1/completions",
+                "prefix": source[:cursor],
+                "suffix": source[cursor:cursor + 200],
+                "max_tokens": 16,
+            })
+            continue
+        prompt = rng.choice(popular) if rng.random() < 0.3 else f"Explain request {i}: " + "x" * rng.randint(20, 400)
+        trace.append({
+            "ts": ts,
+            "user": f"tenant-{rng.choices(range(tenants), weights)[0]}",
+            "endpoint": "/v1/generate",
+            "prompt": prompt,
+            "max_tokens": rng.choice([16, 32, 64]),
+            "temperature": 0.0,
+        })
+    return trace
+
+
+def request_body(entry: Dict) -> Dict:
+    body = {k: entry[k] for k in ("max_tokens", "temperature", "top_p", "stop") if k in entry}
+    endpoint = entry.get("endpoint", "/v1/generate")
+    if endpoint == "/v1/chat/completions":
+        body["messages"] = entry["messages"]
+    elif endpoint == "/v1/completions":
+        body.update(prefix=entry["prefix"], suffix=entry.get("suffix", ""), mode=entry.get("mode", "line"))
+    else:
+        body["prompt"] = entry["prompt"]
+    return body
+
+
+def parse_server_timing(header: str) -> Dict:
+    timing = {}
+    for entry in filter(None, (e.strip() for e in header.split(","))):
+        name, _, param = entry.partition(";")
+        key, _, value = param.partition("=")
+        timing[name] = float(value) / 1000 if key == "dur" else value
+    return timing
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def jain_index(values: List[float]) -> float:
+    """1.0 = perfectly even, 1/n = one tenant gets everything"""
+    if not values or not any(values):
+        return 1.0
+    return sum(values) ** 2 / (len(values) * sum(v * v for v in values))
+
+
+class Replayer:
+    def __init__(self, client: httpx.AsyncClient, keys: Dict[str, str], tokenizer):
+        self.client = client
+        self.keys = keys
+        self.tokenizer = tokenizer
+        self.results: List[Dict] = []
+
+    async def send(self, entry: Dict, scheduled: float):
+        endpoint = entry.get("endpoint", "/v1/generate")
+        started = time.perf_counter()
+        response = await self.client.post(
+            endpoint, json=request_body(entry), headers={"Authorization": f"Bearer {self.keys[entry['user']]}"}
+        )
+        finished = time.perf_counter()
+
+        result = {
+            "user": entry["user"],
+            "endpoint": endpoint,
+            "status": response.status_code,
+            "latency": finished - started,
+            # Client-side lag behind the schedule (only non-zero if the replayer falls behind)
+            "start_lag": started - scheduled,
+            "cached": False,
+            "completion_tokens": 0,
+            "queue": 0.0,
+            "error": None,
+        }
+        if response.status_code != 200:
+            result["error"] = response.text[:200]
+        else:
+            data = response.json()
+            timing = parse_server_timing(response.headers.get("Server-Timing", ""))
+            result["queue"] = timing.get("queue", 0.0)
+            if endpoint in ("/v1/chat/completions", "/v1/completions"):
+                result["completion_tokens"] = data["usage"]["completion_tokens"]
+                result["cached"] = timing.get("cache") == "hit"
+            else:
+                result["completion_tokens"] = len(self.tokenizer(data["response"]).input_ids)
+                result["cached"] = data["cached"]
+        self.results.append(result)
+
+    async def open_loop(self, trace: List[Dict], speed: float):
+        """Send at the recorded arrival times, compressed by speed"""
+        origin = trace[0].get("ts", 0)
+        begin = time.perf_counter()
+        tasks = []
+        for entry in trace:
+            scheduled = begin + (entry.get("ts", 0) - origin) / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.send(entry, scheduled)))
+        await asyncio.gather(*tasks)
+
+    async def closed_loop(self, trace: List[Dict], concurrency: int):
+        """concurrency clients, each sending its next request as soon as one finishes"""
+        pending = iter(trace)
+
+        async def client():
+            for entry in pending:
+                await self.send(entry, time.perf_counter())
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+
+
+def summarize(results: List[Dict], elapsed: float) -> Dict:
+    ok = [r for r in results if r["status"] == 200]
+    latencies = [r["latency"] for r in ok]
+    misses = [r for r in ok if not r["cached"]]
+
+    per_tenant = defaultdict(list)
+    for r in results:
+        per_tenant[r["user"]].append(r)
+
+    tenants = {}
+    for user, rows in sorted(per_tenant.items()):
+        served = [r for r in rows if r["status"] == 200]
+        tokens = sum(r["completion_tokens"] for r in served)
+        tenants[user] = {
+            "requests": len(rows),
+            "errors": len(rows) - len(served),
+            "p50_latency": percentile([r["latency"] for r in served], 50),
+            "p99_latency": percentile([r["latency"] for r in served], 99),
+            "ms_per_token": 1000 * sum(r["latency"] for r in served) / tokens if tokens else 0.0,
+        }
+
+    return {
+        "requests": len(results),
+        "status": dict(Counter(r["status"] for r in results)),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "throughput_tokens_s": sum(r["completion_tokens"] for r in ok) / elapsed if elapsed else 0.0,
+        "latency_s": {f"p{q}": percentile(latencies, q) for q in (50, 90, 99)},
+        "uncached_latency_s": {f"p{q}": percentile([r["latency"] for r in misses], q) for q in (50, 90, 99)},
+        "queue_s": {f"p{q}": percentile([r["queue"] for r in misses], q) for q in (50, 90, 99)},
+        "max_start_lag_s": max((r["start_lag"] for r in results), default=0.0),
+        "cache_hit_rate": (len(ok) - len(misses)) / len(ok) if ok else 0.0,
+        "tenants": tenants,
+        "endpoints": {
+            endpoint: {f"p{q}": percentile([r["latency"] for r in ok if r["endpoint"] == endpoint], q) for q in (50, 99)}
+            for endpoint in sorted({r["endpoint"] for r in ok})
+        },
+        # Evenness of per-token latency across tenants
+        "fairness_jain": jain_index([t["ms_per_token"] for t in tenants.values() if t["ms_per_token"]]),
+        "errors": dict(Counter(r["error"] for r in results if r["error"]).most_common(5)),
+    }
+
+
+def print_report(report: Dict):
+    print(f"Requests: {report['requests']}  status {report['status']}  in {report['elapsed_s']:.1f}s")
+    print(f"Throughput: {report['throughput_rps']:.2f} req/s, {report['throughput_tokens_s']:.1f} tokens/s")
+    for label, key in (("Latency", "latency_s"), ("Uncached", "uncached_latency_s"), ("Queueing", "queue_s")):
+        values = "  ".join(f"{q} {v * 1000:8.1f}ms" for q, v in report[key].items())
+        print(f"{label:10s} {values}")
+    for endpoint, values in report["endpoints"].items():
+        print(f"  {endpoint:22s} " + "  ".join(f"{q} {v * 1000:8.1f}ms" for q, v in values.items()))
+    print(f"Cache hit rate: {report['cache_hit_rate']:.1%}  max replay lag: {report['max_start_lag_s'] * 1000:.1f}ms")
+    for error, count in report["errors"].items():
+        print(f"  {count:5d} x {error}")
+    print(f"Tenant fairness (Jain, per-token latency): {report['fairness_jain']:.3f}")
+    for user, t in report["tenants"].items():
+        print(f"  {user:20s} {t['requests']:5d} req  {t['errors']:3d} err  p50 {t['p50_latency'] * 1000:8.1f}ms  "
+              f"p99 {t['p99_latency'] * 1000:8.1f}ms  {t['ms_per_token']:6.1f} ms/token")
+
+
+async def replay(args, trace: List[Dict]) -> Dict:
+    model, tokenizer = load_stand_in(args.model)
+    qwen_api = api_server.qwen_api
+    qwen_api.model, qwen_api.tokenizer, qwen_api.device = model, tokenizer, "cpu"
+    qwen_api.prefix_cache = None if args.no_prefix_cache else PrefixKVCache()
+    qwen_api.chat_template_version = template_version(tokenizer.chat_template)
+    qwen_api.generation_slots = AdjustableSemaphore(args.concurrency)
+    if args.engine:
+        qwen_api.engine = GenerationEngine(
+            model, tokenizer, "cpu", pool=PagedKVPool.for_memory(model, args.kv_memory_gb), max_sequences=args.concurrency
+        )
+        qwen_api.engine.start()
+
+    server = fakeredis.FakeServer()
+    qwen_api.redis_client = fakeredis.aioredis.FakeRedis(server=server, db=0, decode_responses=True)
+    api_server.api_key_manager.redis_client = fakeredis.aioredis.FakeRedis(server=server, db=1, decode_responses=True)
+    api_server.rate_limiter.limits = parse_tier_limits(args.rate_limits)
+
+    keys = {}
+    for user in sorted({e["user"] for e in trace}):
+        keys[user] = await api_server.api_key_manager.create_api_key(user, tier="standard")
+
+    api_server.usage_pipeline.start()
+    transport = httpx.ASGITransport(app=api_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://localhost", timeout=None) as client:
+        replayer = Replayer(client, keys, tokenizer)
+        begin = time.perf_counter()
+        if args.closed_loop:
+            await replayer.closed_loop(trace, args.closed_loop)
+        else:
+            await replayer.open_loop(trace, args.speed)
+        elapsed = time.perf_counter() - begin
+    await api_server.usage_pipeline.stop()
+    if qwen_api.engine is not None:
+        qwen_api.engine.stop()
+
+    return summarize(replayer.results, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace", nargs="?", help="JSON lines request log")
+    parser.add_argument("--synthetic", type=int, default=0, help="generate N requests instead of reading a trace")
+    parser.add_argument("--tenants", type=int, default=4, help="tenants in the synthetic trace")
+    parser.add_argument("--rate", type=float, default=2.0, help="synthetic arrivals per second")
+    parser.add_argument("--fim-share", type=float, default=0.0, help="share of synthetic autocomplete requests")
+    parser.add_argument("--speed", type=float, default=1.0, help="open loop: replay N times faster than recorded")
+    parser.add_argument("--closed-loop", type=int, default=0, metavar="N", help="N clients sending back to back")
+    parser.add_argument("--concurrency", type=int, default=api_server.GENERATION_CONCURRENCY,
+                        help="generation slots (GENERATION_CONCURRENCY)")
+    parser.add_argument("--rate-limits", default="standard=1000000/second",
+                        help="RATE_LIMITS spec for the replay (default: effectively unlimited)")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="disable prompt KV reuse")
+    parser.add_argument("--engine", action="store_true",
+                        help="continuous batching on the paged KV cache, --concurrency sequences per batch")
+    parser.add_argument("--kv-memory-gb", type=float, default=0.25, help="paged KV pool size with --engine")
+    parser.add_argument("--model", help="local checkpoint instead of the tiny stand-in")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        trace = synthetic_trace(args.synthetic, args.tenants, args.rate, args.fim_share)
+    elif args.trace:
+        trace = load_trace(args.trace)
+    else:
+        parser.error("give a trace file or --synthetic N")
+
+    report = asyncio.run(replay(args, trace))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
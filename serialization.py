@@ -0,0 +1,118 @@
+# ~/qwen-api/serialization.py
+"""
+Fast JSON encoding for hot endpoints and the response cache.
+
+Cache records are stored already JSON-encoded with the completion text as
+the last field, so a cache hit can splice the stored text bytes into the
+HTTP response without decoding and re-escaping multi-KB strings. Records
+in any other layout are decoded in full.
+"""
+import json
+import re
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+RECORD_TEXT_MARKER = ',"text":'
+# A '"' not escaped by a backslash, i.e. the end of a JSON string
+UNESCAPED_QUOTE = re.compile(r'(?<!\\)(?:\\\\)*"')
+
+
+class RawJSON(str):
+    """A value that is already valid JSON and must be emitted verbatim"""
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact JSON encoding (orjson if available)"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _placeholder(index: int) -> str:
+    # NUL cannot appear unescaped in JSON, so the encoded placeholder is unique
+    return f"\x00raw{index}\x00"
+
+
+def dumps_with_raw(obj: Any) -> bytes:
+    """Like dumps(), but RawJSON values anywhere in obj are spliced in as-is"""
+    raw_values = []
+
+    def replace(value):
+        if isinstance(value, RawJSON):
+            raw_values.append(value)
+            return _placeholder(len(raw_values) - 1)
+        if isinstance(value, dict):
+            return {k: replace(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [replace(v) for v in value]
+        return value
+
+    encoded = dumps(replace(obj))
+    for index, raw in enumerate(raw_values):
+        encoded = encoded.replace(dumps(_placeholder(index)), raw.encode(), 1)
+    return encoded
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse without jsonable_encoder, using orjson and RawJSON splicing"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_with_raw(content)
+
+
+def encode_cache_record(text: str, **meta) -> str:
+    """Serialize a completion for the cache, text last (see cache_record_text)"""
+    head = dumps(meta).decode()[:-1]
+    separator = RECORD_TEXT_MARKER if meta else RECORD_TEXT_MARKER[1:]
+    return head + separator + dumps(text).decode() + "}"
+
+
+def _split_record(record: str) -> Optional[Tuple[str, str]]:
+    """(metadata JSON, text JSON) of a record with the text last, else None"""
+    if record.startswith('{"text":'):
+        head, text = "{}", record[8:-1]
+    else:
+        # The text itself cannot contain the marker unescaped, so its marker is the last one
+        split = record.rfind(RECORD_TEXT_MARKER)
+        if split < 0:
+            return None
+        head, text = record[:split] + "}", record[split + len(RECORD_TEXT_MARKER):-1]
+    # The text must be exactly one JSON string: its first unescaped quote after the opening one ends it
+    end = UNESCAPED_QUOTE.search(text, 1) if text.startswith('"') and record.endswith("}") else None
+    if end is None or end.end() != len(text):
+        return None
+    return head, text
+
+
+def decode_cache_record(record: str) -> Dict:
+    """Metadata of a cache record plus the still-encoded text as RawJSON.
+
+    ValueError if record is not a JSON object with a string text.
+    """
+    split = _split_record(record)
+    if split is not None:
+        try:
+            meta = loads(split[0])
+        except ValueError:
+            meta = None
+        if isinstance(meta, dict):
+            meta["text_json"] = RawJSON(split[1])
+            return meta
+
+    data = loads(record)
+    if not isinstance(data, dict) or not isinstance(data.get("text"), str):
+        raise ValueError("Not a cache record")
+    data["text_json"] = RawJSON(dumps(data.pop("text")).decode())
+    return data
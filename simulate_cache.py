@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# ~/qwen-api/simulate_cache.py
+"""
+Hit ratio of the in-memory cache policies on a key trace
+
+    python simulate_cache.py --synthetic 200000               # IDE prompts + batch bursts
+    python simulate_cache.py traffic.jsonl --sizes 500,1000   # recorded trace
+
+Every trace entry is a lookup; a miss stores the key, as the API server
+does after generating (or after a Redis hit). Policies: lru (admit all,
+evict least recently used), ttl (the former TTLCache), tinylfu
+(tinylfu_cache.TinyLFUCache). Time is the trace's, so TTL expiry plays out
+as recorded.
+
+Trace lines are JSON objects with "ts" and either "key" or a request in
+replay_traffic.py's format (the key is then a digest of the fields that
+make up the response cache key). Synthetic traces mark IDE requests, their
+hit ratio is reported separately: the traffic batch jobs should not evict.
+"""
+
+import argparse
+import json
+import random
+from typing import Dict, List
+
+from cachetools import LRUCache, TTLCache
+
+from cache_keys import fast_digest
+from tinylfu_cache import TinyLFUCache
+
+TTL_SECONDS = 3600
+# Fields of a replay_traffic.py request that end up in its cache key
+KEY_FIELDS = ("endpoint", "prompt", "messages", "prefix", "suffix", "mode", "max_tokens", "temperature", "top_p", "stop")
+
+
+def trace_key(entry: Dict) -> str:
+    if "key" in entry:
+        return entry["key"]
+    return fast_digest(json.dumps({k: entry.get(k) for k in KEY_FIELDS}, sort_keys=True).encode())
+
+
+def load_trace(path: str) -> List[Dict]:
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda e: e.get("ts", 0))
+    return [{"ts": e.get("ts", 0), "key": trace_key(e), "ide": e.get("ide", False)} for e in entries]
+
+
+def synthetic_trace(count: int, hot_keys: int, batch_share: float, rate: float, seed: int = 0) -> List[Dict]:
+    """IDE traffic over Zipf-popular prompts, interrupted by batch jobs of one-off prompts.
+
+    Requests come in blocks of 1000; a block is a batch job with probability
+    batch_share and then 90% of its requests are prompts never seen again.
+    5% of the IDE requests are new prompts too.
+    """
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(hot_keys)]
+    trace, ts, one_off = [], 0.0, 0
+    for block in range(0, count, 1000):
+        batch = rng.random() < batch_share
+        for _ in range(min(1000, count - block)):
+            ts += rng.expovariate(rate)
+            if rng.random() < (0.9 if batch else 0.05):
+                one_off += 1
+                trace.append({"ts": ts, "key": f"once-{one_off}", "ide": not batch})
+            else:
+                key = f"ide-{rng.choices(range(hot_keys), weights)[0]}"
+                trace.append({"ts": ts, "key": key, "ide": True})
+    return trace
+
+
+def simulate(trace: List[Dict], policy: str, size: int) -> Dict:
+    now = [0.0]
+    if policy == "lru":
+        cache = LRUCache(maxsize=size)
+    elif policy == "ttl":
+        cache = TTLCache(maxsize=size, ttl=TTL_SECONDS, timer=lambda: now[0])
+    else:
+        cache = TinyLFUCache(size, TTL_SECONDS, timer=lambda: now[0], tier=None)
+
+    hits = ide_hits = ide_lookups = 0
+    for entry in trace:
+        now[0] = entry["ts"]
+        hit = cache.get(entry["key"]) is not None
+        if not hit:
+            cache[entry["key"]] = True
+        hits += hit
+        if entry["ide"]:
+            ide_lookups += 1
+            ide_hits += hit
+    return {
+        "hit_ratio": hits / len(trace),
+        "ide_hit_ratio": ide_hits / ide_lookups if ide_lookups else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace", nargs="?", help="JSON lines key or request trace")
+    parser.add_argument("--synthetic", type=int, default=0, help="generate N lookups instead of reading a trace")
+    parser.add_argument("--hot-keys", type=int, default=5000, help="distinct IDE prompts in the synthetic trace")
+    parser.add_argument("--batch-share", type=float, default=0.3, help="share of synthetic traffic in batch jobs")
+    parser.add_argument("--rate", type=float, default=20.0, help="synthetic lookups per second")
+    parser.add_argument("--sizes", default="250,1000,4000", help="cache sizes to simulate")
+    parser.add_argument("--policies", default="lru,ttl,tinylfu")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        trace = synthetic_trace(args.synthetic, args.hot_keys, args.batch_share, args.rate)
+    elif args.trace:
+        trace = load_trace(args.trace)
+    else:
+        parser.error("give a trace file or --synthetic N")
+
+    distinct = len({e["key"] for e in trace})
+    span = trace[-1]["ts"] - trace[0]["ts"]
+    print(f"{len(trace)} lookups, {distinct} distinct keys over {span / 3600:.1f}h (TTL {TTL_SECONDS}s)")
+    print(f"{'size':>6s} {'policy':8s} {'hit ratio':>10s} {'IDE hit ratio':>14s}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        for policy in args.policies.split(","):
+            r = simulate(trace, policy, size)
+            ide = f"{r['ide_hit_ratio']:14.1%}" if r["ide_hit_ratio"] is not None else f"{'-':>14s}"
+            print(f"{size:6d} {policy:8s} {r['hit_ratio']:10.1%} {ide}")
+
+
+if __name__ == "__main__":
+    main()
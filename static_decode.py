@@ -0,0 +1,132 @@
+# ~/qwen-api/static_decode.py
+"""
+Static-KV-cache generation with padded sequence-length buckets.
+
+Prompts are left-padded to a small set of bucket lengths and decoded
+against a preallocated StaticCache whose length is bucketed too, so
+torch.compile sees a handful of fixed shapes instead of one per request
+(and CUDA graphs can be captured with mode="reduce-overhead").
+
+STATIC_KV_CACHE is GPU-only: the gain comes from captured CUDA graphs, and
+on CPU (bench_static_decode.py) it is no faster than the dynamic-shape
+compile, so CPU mode ignores it. Caches hold one sequence, so parallel
+samples (n/best_of) decode one after another, each prefilling the prompt
+again. They are not sent down the dynamic-cache path instead: forward is
+compiled for the bucket shapes, and every new shape would recompile it.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from prometheus_client import Counter
+from transformers import StaticCache
+
+logger = logging.getLogger(__name__)
+
+STATIC_KV_CACHE = os.getenv("STATIC_KV_CACHE", "0") == "1"
+SEQ_BUCKETS = [int(b) for b in os.getenv("SEQ_BUCKETS", "256,512,1024,2048,4096,8192,16384,32768").split(",")]
+# Preallocated caches kept around (one per cache-length bucket)
+STATIC_CACHE_SLOTS = int(os.getenv("STATIC_CACHE_SLOTS", "2"))
+
+RECOMPILES = Counter('qwen_torch_compiles_total', 'Graphs compiled by torch.compile (first compile and recompiles)')
+BUCKET_REQUESTS = Counter('qwen_static_bucket_requests_total', 'Generations per static cache bucket', ['bucket'])
+
+
+def bucket_length(length: int, buckets: List[int] = SEQ_BUCKETS) -> int:
+    """Smallest bucket >= length (multiples of the largest bucket beyond it)"""
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    largest = buckets[-1]
+    return -(-length // largest) * largest
+
+
+def compiled_graph_count() -> int:
+    from torch._dynamo.utils import counters
+    return counters["stats"]["unique_graphs"]
+
+
+class BucketedStaticDecoder:
+    """Wraps model.generate with padded shapes and reusable static caches"""
+
+    def __init__(self, model, pad_token_id: int, compile_mode: Optional[str] = "default", buckets: List[int] = SEQ_BUCKETS):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.buckets = buckets
+        self.caches: "OrderedDict[int, StaticCache]" = OrderedDict()
+        self.locks: Dict[int, threading.Lock] = {}
+        self.lock = threading.Lock()
+        self.graphs_seen = compiled_graph_count()
+
+        if compile_mode:
+            # Every (prompt bucket, cache bucket) pair is one static graph
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 4 * len(buckets) ** 2)
+            model.forward = torch.compile(model.forward, mode=compile_mode, dynamic=False)
+            logger.info(f"Compiled forward for static decoding (mode={compile_mode}, buckets={buckets})")
+
+    def _cache(self, cache_len: int) -> StaticCache:
+        with self.lock:
+            if cache_len in self.caches:
+                self.caches.move_to_end(cache_len)
+                return self.caches[cache_len]
+            while len(self.caches) >= STATIC_CACHE_SLOTS:
+                self.caches.popitem(last=False)
+            param = next(self.model.parameters())
+            cache = StaticCache(
+                config=self.model.config,
+                max_batch_size=1,
+                max_cache_len=cache_len,
+                device=param.device,
+                dtype=param.dtype
+            )
+            self.caches[cache_len] = cache
+            self.locks.setdefault(cache_len, threading.Lock())
+            return cache
+
+    def trim(self, keep: int) -> bool:
+        """Drop all but the keep most recently used caches, True if any were dropped"""
+        with self.lock:
+            dropped = False
+            while len(self.caches) > keep:
+                cache_len, _ = self.caches.popitem(last=False)
+                dropped = True
+                logger.info(f"Released static cache for bucket {cache_len}")
+            return dropped
+
+    def _count_recompiles(self):
+        graphs = compiled_graph_count()
+        if graphs > self.graphs_seen:
+            RECOMPILES.inc(graphs - self.graphs_seen)
+            self.graphs_seen = graphs
+
+    def generate(self, inputs: Dict, max_new_tokens: int, **generate_kwargs) -> torch.Tensor:
+        """Same contract as model.generate for batch size 1; padding is stripped"""
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs.get("attention_mask", torch.ones_like(input_ids))
+        length = input_ids.shape[-1]
+        padded = bucket_length(length, self.buckets)
+        pad = padded - length
+
+        input_ids = F.pad(input_ids, (pad, 0), value=self.pad_token_id)
+        attention_mask = F.pad(attention_mask, (pad, 0), value=0)
+
+        cache_len = bucket_length(padded + max_new_tokens, self.buckets)
+        BUCKET_REQUESTS.labels(bucket=str(cache_len)).inc()
+        cache = self._cache(cache_len)
+
+        with self.locks[cache_len]:
+            cache.reset()
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=cache,
+                max_new_tokens=max_new_tokens,
+                **generate_kwargs
+            )
+
+        self._count_recompiles()
+        return outputs[:, pad:]
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_affinity_router.py
+"""Consistent-hash remapping and bounded-load replica choice"""
+import math
+import random
+
+import pytest
+from fastapi import HTTPException
+
+from affinity_router import AffinityRouter, affinity_key
+from hash_ring import HashRing
+
+NODES = [f"http://replica-{i}:8000" for i in range(5)]
+KEYS = [f"prompt-{i}" for i in range(20000)]
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before = HashRing(NODES)
+    added = "http://replica-5:8000"
+    after = HashRing(NODES + [added])
+
+    moved = [key for key in KEYS if before.owner(key) != after.owner(key)]
+    assert all(after.owner(key) == added for key in moved)
+    # About 1/N of the keys
+    assert 0.5 / 6 < len(moved) / len(KEYS) < 1.5 / 6
+
+
+def test_removing_a_node_only_moves_its_keys():
+    before = HashRing(NODES)
+    removed = NODES[2]
+    after = HashRing([node for node in NODES if node != removed])
+
+    owned = [key for key in KEYS if before.owner(key) == removed]
+    assert 0.5 / 5 < len(owned) / len(KEYS) < 1.5 / 5
+    for key in KEYS:
+        if before.owner(key) == removed:
+            # Taken over by the next node on its walk
+            assert after.owner(key) == [node for node in before.walk(key) if node != removed][0]
+        else:
+            assert after.owner(key) == before.owner(key)
+
+
+def test_walk_visits_every_node_once_from_the_owner():
+    ring = HashRing(NODES)
+    for key in KEYS[:200]:
+        walk = list(ring.walk(key))
+        assert walk[0] == ring.owner(key) and sorted(walk) == sorted(NODES)
+
+
+def healthy_router(load_factor: float = 1.25) -> AffinityRouter:
+    router = AffinityRouter(NODES, load_factor=load_factor)
+    for replica in router.replicas.values():
+        replica.healthy = True
+    return router
+
+
+@pytest.mark.parametrize("load_factor", [1.0, 1.25, 2.0])
+def test_bounded_load(load_factor):
+    router = healthy_router(load_factor)
+    rng = random.Random(7)
+    # Mostly one hot prompt, the worst case for affinity
+    keys = ["hot prompt"] * 8 + [f"prompt-{i}" for i in range(2)]
+    running = []
+    for _ in range(5000):
+        if running and rng.random() < 0.45:
+            running.pop(rng.randrange(len(running))).in_flight -= 1
+        replica, _ = router.choose(rng.choice(keys))
+        replica.in_flight += 1
+        running.append(replica)
+
+        loads = [r.load for r in router.replicas.values()]
+        assert max(loads) <= math.ceil(load_factor * sum(loads) / len(loads))
+
+
+def test_keys_stay_on_their_owner_while_balanced():
+    router = healthy_router()
+    for key in KEYS[:500]:
+        replica, decision = router.choose(key)
+        assert replica.url == router.ring.owner(key) and decision == "affinity"
+
+
+def test_overflow_and_unhealthy_replicas():
+    router = healthy_router()
+    owner = router.replicas[router.ring.owner("hot prompt")]
+    owner.reported = 10
+    replica, decision = router.choose("hot prompt")
+    assert replica is not owner and decision == "overflow"
+
+    for replica in router.replicas.values():
+        replica.healthy = replica is owner
+    # Unhealthy replicas are skipped even when the only one left is busy
+    assert router.choose("hot prompt")[0] is owner
+    owner.healthy = False
+    with pytest.raises(HTTPException) as error:
+        router.choose("hot prompt")
+    assert error.value.status_code == 503
+
+
+def test_affinity_key():
+    body = b'{"model": "qwen", "prompt": "  Summarize\\n the   following text"}'
+    assert affinity_key("/v1/generate", {}, body) == "qwen\nSummarize the following text"
+    assert affinity_key("/v1/generate", {"x-conversation-id": "abc"}, body) == "conversation:abc"
+    assert affinity_key("/v1/generate", {}, b"not json") is None
+    assert affinity_key("/v1/generate", {}, b"") is None
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_api_keys.py
+"""Key listing, bulk creation and revocation, also of keys created before the key indexes"""
+import asyncio
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+
+import fakeredis
+import pytest
+from fastapi import HTTPException
+
+from auth import APIKeyManager
+from conftest import api_client
+
+
+async def legacy_key(redis_client, user_id: str, last_reset: str) -> str:
+    """A key as the server stored it before the indexes: the hash only"""
+    raw_key = secrets.token_hex(32)
+    await redis_client.hset(f"apikey:{hashlib.sha256(raw_key.encode()).hexdigest()}", mapping={
+        "user_id": user_id, "permissions": "generate", "tier": "standard", "requests_today": "0",
+        "daily_limit": "1000", "last_reset": last_reset
+    })
+    return raw_key
+
+
+def test_backfill_lists_and_revokes_legacy_keys():
+    async def run():
+        manager = APIKeyManager()
+        manager.redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        today = datetime.utcnow().date().isoformat()
+        old_keys = [await legacy_key(manager.redis_client, "legacy-user", today) for _ in range(3)]
+        new_key = await manager.create_api_key("legacy-user")
+
+        assert len((await manager.list_api_keys(user_id="legacy-user"))["keys"]) == 1
+        assert await manager.backfill_key_indexes(batch=2) == 3
+        # Done once, the marker skips the scan
+        assert await manager.backfill_key_indexes() == 0
+        listed = (await manager.list_api_keys())["keys"]
+        assert len(listed) == 4
+
+        assert await manager.revoke_user_keys("legacy-user") == 4
+        for raw_key in old_keys + [new_key]:
+            with pytest.raises(HTTPException):
+                await manager.verify_api_key(raw_key)
+
+    asyncio.run(run())
+
+
+def test_daily_reset_indexes_keys_missed_by_the_backfill():
+    async def run():
+        manager = APIKeyManager()
+        manager.redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        await manager.backfill_key_indexes()
+        # Written later by a server without the indexes
+        yesterday = (datetime.utcnow().date() - timedelta(days=1)).isoformat()
+        raw_key = await legacy_key(manager.redis_client, "straggler", yesterday)
+        await manager.verify_api_key(raw_key)
+        return await manager.list_api_keys(user_id="straggler")
+
+    assert len(asyncio.run(run())["keys"]) == 1
+
+
+def test_admin_key_endpoints_validate_their_input(api):
+    async def run():
+        admin_key = await api.api_key_manager.create_api_key("key-admin", permissions=["admin"], tier="admin")
+        headers = {"Authorization": f"Bearer {admin_key}"}
+        async with api_client(api.app) as client:
+            created = await client.post("/admin/api-keys/bulk", headers=headers,
+                                        json={"keys": [{"user_id": "bulk-user"}, {"user_id": "bulk-user", "tier": "admin"}]})
+            first = await client.get("/admin/api-keys", headers=headers, params={"limit": 2})
+            second = await client.get("/admin/api-keys", headers=headers,
+                                      params={"limit": 2, "cursor": first.json()["next_cursor"]})
+            statuses = [
+                (await client.post("/admin/api-keys/bulk", headers=headers, json=body)).status_code
+                for body in ({"keys": []}, {"keys": [{"tier": "admin"}]}, {"keys": "bulk-user"})
+            ] + [
+                (await client.post("/admin/api-keys/revoke", headers=headers, json=body)).status_code
+                for body in ({}, {"key_hashes": ["0" * 64] * (api.MAX_BULK_KEYS + 1)})
+            ] + [
+                (await client.get("/admin/api-keys", headers=headers, params=params)).status_code
+                for params in ({"cursor": "not-a-key-hash"}, {"user_id": "bulk-user", "cursor": "abc"})
+            ]
+            revoked = await client.post("/admin/api-keys/revoke", headers=headers, json={"user_id": "bulk-user"})
+        return created, first, second, statuses, revoked
+
+    created, first, second, statuses, revoked = asyncio.run(run())
+    assert created.status_code == 200 and [k["tier"] for k in created.json()["keys"]] == ["standard", "admin"]
+    # Three keys: the admin's and the two created in bulk
+    assert len(first.json()["keys"]) == 2 and len(second.json()["keys"]) == 1
+    assert statuses == [422, 422, 422, 400, 422, 400, 400]
+    assert revoked.json()["revoked"] == 2
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_batch_generate.py
+"""/v1/batch/generate at the default rate limits (standard=5/minute)"""
+import asyncio
+
+from conftest import api_client
+
+
+def test_batch_over_capacity_is_rejected(api):
+    async def run():
+        api_key = await api.api_key_manager.create_api_key("batch-user", tier="standard")
+        async with api_client(api.app) as client:
+            response = await client.post("/v1/batch/generate", headers={"Authorization": f"Bearer {api_key}"},
+                                         json={"requests": [{"prompt": f"p{i}", "max_tokens": 2} for i in range(10)]})
+        return response
+
+    response = asyncio.run(run())
+    # More prompts than the bucket can ever hold: 400, not a 429 to retry forever
+    assert response.status_code == 400
+    assert "rate limit of 5" in response.json()["detail"]
+
+
+def test_batch_within_capacity(api):
+    async def run():
+        api_key = await api.api_key_manager.create_api_key("batch-user", tier="standard")
+        async with api_client(api.app) as client:
+            return await client.post("/v1/batch/generate", headers={"Authorization": f"Bearer {api_key}"},
+                                     json={"requests": [{"prompt": f"p{i}", "max_tokens": 2} for i in range(5)]})
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["index"] for r in results] == list(range(5))
+    assert all("response" in r for r in results)
+    # The whole burst was used, a single prompt now waits for the bucket
+    assert response.headers["x-ratelimit-remaining"] == "0"
+
+
+def test_batch_with_jwt(api):
+    async def run():
+        token = await api.api_key_manager.create_jwt_token("jwt-user")
+        async with api_client(api.app) as client:
+            return await client.post("/v1/batch/generate", headers={"Authorization": f"Bearer {token}"},
+                                     json={"requests": [{"prompt": "p", "max_tokens": 2}] * 2})
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert len(response.json()["results"]) == 2
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_cache_keys.py
+"""Cache keys are the same on every server: fixed token encoding, pinned digests"""
+import struct
+
+import pytest
+import torch
+
+import cache_keys
+from cache_keys import build_cache_key, build_embedding_key, token_bytes
+
+MODEL = "Qwen/Qwen2.5-Coder-32B-Instruct"
+TOKENS = [151644, 872, 198, 9707, 151645]
+
+# Keys existing caches hold; a change here orphans every stored entry
+PINNED = {
+    "xxh3": (
+        f"qwen:resp:v2:{MODEL}@main:0123abcd:b1e59431fb554e9fd59127a5ff64e9f6",
+        f"qwen:emb:v1:{MODEL}@main:mean:bc5bfd667cc4fce7a59ea6eafbd69a9b",
+    ),
+    "blake2b": (
+        f"qwen:resp:v2:{MODEL}@main:0123abcd:b5f863ada320999f014852c91215e1a5",
+        f"qwen:emb:v1:{MODEL}@main:mean:4cfa8e2447c0d22e4a4d119967a4fb2f",
+    ),
+}
+
+
+def test_token_bytes_are_little_endian_uint32():
+    assert token_bytes([1, 2, 70000]) == bytes.fromhex("01000000" "02000000" "70110100")
+    assert token_bytes(TOKENS) == struct.pack(f"<{len(TOKENS)}I", *TOKENS)
+    # Lists, generators and tensors encode alike
+    assert token_bytes(iter(TOKENS)) == token_bytes(torch.tensor(TOKENS)) == token_bytes(TOKENS)
+    assert token_bytes([]) == b""
+
+
+@pytest.mark.parametrize("digest", ["xxh3", "blake2b"])
+def test_keys_are_pinned(digest, monkeypatch):
+    if digest == "xxh3" and cache_keys.xxhash is None:
+        pytest.skip("xxhash not installed")
+    if digest == "blake2b":
+        monkeypatch.setattr(cache_keys, "xxhash", None)
+
+    response_key = build_cache_key(MODEL, "main", "0123abcd", TOKENS, temperature=0.0, top_p=1.0, stop=["\n"])
+    embedding_key = build_embedding_key(MODEL, "main", "mean", [9707, 1879])
+    assert (response_key, embedding_key) == PINNED[digest]
+
+
+def test_equivalent_params_share_a_key():
+    key = build_cache_key(MODEL, "main", "0123abcd", TOKENS, temperature=0.0, top_p=1.0, stop=["\n"])
+    # Order, int vs float and float noise below FLOAT_PRECISION do not matter
+    assert key == build_cache_key(MODEL, "main", "0123abcd", TOKENS, stop=["\n"], top_p=1.0000000001, temperature=0)
+    assert key != build_cache_key(MODEL, "main", "0123abcd", TOKENS, temperature=0.0, top_p=0.9, stop=["\n"])
+    assert key != build_cache_key(MODEL, "main", "0123abcd", TOKENS[:-1], temperature=0.0, top_p=1.0, stop=["\n"])
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_cache_shards.py
+"""Response cache over several Redis nodes: key routing and a node going down"""
+import asyncio
+
+import fakeredis
+import pytest
+
+from cache_backend import CacheShards
+from conftest import api_client
+
+NODES = [f"redis://cache-{i}:6379/0" for i in range(3)]
+
+
+@pytest.fixture
+def shards(api):
+    servers = {node: fakeredis.FakeServer() for node in NODES}
+    api.qwen_api.cache_shards = CacheShards({
+        node: fakeredis.aioredis.FakeRedis(server=server, decode_responses=True) for node, server in servers.items()
+    })
+    yield servers
+    api.qwen_api.cache_shards = None
+
+
+def test_keys_live_on_their_owner(api, shards):
+    qwen_api = api.qwen_api
+    cache = qwen_api.cache_shards
+    keys = [f"qwen:response:{i}" for i in range(60)]
+
+    async def run():
+        for key in keys:
+            await qwen_api.store_in_cache(key, f"value of {key}")
+        placement = {}
+        for node, client in cache.clients.items():
+            placement[node] = (set(await client.keys("qwen:response:*")),
+                               set(await client.zrange(api.CACHE_HITS_KEY, 0, -1)))
+        values = await cache.mget(list(reversed(keys)) + ["qwen:response:missing"])
+        qwen_api.memory_cache.clear()
+        hit = await qwen_api.get_from_cache(keys[0])
+        return placement, values, hit, await cache.client_for(keys[0]).zscore(api.CACHE_HITS_KEY, keys[0])
+
+    placement, values, hit, hits = asyncio.run(run())
+    for node, (stored, ranked) in placement.items():
+        owned = {key for key in keys if cache.ring.owner(key) == node}
+        # Every node gets some keys, and only its own, hit ranking included
+        assert owned and stored == owned and ranked == owned
+    assert values == [f"value of {key}" for key in reversed(keys)] + [None]
+    assert hit == f"value of {keys[0]}" and hits == 1
+
+
+def test_node_down_misses_only_its_keys(api, shards):
+    qwen_api = api.qwen_api
+    cache = qwen_api.cache_shards
+    down = NODES[1]
+    keys = [f"qwen:response:{i}" for i in range(30)]
+
+    async def run():
+        for key in keys:
+            await qwen_api.store_in_cache(key, f"value of {key}")
+        qwen_api.memory_cache.clear()
+        shards[down].connected = False
+        # Reads and writes for the lost node fail softly, as misses
+        values = {key: await qwen_api.get_from_cache(key) for key in keys}
+        await qwen_api.store_in_cache("qwen:response:new", "new value")
+        with pytest.raises(Exception):
+            await cache.ping()
+        return values
+
+    values = asyncio.run(run())
+    for key, value in values.items():
+        assert value == (None if cache.ring.owner(key) == down else f"value of {key}")
+
+
+def test_requests_served_and_limited_with_every_cache_node_down(api, shards):
+    for server in shards.values():
+        server.connected = False
+
+    async def run():
+        api_key = await api.api_key_manager.create_api_key("shard-user", tier="standard")
+        headers = {"Authorization": f"Bearer {api_key}"}
+        async with api_client(api.app) as client:
+            return [await client.post("/v1/generate", headers=headers, json={"prompt": "hi", "max_tokens": 2})
+                    for _ in range(6)]
+
+    responses = asyncio.run(run())
+    capacity, _ = api.rate_limiter.limit_for("standard")
+    # The buckets live with the API keys, so losing the cache does not lift the limit
+    assert [r.status_code for r in responses] == [200] * capacity + [429] * (6 - capacity)
+    assert [r.headers["x-ratelimit-remaining"] for r in responses[:capacity]] == [
+        str(remaining) for remaining in range(capacity - 1, -1, -1)
+    ]
+
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_cache_warm.py
+"""Hit ranking, memory-cache warmup and cache export/import"""
+import asyncio
+import gzip
+import json
+
+import fakeredis
+
+from conftest import api_client
+
+
+def test_memory_hits_are_counted(api):
+    qwen_api = api.qwen_api
+    key = "qwen:response:hot"
+
+    async def run():
+        await qwen_api.store_in_cache(key, "value")
+        for _ in range(3):
+            assert await qwen_api.get_from_cache(key) == "value"
+        # The counter updates run after the hits, none is left pending
+        await asyncio.gather(*qwen_api.background_tasks)
+        return len(qwen_api.background_tasks), await qwen_api.redis_client.zscore(api.CACHE_HITS_KEY, key)
+
+    assert asyncio.run(run()) == (0, 3)
+
+
+async def store_ranked(api, hits: dict):
+    for key, count in hits.items():
+        await api.qwen_api.store_in_cache(key, f"value of {key}")
+        await api.qwen_api.redis_client.zadd(api.CACHE_HITS_KEY, {key: count})
+    api.qwen_api.memory_cache.clear()
+
+
+def test_warm_loads_the_hottest_entries(api):
+    qwen_api = api.qwen_api
+    hits = {f"qwen:response:{i}": i for i in range(10)}
+
+    async def run():
+        await store_ranked(api, hits)
+        # Expired in Redis but still ranked
+        await qwen_api.redis_client.delete("qwen:response:9")
+        loaded = await qwen_api.warm_cache(limit=4)
+        return loaded, await qwen_api.redis_client.zscore(api.CACHE_HITS_KEY, "qwen:response:9")
+
+    loaded, expired_rank = asyncio.run(run())
+    assert loaded == 3 and expired_rank is None
+    assert len(qwen_api.memory_cache) == 3
+    assert all(f"qwen:response:{i}" in qwen_api.memory_cache for i in (6, 7, 8))
+
+
+def test_export_import_round_trip(api):
+    qwen_api = api.qwen_api
+    hits = {f"qwen:response:{i}": i for i in range(5)}
+
+    async def run():
+        await store_ranked(api, hits)
+        await qwen_api.redis_client.expire("qwen:response:3", 600)
+        payload = await qwen_api.export_cache()
+
+        # Into an empty Redis, as on a new node
+        qwen_api.redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        qwen_api.cache_shards = None
+        imported = await qwen_api.import_cache(payload, warm=False)
+        redis_client = qwen_api.redis_client
+        return payload, imported, {
+            key: (await redis_client.get(key), await redis_client.zscore(api.CACHE_HITS_KEY, key),
+                  await redis_client.ttl(key))
+            for key in hits
+        }
+
+    payload, imported, restored = asyncio.run(run())
+    lines = [json.loads(line) for line in gzip.decompress(payload).decode().splitlines()]
+    assert [entry["k"] for entry in lines] == [f"qwen:response:{i}" for i in range(4, -1, -1)]
+    assert imported == 5
+    for key, (value, rank, ttl) in restored.items():
+        assert value == f"value of {key}" and rank == hits[key]
+        assert 0 < ttl <= (600 if key == "qwen:response:3" else api.CACHE_TTL_SECONDS)
+
+
+def test_import_rejects_malformed_files(api):
+    good = {"k": "qwen:response:ok", "v": "value", "h": 1, "t": 60}
+    files = [
+        b"not gzip",
+        gzip.compress(b"not json"),
+        gzip.compress((json.dumps(good) + "\n" + json.dumps({"k": "qwen:response:bad", "v": "value"})).encode()),
+        gzip.compress(json.dumps({**good, "t": -1}).encode()),
+        gzip.compress(json.dumps([good]).encode()),
+    ]
+
+    async def run():
+        api_key = await api.api_key_manager.create_api_key("cache-admin", permissions=["admin"], tier="admin")
+        async with api_client(api.app) as client:
+            responses = [
+                await client.post("/admin/cache/import", headers={"Authorization": f"Bearer {api_key}"}, content=body)
+                for body in files
+            ]
+        return responses, await api.qwen_api.redis_client.exists("qwen:response:ok")
+
+    responses, written = asyncio.run(run())
+    assert [r.status_code for r in responses] == [400] * len(files)
+    # Nothing from a rejected file is written, its valid lines included
+    assert written == 0
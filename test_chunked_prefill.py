@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_chunked_prefill.py
+"""Chunked prefill on the generation engine: same tokens, decodes keep going during a long prefill"""
+import random
+import threading
+
+import torch
+
+from generation_engine import GenerationEngine
+from paged_kv import PagedKVPool
+
+
+class RecordingEngine(GenerationEngine):
+    """Keeps the (request, tokens fed) batches of every forward pass, stepped by hand"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.steps = []
+
+    def step(self) -> bool:
+        self.steps.append([])
+        return super().step()
+
+    def _forward(self, batch):
+        self.steps[-1] += [(request, count) for request, count in batch]
+        return super()._forward(batch)
+
+    def run(self):
+        while self.step():
+            pass
+        self.steps = [fed for fed in self.steps if fed]
+
+
+def prompt(length: int, seed: int):
+    rng = random.Random(seed)
+    return [rng.randint(32, 126) for _ in range(length)]
+
+
+def test_chunked_prefill_gives_the_same_tokens(stand_in):
+    model, tokenizer = stand_in
+    long = prompt(150, 0)
+    outputs = {}
+    for chunk in (16, 10**9):
+        engine = RecordingEngine(model, tokenizer, "cpu", pool=PagedKVPool(model, 64, 8), chunk_tokens=chunk)
+        future = engine.submit(long, threading.Event(), 12, 0.0, 1.0, [])
+        engine.run()
+        outputs[chunk] = future.result()["token_ids"]
+        # ceil(150 / 16) chunks, or the whole prompt at once
+        prefill = [count for fed in engine.steps for _, count in fed if count > 1]
+        assert prefill == ([16] * 9 + [6] if chunk == 16 else [150])
+
+    with torch.inference_mode():
+        output = model.generate(
+            input_ids=torch.tensor([long]), attention_mask=torch.ones(1, len(long), dtype=torch.long),
+            max_new_tokens=12, do_sample=False, pad_token_id=tokenizer.pad_token_id
+        )
+    assert outputs[16] == outputs[10**9] == output[0, len(long):].tolist()
+
+
+def test_decodes_continue_while_a_long_prompt_is_prefilled(stand_in):
+    model, tokenizer = stand_in
+    engine = RecordingEngine(model, tokenizer, "cpu", pool=PagedKVPool(model, 128, 8),
+                             step_tokens=40, chunk_tokens=32)
+    shorts = [engine.submit(prompt(6, seed), threading.Event(), 30, 0.0, 1.0, []) for seed in (1, 2)]
+    # Both short prompts computed, then the long one arrives
+    engine.step()
+    engine.step()
+    long = engine.submit(prompt(300, 3), threading.Event(), 1, 0.0, 1.0, [])
+    engine.run()
+
+    assert long.done() and all(short.result()["generated_tokens"] == 30 for short in shorts)
+    short_requests = {request for fed in engine.steps[:2] for request, _ in fed}
+    prefill_steps = [fed for fed in engine.steps if any(count > 1 and r not in short_requests for r, count in fed)]
+    assert len(prefill_steps) == 10  # 300 tokens, 32 at a time
+    for fed in prefill_steps:
+        # Every step still advances each short request by one token, within the step budget
+        assert sorted(count for r, count in fed if r in short_requests) == [1, 1]
+        assert sum(count for _, count in fed) <= 40
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_completion_cache.py
+"""Greedy completions served across max_tokens: cut from the cache, or resumed after it"""
+import asyncio
+import json
+import threading
+
+from prometheus_client import REGISTRY
+
+from completion_cache import resume_point
+
+PROMPT = list(range(30, 60))
+
+
+def subsumed(mode: str) -> float:
+    return REGISTRY.get_sample_value("qwen_cache_subsumed_total", {"mode": mode}) or 0.0
+
+
+def resumed_tokens() -> float:
+    return REGISTRY.get_sample_value("qwen_cache_resumed_tokens_total") or 0.0
+
+
+def answer(result: dict) -> tuple:
+    return json.loads(str(result["text_json"])), result["finish_reason"], result["completion_tokens"]
+
+
+class Generations:
+    """Greedy requests against the stand-in, recording the max_tokens actually decoded"""
+
+    def __init__(self, api, monkeypatch):
+        self.qwen_api = api.qwen_api
+        self.decoded = []
+        run_generation = self.qwen_api.run_generation
+
+        async def recording(input_ids, cancel_event, **kwargs):
+            self.decoded.append(kwargs["max_tokens"])
+            return await run_generation(input_ids, cancel_event, **kwargs)
+
+        monkeypatch.setattr(self.qwen_api, "run_generation", recording)
+
+    async def request(self, max_tokens: int, stop=None) -> dict:
+        return await self.qwen_api.generate_from_tokens(list(PROMPT), max_tokens, 0.0, 1.0, stop)
+
+    async def fresh(self, max_tokens: int, stop=None) -> dict:
+        """The same request decoded from scratch, nothing cached"""
+        self.qwen_api.memory_cache.clear()
+        await self.qwen_api.redis_client.flushdb()
+        return await self.request(max_tokens, stop)
+
+
+def test_longer_cached_answer_is_cut_down(api, monkeypatch):
+    generations = Generations(api, monkeypatch)
+    truncated = subsumed("truncated")
+
+    async def run():
+        expected = await generations.fresh(6)
+        await generations.fresh(20)
+        generations.decoded.clear()
+        return expected, await generations.request(6)
+
+    expected, result = asyncio.run(run())
+    assert result["cached"] and generations.decoded == []
+    assert answer(result) == answer(expected) and expected["finish_reason"] == "length"
+    assert subsumed("truncated") == truncated + 1
+
+
+def test_shorter_cached_answer_is_resumed(api, monkeypatch):
+    generations = Generations(api, monkeypatch)
+    resumed, tokens = subsumed("resumed"), resumed_tokens()
+
+    async def run():
+        expected = await generations.fresh(20)
+        await generations.fresh(8)
+        generations.decoded.clear()
+        result = await generations.request(20)
+        # The resumed completion is cached whole and now covers the longer request
+        return expected, result, await generations.request(20)
+
+    expected, result, again = asyncio.run(run())
+    # Only the 12 tokens after the cached 8 are decoded
+    assert not result["cached"] and generations.decoded == [12]
+    assert answer(result) == answer(expected) and expected["completion_tokens"] == 20
+    assert subsumed("resumed") == resumed + 1 and resumed_tokens() == tokens + 8
+    assert again["cached"] and answer(again) == answer(expected)
+
+
+def test_stop_string_inside_the_cached_text(api, monkeypatch):
+    generations = Generations(api, monkeypatch)
+    tokenizer = api.qwen_api.tokenizer
+
+    async def pick_stop():
+        # The greedy completion, to take a stop string from its middle
+        result = await generations.qwen_api.run_generation(
+            list(PROMPT), threading.Event(), max_tokens=24, temperature=0.0, top_p=1.0, stop=[]
+        )
+        return result["token_ids"]
+
+    token_ids = asyncio.run(pick_stop())
+    # Tokens 21 and 22 ("\x0fe" for this prompt), first seen there
+    stop = [tokenizer.decode(token_ids[21:23], skip_special_tokens=True)]
+    assert stop[0] and stop[0] not in tokenizer.decode(token_ids[:22], skip_special_tokens=True)
+
+    async def requests():
+        results = {}
+        for label, first, then in [("cut", 24, 30), ("before", 24, 6), ("seam", 22, 24)]:
+            expected = await generations.fresh(then, stop)
+            await generations.fresh(first, stop)
+            generations.decoded.clear()
+            results[label] = (expected, await generations.request(then, stop), list(generations.decoded))
+        return results
+
+    results = asyncio.run(requests())
+    expected, result, decoded = results["cut"]
+    # Ended by the stop string: served for any limit, the cut text and "stop" as they were
+    assert expected["finish_reason"] == "stop" and result["cached"] and decoded == []
+    assert answer(result) == answer(expected)
+
+    expected, result, decoded = results["before"]
+    # A limit short of the stop string: the plain cut, no stop
+    assert result["cached"] and decoded == [] and answer(result) == answer(expected)
+    assert expected["finish_reason"] == "length"
+
+    expected, result, decoded = results["seam"]
+    # The stop string starts in the cached tokens and ends in the resumed ones; the
+    # decode redoes an overlap of the cached tokens to see it, then stops where a fresh one would
+    resumed = len(resume_point(token_ids[:22], stop))
+    assert not result["cached"] and 0 < resumed < 22 and decoded == [24 - resumed]
+    assert answer(result) == answer(expected) and result["finish_reason"] == "stop"
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_disconnect.py
+"""A client that hangs up mid-generation: 499, counted as a disconnect, not an error"""
+import asyncio
+import json
+
+from prometheus_client import REGISTRY
+
+
+def sample(name: str, labels: dict) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+async def post_then_disconnect(app, path: str, body: dict, api_key: str) -> int:
+    """Raw ASGI call whose client is gone as soon as the body has been read.
+
+    The disconnect is delivered once, later receive() calls never return.
+    """
+    messages = [{"type": "http.request", "body": json.dumps(body).encode(), "more_body": False},
+                {"type": "http.disconnect"}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"localhost"), (b"content-type", b"application/json"),
+                    (b"authorization", f"Bearer {api_key}".encode())],
+        "client": ("127.0.0.1", 50000), "server": ("localhost", 80),
+    }
+    await app(scope, receive, send)
+    return sent[0]["status"]
+
+
+def test_disconnect_is_not_an_error(api):
+    errors = {"endpoint": "generate", "status": "error"}
+    disconnects = {"reason": "disconnect"}
+    errors_before = sample("qwen_requests_total", errors)
+    disconnects_before = sample("qwen_early_stops_total", disconnects)
+
+    # Greedy decoding on the stand-in model runs to max_tokens, only the disconnect ends it early
+    async def run():
+        api_key = await api.api_key_manager.create_api_key("gone-user", tier="standard")
+        return await post_then_disconnect(api.app, "/v1/generate", {"prompt": "count to a thousand", "max_tokens": 4096,
+                                                                     "temperature": 0.0}, api_key)
+
+    assert asyncio.run(run()) == 499
+    assert sample("qwen_early_stops_total", disconnects) == disconnects_before + 1
+    assert sample("qwen_requests_total", errors) == errors_before
+    # Partial output is not cached
+    assert len(api.qwen_api.memory_cache) == 0
+
+
+def test_batch_disconnect_stops_every_item(api):
+    errors = {"endpoint": "batch", "status": "error"}
+    disconnects = {"reason": "disconnect"}
+    errors_before = sample("qwen_requests_total", errors)
+    disconnects_before = sample("qwen_early_stops_total", disconnects)
+    items = [{"prompt": f"count to {n}", "max_tokens": 4096, "temperature": 0.0} for n in (1000, 2000, 3000)]
+
+    async def run():
+        api_key = await api.api_key_manager.create_api_key("gone-batch-user", tier="standard")
+        return await asyncio.wait_for(
+            post_then_disconnect(api.app, "/v1/batch/generate", {"requests": items}, api_key), timeout=120
+        )
+
+    assert asyncio.run(run()) == 499
+    assert sample("qwen_early_stops_total", disconnects) == disconnects_before + len(items)
+    assert sample("qwen_requests_total", errors) == errors_before
+    assert len(api.qwen_api.memory_cache) == 0
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_embeddings.py
+"""/v1/embeddings: vectors, the content-hash cache and the input length limit"""
+import asyncio
+import math
+
+from conftest import api_client
+
+
+async def embed(api, inputs, **extra):
+    api_key = await api.api_key_manager.create_api_key("embedding-user", tier="admin")
+    async with api_client(api.app) as client:
+        return await client.post("/v1/embeddings", headers={"Authorization": f"Bearer {api_key}"},
+                                 json={"input": inputs, **extra})
+
+
+def test_embeddings_are_cached_by_content(api):
+    async def run():
+        first = await embed(api, ["alpha", "beta", "alpha"])
+        again = await api.qwen_api.get_embeddings(["beta", "alpha"])
+        return first, again
+
+    first, again = asyncio.run(run())
+    assert first.status_code == 200
+    data = first.json()["data"]
+    assert [item["index"] for item in data] == [0, 1, 2]
+    # L2-normalized, identical inputs get the same vector
+    assert all(math.isclose(sum(x * x for x in item["embedding"]), 1.0, rel_tol=1e-4) for item in data)
+    assert data[0]["embedding"] == data[2]["embedding"] != data[1]["embedding"]
+    assert again["cached"]
+
+
+def test_inputs_over_the_token_limit_are_rejected(api, monkeypatch):
+    tokenizer = api.qwen_api.tokenizer
+    short, long = "short text", "a much longer text " * 20
+    limit = len(tokenizer(short).input_ids) + 5
+    monkeypatch.setattr(api, "EMBEDDING_MAX_TOKENS", limit)
+
+    async def run():
+        return await embed(api, [short, long]), await embed(api, short)
+
+    rejected, accepted = asyncio.run(run())
+    # Not embedded truncated: the caller learns which input is too long
+    assert rejected.status_code == 400
+    assert rejected.json()["detail"] == (
+        f"input[1] is {len(tokenizer(long).input_ids)} tokens, over the limit of {limit}"
+    )
+    assert accepted.status_code == 200
+    assert accepted.json()["usage"]["prompt_tokens"] == len(tokenizer(short).input_ids)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_fim.py
+"""/v1/completions: FIM prompt assembly, stop strings, priority lane and prefix reuse"""
+import asyncio
+import json
+
+from prometheus_client import REGISTRY
+
+import model_runtime
+from completion_cache import truncate_at_stop
+from conftest import api_client
+from memory_monitor import AdjustableSemaphore
+from prefix_cache import PrefixKVCache
+
+PREFIX = "import os\n\ndef main():\n    path = "
+SUFFIX = "\n    print(path)\n"
+
+
+def record_generations(api, monkeypatch) -> list:
+    """(input_ids, kwargs) of every run_generation call"""
+    calls = []
+    run_generation = api.qwen_api.run_generation
+
+    async def recording(input_ids, cancel_event, **kwargs):
+        calls.append((input_ids, kwargs))
+        return await run_generation(input_ids, cancel_event, **kwargs)
+
+    monkeypatch.setattr(api.qwen_api, "run_generation", recording)
+    return calls
+
+
+async def complete(api, **body):
+    api_key = await api.api_key_manager.create_api_key("fim-user", tier="admin")
+    async with api_client(api.app) as client:
+        return await client.post("/v1/completions", headers={"Authorization": f"Bearer {api_key}"},
+                                 json={"prefix": PREFIX, "suffix": SUFFIX, "max_tokens": 8, **body})
+
+
+def test_fim_prompt_and_engine_params(api, monkeypatch):
+    calls = record_generations(api, monkeypatch)
+    tokenizer = api.qwen_api.tokenizer
+
+    async def run():
+        return [await complete(api, mode="line"), await complete(api, mode="block", stop=["#"])]
+
+    responses = asyncio.run(run())
+    assert [r.status_code for r in responses] == [200, 200]
+    assert responses[0].json()["object"] == "text_completion"
+
+    (input_ids, line), (_, block) = calls
+    # Built directly with the FIM tokens, no chat template
+    assert input_ids == tokenizer(f"<|fim_prefix|>{PREFIX}<|fim_suffix|>{SUFFIX}<|fim_middle|>").input_ids
+    vocab = tokenizer.get_vocab()
+    assert input_ids[0] == vocab["<|fim_prefix|>"] and input_ids[-1] == vocab["<|fim_middle|>"]
+    assert line["stop"] == ["\n"] and block["stop"] == ["\n\n", "#"]
+    # The FIM end tokens known to this tokenizer end the middle, besides its eos
+    assert line["eos_token_ids"] == sorted({tokenizer.eos_token_id, vocab["<|endoftext|>"]})
+    assert line["priority"] and line["use_prefix_cache"]
+
+
+def test_stop_strings_cut_the_middle(api):
+    async def run():
+        full = await api.qwen_api.complete_fim(PREFIX, SUFFIX, 16, 0.0, [])
+        api.qwen_api.memory_cache.clear()
+        return json.loads(full["text_json"]), await complete(api, mode="line", stop=["N"], max_tokens=16)
+
+    # The middle this prompt gets from the stand-in, "\x11N" repeated
+    full, response = asyncio.run(run())
+    choice = response.json()["choices"][0]
+    assert "N" in full and choice["finish_reason"] == "stop"
+    assert choice["text"] == truncate_at_stop(full, ["\n", "N"]) != full
+
+
+def test_fim_takes_the_priority_lane(api, monkeypatch):
+    qwen_api = api.qwen_api
+    monkeypatch.setattr(qwen_api, "generation_slots", AdjustableSemaphore(1))
+    fim_prefix = qwen_api.tokenizer.get_vocab()["<|fim_prefix|>"]
+    order = []
+    generate_tokens = model_runtime.generate_tokens
+
+    def recording(model, tokenizer, device, input_ids, *args, **kwargs):
+        order.append("fim" if input_ids[0] == fim_prefix else "chat")
+        return generate_tokens(model, tokenizer, device, input_ids, *args, **kwargs)
+
+    monkeypatch.setattr(model_runtime, "generate_tokens", recording)
+
+    async def run():
+        await qwen_api.generation_slots.acquire()
+        # Queued first, but the autocomplete request queued after it goes first
+        chat = asyncio.create_task(qwen_api.generate_response("hello", 4, 0.0, 1.0))
+        await asyncio.sleep(0.05)
+        fim = asyncio.create_task(qwen_api.complete_fim(PREFIX, SUFFIX, 4, 0.0, ["\n"]))
+        await asyncio.sleep(0.05)
+        assert order == []
+        await qwen_api.generation_slots.release()
+        await asyncio.gather(chat, fim)
+
+    asyncio.run(run())
+    assert order == ["fim", "chat"]
+
+
+def test_edits_at_the_cursor_reuse_the_prefix_kv(api, monkeypatch):
+    qwen_api = api.qwen_api
+    monkeypatch.setattr(qwen_api, "prefix_cache", PrefixKVCache(min_tokens=8))
+    prefix = "".join(f"def f{i}(x):\n    return x + {i}\n\n" for i in range(4))
+
+    def reused() -> float:
+        return REGISTRY.get_sample_value("qwen_prefix_cache_reused_tokens_total") or 0.0
+
+    async def run():
+        await qwen_api.complete_fim(prefix, "", 4, 0.0, ["\n"])
+        before = reused()
+        # The user typed on: same file context, a new suffix
+        await qwen_api.complete_fim(prefix, "\nprint(f0(1))\n", 4, 0.0, ["\n"])
+        return reused() - before
+
+    shared = len(qwen_api.tokenizer(f"<|fim_prefix|>{prefix}").input_ids)
+    assert asyncio.run(run()) >= shared
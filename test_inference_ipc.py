@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_inference_ipc.py
+"""HTTP worker <-> inference process IPC over a temporary Unix socket"""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+
+import pytest
+
+import inference_ipc
+from conftest import api_client
+from inference_ipc import HEADER, MAX_FRAME_SIZE, InferenceClient, InferenceError, InferenceServer, encode_frame, read_frame
+
+# A worker whose generations never finish, so it can be killed mid-request
+HANGING_WORKER = """
+import asyncio, sys
+from inference_ipc import InferenceServer
+
+async def hang(message, cancel_event):
+    await asyncio.sleep(3600)
+
+asyncio.run(InferenceServer({"generate": hang}, sys.argv[1]).serve_forever())
+"""
+
+
+@pytest.fixture
+def socket_path():
+    # tmp_path can exceed the ~100 byte limit on Unix socket paths
+    with tempfile.TemporaryDirectory() as directory:
+        yield os.path.join(directory, "inference.sock")
+
+
+async def wait_for(condition, timeout: float = 30.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.02)
+
+
+def test_frame_codec():
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_frame({"id": 1, "op": "generate", "input_ids": [1, 2, 3]}))
+        reader.feed_data(encode_frame({"id": 2, "op": "cancel"}))
+        reader.feed_data(HEADER.pack(MAX_FRAME_SIZE + 1))
+        frames = [await read_frame(reader), await read_frame(reader)]
+        with pytest.raises(InferenceError):
+            await read_frame(reader)
+
+        truncated = asyncio.StreamReader()
+        truncated.feed_data(encode_frame({"id": 3})[:-2])
+        truncated.feed_eof()
+        return frames, await read_frame(truncated)
+
+    frames, eof = asyncio.run(run())
+    assert frames == [{"id": 1, "op": "generate", "input_ids": [1, 2, 3]}, {"id": 2, "op": "cancel"}]
+    assert eof is None
+
+
+def test_generate_and_cancel(api, socket_path, monkeypatch):
+    from inference_worker import handle_generate
+
+    monkeypatch.setattr(inference_ipc, "CANCEL_POLL_INTERVAL", 0.05)
+    prompt = api.qwen_api.tokenizer.encode("count to a thousand")
+
+    async def run():
+        server = asyncio.create_task(InferenceServer({"generate": handle_generate}, socket_path).serve_forever())
+        client = InferenceClient(socket_path)
+        try:
+            await wait_for(lambda: os.path.exists(socket_path))
+            local = await api.qwen_api.run_generation(prompt, threading.Event(), 8, 0.0, 1.0, [])
+            remote = await client.run_generation(prompt, threading.Event(), max_tokens=8, temperature=0.0,
+                                                 top_p=1.0, stop=[])
+            with pytest.raises(InferenceError) as unknown:
+                await client.call("tokenize")
+
+            # Greedy decoding runs to max_tokens, only the cancel frame ends it early
+            cancel_event = threading.Event()
+            asyncio.get_running_loop().call_later(0.2, cancel_event.set)
+            cancelled = await client.run_generation(prompt, cancel_event, max_tokens=4096, temperature=0.0,
+                                                    top_p=1.0, stop=[])
+            return local, remote, unknown.value, cancelled
+        finally:
+            client.writer and client.writer.close()
+            server.cancel()
+
+    local, remote, unknown, cancelled = asyncio.run(run())
+    assert remote["text"] == local["text"] and remote["generated_tokens"] == 8
+    assert unknown.status_code == 400
+    assert cancelled["stopped"] == "disconnect" and cancelled["generated_tokens"] < 4096
+
+
+def test_worker_dying_mid_request(api, socket_path, monkeypatch):
+    worker = subprocess.Popen([sys.executable, "-c", HANGING_WORKER, socket_path],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    client = InferenceClient(socket_path)
+    monkeypatch.setattr(api.qwen_api, "inference_client", client)
+
+    async def run():
+        await wait_for(lambda: os.path.exists(socket_path))
+        api_key = await api.api_key_manager.create_api_key("ipc-user", tier="standard")
+        async with api_client(api.app) as http:
+            request = asyncio.create_task(http.post("/v1/generate", headers={"Authorization": f"Bearer {api_key}"},
+                                                    json={"prompt": "hi", "max_tokens": 8}))
+            await wait_for(lambda: client.pending)
+            worker.send_signal(signal.SIGKILL)
+            crashed = await asyncio.wait_for(request, timeout=30)
+            # Nothing listens on the socket anymore until the worker is restarted
+            after = await http.post("/v1/generate", headers={"Authorization": f"Bearer {api_key}"},
+                                    json={"prompt": "hi again", "max_tokens": 8})
+            return crashed, after
+
+    try:
+        crashed, after = asyncio.run(run())
+    finally:
+        worker.kill()
+        worker.wait()
+    assert crashed.status_code == 503 and crashed.json()["detail"] == "Inference process unavailable"
+    assert after.status_code == 503 and after.json()["detail"] == "Model not loaded yet"
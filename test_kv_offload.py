@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_kv_offload.py
+"""Offloaded prefix KV blocks: tier LRU and spill, restore vs recompute, engine round trip"""
+import random
+import threading
+
+import pytest
+from prometheus_client import REGISTRY
+
+from generation_engine import GenerationEngine
+from kv_offload import TieredKVStore
+from paged_kv import PagedKVPool
+
+BLOCK = 8
+
+
+def decisions(choice: str) -> float:
+    return REGISTRY.get_sample_value("qwen_kv_restore_decisions_total", {"choice": choice}) or 0.0
+
+
+def restored(tier: str) -> float:
+    return REGISTRY.get_sample_value("qwen_kv_offload_restored_total", {"tier": tier}) or 0.0
+
+
+def store(pool: PagedKVPool, host_blocks: int, disk_blocks: int, disk_dir) -> TieredKVStore:
+    return TieredKVStore(pool, host_blocks * pool.bytes_per_block / 2**30,
+                         disk_blocks * pool.bytes_per_block / 2**30, str(disk_dir))
+
+
+def fill(pool: PagedKVPool, block: int, value: float):
+    for keys, values in zip(pool.keys, pool.values):
+        keys[block * BLOCK:(block + 1) * BLOCK] = value
+        values[block * BLOCK:(block + 1) * BLOCK] = -value
+
+
+def block_values(pool: PagedKVPool, block: int):
+    return [float(keys[block * BLOCK].flatten()[0]) for keys in pool.keys] + \
+        [float(values[block * BLOCK].flatten()[0]) for values in pool.values]
+
+
+@pytest.fixture
+def pool(stand_in):
+    return PagedKVPool(stand_in[0], 8, BLOCK)
+
+
+def test_host_spills_to_disk_then_drops(pool, tmp_path):
+    offload = store(pool, 2, 2, tmp_path)
+    host, disk = offload.tiers
+    for block_hash in range(5):
+        fill(pool, 0, block_hash + 1.0)
+        offload.offload(block_hash, pool, 0)
+
+    # Least recently used first: 0 dropped, 1 and 2 on disk, 3 and 4 in host RAM
+    assert (list(host.slots), list(disk.slots)) == ([3, 4], [1, 2])
+    # Every tier returns the block's data as it was
+    for block_hash in (1, 4):
+        assert offload.restore(block_hash, pool, 1)
+        assert block_values(pool, 1) == [block_hash + 1.0] * len(pool.keys) + [-(block_hash + 1.0)] * len(pool.keys)
+    assert not offload.restore(0, pool, 1)
+    offload.close()
+
+
+def test_prefetch_moves_disk_blocks_to_host(pool, tmp_path):
+    offload = store(pool, 2, 4, tmp_path)
+    host, disk = offload.tiers
+    for block_hash in range(4):
+        fill(pool, 0, block_hash + 1.0)
+        offload.offload(block_hash, pool, 0)
+    assert list(disk.slots) == [0, 1]
+
+    offload.prefetch([0, 1, 7])
+    offload.close()  # waits for the prefetch
+    # Host RAM made room by spilling its own blocks to disk
+    assert list(host.slots) == [0, 1] and sorted(disk.slots) == [0, 1, 2, 3]
+    assert offload.restore(0, pool, 1) and block_values(pool, 1)[0] == 1.0
+
+
+def test_restore_only_while_cheaper_than_recompute(pool, tmp_path):
+    offload = store(pool, 4, 0, tmp_path)
+    for block_hash in range(3):
+        offload.offload(block_hash, pool, 0)
+    restore, recompute = decisions("restore"), decisions("recompute")
+
+    # Nothing measured yet: restore (that is how restores get measured); stop at the first miss
+    assert offload.plan([0, 1, 9, 2]) == [0, 1]
+    offload.observe_prefill(tokens=64, seconds=0.08)
+    assert offload.recompute_cost == pytest.approx(0.01)
+    offload.restore_cost["host"] = 0.001
+    assert offload.plan([0, 1, 2]) == [0, 1, 2]
+    offload.restore_cost["host"] = 0.05
+    assert offload.plan([0, 1, 2]) == []
+    assert decisions("recompute") == recompute + 1 and decisions("restore") == restore
+    offload.close()
+
+
+def test_engine_restores_an_evicted_session(stand_in, tmp_path):
+    model, tokenizer = stand_in
+    rng = random.Random(0)
+    sessions = [[rng.randint(32, 126) for _ in range(64)] for _ in range(4)]
+    follow_up = sessions[0] + [rng.randint(32, 126) for _ in range(5)]
+
+    def run(offload_blocks: int, recompute_cheaper: bool = False):
+        # Room for two sessions' prefixes: the later ones evict all of the first
+        pool = PagedKVPool(model, 20, BLOCK)
+        offload = store(pool, offload_blocks, 0, tmp_path) if offload_blocks else None
+        engine = GenerationEngine(model, tokenizer, "cpu", pool=pool, offload=offload)
+        engine.start()
+        try:
+            for prompt in sessions:
+                engine.generate(prompt, threading.Event(), 4, 0.0, 1.0, [], eos_token_ids=[-1])
+            if recompute_cheaper:
+                offload.restore_cost["host"], offload.recompute_cost = 1.0, 0.001
+            return engine.generate(follow_up, threading.Event(), 4, 0.0, 1.0, [], eos_token_ids=[-1])
+        finally:
+            engine.stop()
+
+    recomputed = run(0)
+    before = restored("host")
+    result = run(32)
+    assert recomputed["prefix_tokens_reused"] == 0
+    # The first session's 8 prompt blocks come back from host RAM, same output
+    assert result["prefix_tokens_reused"] == 64 and restored("host") == before + 8
+    assert result["token_ids"] == recomputed["token_ids"]
+
+    recompute = decisions("recompute")
+    skipped = run(32, recompute_cheaper=True)
+    assert skipped["prefix_tokens_reused"] == 0 and decisions("recompute") == recompute + 1
+    assert skipped["token_ids"] == recomputed["token_ids"]
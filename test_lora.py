@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_lora.py
+"""LoRA adapters on the stand-in model: loading, LRU eviction, and deltas matching merged weights"""
+import copy
+import json
+import os
+import threading
+
+import pytest
+import torch
+from prometheus_client import REGISTRY
+from safetensors.torch import save_file
+
+from lora_adapters import LORA_TARGET_MODULES, AdapterRegistry, LoRALinear, UnknownAdapter, activate, attach_lora
+from model_runtime import generate_tokens
+from prefix_cache import PrefixKVCache
+
+PROMPT = list(range(30, 60))
+
+
+def write_adapter(path: str, model, seed: int, rank: int = 4):
+    """PEFT LoRA checkpoint with random A and B for every target projection"""
+    generator = torch.Generator().manual_seed(seed)
+    tensors = {}
+    for name, module in model.named_modules():
+        if name.split(".")[-1] in LORA_TARGET_MODULES and isinstance(module, torch.nn.Linear):
+            out_features, in_features = module.weight.shape
+            tensors[f"base_model.model.{name}.lora_A.weight"] = torch.randn(rank, in_features, generator=generator)
+            tensors[f"base_model.model.{name}.lora_B.weight"] = torch.randn(out_features, rank, generator=generator) * 0.05
+    os.makedirs(path)
+    save_file(tensors, os.path.join(path, "adapter_model.safetensors"))
+    with open(os.path.join(path, "adapter_config.json"), "w") as f:
+        json.dump({"peft_type": "LORA", "r": rank, "lora_alpha": 2 * rank}, f)
+
+
+def counter(name: str) -> float:
+    return REGISTRY.get_sample_value(name) or 0.0
+
+
+@pytest.fixture
+def lora(stand_in, tmp_path):
+    """(base model, model with LoRA layers, registry of adapters team-0..team-2 holding 2)"""
+    model, _ = stand_in
+    wrapped = copy.deepcopy(model)
+    attach_lora(wrapped)
+    for i in range(3):
+        write_adapter(str(tmp_path / f"team-{i}"), model, seed=i)
+    return model, wrapped, AdapterRegistry(wrapped, str(tmp_path), max_resident=2)
+
+
+def merged(model, adapter):
+    """Copy of the base model with the adapter folded into its weights"""
+    merged = copy.deepcopy(model)
+    modules = dict(merged.named_modules())
+    with torch.no_grad():
+        for path, (a, b) in adapter.layers.items():
+            modules[path].weight += (a @ b * adapter.scaling).t()
+    return merged
+
+
+def logits(model, input_ids) -> torch.Tensor:
+    with torch.inference_mode():
+        return model(input_ids=torch.tensor(input_ids)).logits
+
+
+def test_load(lora):
+    model, wrapped, registry = lora
+    loads = counter("qwen_lora_adapter_loads_total")
+    targets = [m for m in wrapped.modules() if isinstance(m, LoRALinear)]
+    adapter = registry.get("team-0")
+
+    assert len(targets) == 7 * model.config.num_hidden_layers
+    assert set(adapter.layers) == {m.path for m in targets}
+    assert adapter.scaling == 2.0 and adapter.nbytes > 0
+    assert registry.names() == ["team-0", "team-1", "team-2"]
+    assert registry.get("team-0") is adapter and counter("qwen_lora_adapter_loads_total") == loads + 1
+    for name in ("team-9", "../team-0", ".hidden"):
+        with pytest.raises(UnknownAdapter):
+            registry.get(name)
+
+
+def test_least_recently_used_adapter_is_evicted(lora):
+    _, _, registry = lora
+    evictions = counter("qwen_lora_adapter_evictions_total")
+    team_1 = registry.get("team-1")
+    registry.get("team-0")
+    registry.get("team-1")
+    registry.get("team-2")
+
+    assert list(registry.resident) == ["team-1", "team-2"]
+    assert counter("qwen_lora_adapter_evictions_total") == evictions + 1
+    # Loaded again on the next request
+    loads = counter("qwen_lora_adapter_loads_total")
+    assert registry.get("team-0") is not None and counter("qwen_lora_adapter_loads_total") == loads + 1
+    assert list(registry.resident) == ["team-2", "team-0"]
+    # Requests holding an evicted adapter keep using it
+    assert "team-1" not in registry.resident and team_1.layers
+
+
+def test_deltas_match_merged_weights(lora):
+    model, wrapped, registry = lora
+    team_0, team_1 = registry.get("team-0"), registry.get("team-1")
+    prompts = [PROMPT, PROMPT[::-1], PROMPT]
+
+    # No adapter active: the wrapped model is the base model
+    assert torch.allclose(logits(wrapped, prompts), logits(model, prompts), atol=1e-5)
+    with activate([team_0] * 3):
+        assert torch.allclose(logits(wrapped, prompts), logits(merged(model, team_0), prompts), atol=1e-4)
+    assert not torch.allclose(logits(merged(model, team_0), prompts), logits(model, prompts), atol=1e-2)
+
+    # One batch, a different adapter (or none) per row
+    with activate([team_0, None, team_1]):
+        mixed = logits(wrapped, prompts)
+    assert torch.allclose(mixed[0], logits(merged(model, team_0), prompts[:1])[0], atol=1e-4)
+    assert torch.allclose(mixed[1], logits(model, prompts[1:2])[0], atol=1e-5)
+    assert torch.allclose(mixed[2], logits(merged(model, team_1), prompts[2:])[0], atol=1e-4)
+
+
+def test_generation_with_an_adapter(lora, stand_in):
+    model, wrapped, registry = lora
+    tokenizer = stand_in[1]
+    adapter = registry.get("team-0")
+    prefix_cache = PrefixKVCache(min_tokens=8)
+
+    def greedy(m, adapter=None, prefix_cache=None):
+        return generate_tokens(m, tokenizer, "cpu", PROMPT, threading.Event(), max_tokens=12, temperature=0.0,
+                               top_p=1.0, stop=[], prefix_cache=prefix_cache, adapter=adapter)
+
+    expected = greedy(merged(model, adapter))["token_ids"]
+    assert greedy(wrapped, adapter, prefix_cache)["token_ids"] == expected != greedy(model)["token_ids"]
+    # Prompt KV state is only shared with requests for the same adapter (all but the last prompt token)
+    assert greedy(wrapped, adapter, prefix_cache)["prefix_tokens_reused"] == len(PROMPT) - 1
+    assert greedy(wrapped, registry.get("team-1"), prefix_cache)["prefix_tokens_reused"] == 0
+    assert greedy(wrapped, None, prefix_cache)["prefix_tokens_reused"] == 0
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_memory_pressure.py
+"""OOM recovery answers and memory-cache shedding under sustained pressure"""
+import asyncio
+
+import torch
+from prometheus_client import REGISTRY
+
+import model_runtime
+from conftest import api_client
+from memory_monitor import CRITICAL, HIGH, MemoryMonitor
+from prefix_cache import PrefixKVCache
+
+
+def test_oom_on_generate_keeps_retry_after(api, monkeypatch):
+    def out_of_memory(*args, **kwargs):
+        raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+
+    monkeypatch.setattr(model_runtime, "generate_tokens", out_of_memory)
+
+    async def run():
+        api_key = await api.api_key_manager.create_api_key("oom-user", tier="standard")
+        async with api_client(api.app) as client:
+            return await client.post("/v1/generate", headers={"Authorization": f"Bearer {api_key}"},
+                                     json={"prompt": "hi", "max_tokens": 8})
+
+    response = asyncio.run(run())
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "5"
+
+
+def test_sustained_pressure_sheds_once(api):
+    cache = api.qwen_api.memory_cache
+    for i in range(cache.maxsize):
+        cache[f"key-{i}"] = "response"
+    monitor = MemoryMonitor()
+    monitor.register("memory_cache", api.qwen_api._shed_memory_cache)
+
+    async def run():
+        sizes = []
+        # One monitor check per interval while usage stays above the high watermark
+        for _ in range(4):
+            await monitor.shed(HIGH)
+            sizes.append(len(cache))
+        await monitor.shed(CRITICAL)
+        sizes.append(len(cache))
+        return sizes
+
+    keep = int(cache.maxsize * api.MEMORY_SHED_KEEP)
+    assert asyncio.run(run()) == [keep, keep, keep, keep, 0]
+
+
+def test_kv_shedding_counts_only_what_it_freed(api, monkeypatch):
+    released = []
+    monkeypatch.setattr(model_runtime, "release_device_memory", lambda: released.append(True) or True)
+    prefix_cache = PrefixKVCache(max_entries=4, min_tokens=1)
+    for i in range(4):
+        prefix_cache.store(torch.tensor([i, i + 1]), model_runtime.DynamicCache())
+    monkeypatch.setattr(api.qwen_api, "prefix_cache", prefix_cache)
+    monitor = MemoryMonitor()
+    monitor.register("kv_cache", api.qwen_api._shed_kv_cache)
+    labels = {"action": "kv_cache"}
+    before = REGISTRY.get_sample_value("qwen_memory_shed_total", labels) or 0.0
+
+    async def run():
+        for _ in range(4):
+            await monitor.shed(HIGH)
+
+    asyncio.run(run())
+    assert len(prefix_cache) == int(4 * api.MEMORY_SHED_KEEP)
+    # Later checks under the same pressure find nothing left to drop
+    assert REGISTRY.get_sample_value("qwen_memory_shed_total", labels) == before + 1
+    assert len(released) == 1
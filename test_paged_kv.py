@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_paged_kv.py
+"""Paged KV pool and generation engine on the tiny stand-in Qwen2 model (CPU)"""
+import random
+import threading
+
+import pytest
+import torch
+
+from generation_engine import GenerationEngine
+from paged_kv import BlockTable, OutOfBlocks, PagedKVPool
+
+
+def test_greedy_matches_generate(stand_in):
+    model, tokenizer = stand_in
+    rng = random.Random(1)
+    prompts = [[rng.randint(0, 255) for _ in range(rng.randint(8, 60))] for _ in range(4)]
+    # Small blocks so prompts span several, some partly filled
+    engine = GenerationEngine(model, tokenizer, "cpu", pool=PagedKVPool(model, 128, 8))
+    engine.start()
+    try:
+        futures = [engine.submit(p, threading.Event(), 16, 0.0, 1.0, []) for p in prompts]
+        results = [future.result(timeout=120) for future in futures]
+    finally:
+        engine.stop()
+
+    for prompt, result in zip(prompts, results):
+        with torch.inference_mode():
+            output = model.generate(
+                input_ids=torch.tensor([prompt]), attention_mask=torch.ones(1, len(prompt), dtype=torch.long),
+                max_new_tokens=16, do_sample=False, pad_token_id=tokenizer.pad_token_id
+            )
+        assert result["token_ids"] == output[0, len(prompt):].tolist()
+
+
+def test_blocks_are_reused_after_free(stand_in):
+    model, _ = stand_in
+    pool = PagedKVPool(model, 4, 8)
+    first = BlockTable()
+    pool.reserve(first, 32)
+    assert pool.num_free == 0
+    blocks = list(first.blocks)
+
+    pool.free(first)
+    assert pool.num_free == 4 and first.blocks == []
+    second = BlockTable()
+    pool.reserve(second, 32)
+    assert sorted(second.blocks) == sorted(blocks)
+
+
+def test_shared_tail_block_is_copied_on_write(stand_in):
+    model, _ = stand_in
+    pool = PagedKVPool(model, 8, 8)
+    table = BlockTable()
+    pool.reserve(table, 12)
+    table.length = 12  # one full block, a tail block with 4 positions
+    tail = table.blocks[1]
+    rows = slice(tail * 8, tail * 8 + 4)
+    for keys in pool.keys:
+        keys[rows] = 1.0
+
+    fork = pool.fork(table)
+    assert fork.blocks == table.blocks and pool.allocator.refs[tail] == 2
+    pool.reserve(fork, 1)
+
+    copy = fork.blocks[1]
+    assert copy != tail and fork.blocks[0] == table.blocks[0]
+    assert pool.allocator.refs[tail] == 1 and pool.allocator.refs[table.blocks[0]] == 2
+    for keys in pool.keys:
+        assert torch.equal(keys[copy * 8:copy * 8 + 4], keys[rows])
+    # The fork writing its position 12 leaves the original's tail block alone
+    for keys in pool.keys:
+        keys[copy * 8 + 4] = 2.0
+        assert not keys[tail * 8 + 4].eq(2.0).any()
+
+
+def test_out_of_blocks(stand_in):
+    model, tokenizer = stand_in
+    pool = PagedKVPool(model, 2, 8)
+    table = BlockTable()
+    with pytest.raises(OutOfBlocks):
+        pool.reserve(table, 17)
+    # All or nothing
+    assert table.blocks == [] and pool.num_free == 2
+
+    # A prompt that can never fit fails its request instead of waiting forever
+    engine = GenerationEngine(model, tokenizer, "cpu", pool=pool)
+    engine.start()
+    try:
+        future = engine.submit(list(range(40)), threading.Event(), 4, 0.0, 1.0, [])
+        with pytest.raises(OutOfBlocks):
+            future.result(timeout=60)
+        # The engine keeps serving requests that fit
+        assert engine.submit([1, 2, 3], threading.Event(), 2, 0.0, 1.0, []).result(timeout=60)["generated_tokens"] == 2
+    finally:
+        engine.stop()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_rate_limit.py
+"""Token-bucket Lua script: burst, refill, cost, and failing open with Redis down"""
+import asyncio
+
+import fakeredis
+import pytest
+from fakeredis.commands_mixins import server_mixin
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from rate_limit import RedisRateLimiter, parse_tier_limits
+
+
+class Clock:
+    """Stands in for the Redis server clock (TIME) the script reads"""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server_mixin, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def limiter(server):
+    redis_client = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+
+    async def get_redis():
+        return redis_client
+
+    return RedisRateLimiter(get_redis, "standard=5/minute,admin=60/minute")
+
+
+def checks(limiter, calls):
+    async def run():
+        return [await limiter.check(*call) for call in calls]
+
+    return asyncio.run(run())
+
+
+def test_burst_up_to_capacity(limiter, clock):
+    results = checks(limiter, [("alice", "standard")] * 6)
+    assert [r["allowed"] for r in results] == [True] * 5 + [False]
+    assert [r["remaining"] for r in results] == [4, 3, 2, 1, 0, 0]
+    # One token every 12 s, the bucket is full again a minute after the burst
+    assert results[-1]["retry_after"] == 12 and results[-1]["reset"] == 60
+    assert all(r["limit"] == 5 for r in results)
+
+
+def test_refill_is_gradual_and_capped(limiter, clock):
+    checks(limiter, [("alice", "standard")] * 5)
+
+    clock.now += 11.9
+    assert not checks(limiter, [("alice", "standard")])[0]["allowed"]
+    clock.now += 0.1
+    assert checks(limiter, [("alice", "standard")])[0]["allowed"]
+
+    # Idle for an hour: a full bucket, not 300 tokens
+    clock.now += 3600
+    results = checks(limiter, [("alice", "standard")] * 6)
+    assert [r["allowed"] for r in results] == [True] * 5 + [False]
+
+
+def test_cost_and_separate_buckets(limiter, clock):
+    results = checks(limiter, [("alice", "standard", 3), ("alice", "standard", 3), ("bob", "standard", 5),
+                               ("alice", "admin", 60), ("carol", "unknown")])
+    assert [r["allowed"] for r in results] == [True, False, True, True, True]
+    # 2 left, 1 more needed: 12 s
+    assert results[1]["remaining"] == 2 and results[1]["retry_after"] == 12
+    # Unknown tiers get the default tier's limit
+    assert results[4]["limit"] == 5 and results[4]["remaining"] == 4
+
+
+def test_enforce_sets_headers_and_raises(limiter, clock):
+    request = Request({"type": "http", "headers": []})
+    user = {"user_id": "alice", "tier": "standard"}
+
+    async def run():
+        for _ in range(5):
+            await limiter.enforce(request, user)
+        with pytest.raises(HTTPException) as error:
+            await limiter.enforce(request, user)
+        return error.value
+
+    error = asyncio.run(run())
+    assert request.state.rate_limit_headers == {
+        "X-RateLimit-Limit": "5", "X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "60"
+    }
+    assert error.status_code == 429 and error.headers["Retry-After"] == "12"
+
+
+def test_redis_down_fails_open(limiter, server, clock):
+    request = Request({"type": "http", "headers": []})
+    server.connected = False
+
+    async def run():
+        with pytest.raises(Exception):
+            await limiter.check("alice", "standard")
+        # Every request gets through, without rate-limit headers
+        for _ in range(10):
+            await limiter.enforce(request, {"user_id": "alice", "tier": "standard"})
+
+    asyncio.run(run())
+    assert not hasattr(request.state, "rate_limit_headers")
+
+    # Back up: the bucket was never touched
+    server.connected = True
+    assert checks(limiter, [("alice", "standard")])[0]["remaining"] == 4
+
+
+def test_script_flush_is_survived(limiter, server, clock):
+    async def run():
+        await limiter.check("alice", "standard")
+        await (await limiter.get_redis()).script_flush()
+        return await limiter.check("alice", "standard")
+
+    assert asyncio.run(run())["remaining"] == 3
+
+
+def test_parse_tier_limits():
+    assert parse_tier_limits(" standard = 5/minute, batch=100 / hour ,") == {
+        "standard": (5, 60), "batch": (100, 3600)
+    }
+    with pytest.raises(ValueError):
+        parse_tier_limits("standard=5/fortnight")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_sampling.py
+"""n / best_of / seed on the dynamic-cache decode path (tiny stand-in model, CPU)"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import api_client
+from model_runtime import generate_tokens
+from prefix_cache import PrefixKVCache
+
+
+def sample(stand_in, prompt, **kwargs):
+    model, tokenizer = stand_in
+    params = dict(max_tokens=16, temperature=0.8, top_p=0.95, stop=[])
+    params.update(kwargs)
+    return generate_tokens(model, tokenizer, "cpu", prompt, threading.Event(), **params)
+
+
+def test_seeded_samples_are_reproducible_under_concurrency(stand_in):
+    prompt = list(range(5, 25))
+    alone = sample(stand_in, prompt, samples=3, seed=7)
+
+    # Seeded and unseeded generations running at the same time do not share an RNG
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(sample, stand_in, prompt, samples=3, seed=7 if i % 2 == 0 else None) for i in range(8)]
+        seeded = [future.result() for i, future in enumerate(futures) if i % 2 == 0]
+
+    assert all(result == alone for result in seeded)
+    choices = [c["token_ids"] for c in alone["choices"]]
+    assert len(set(map(tuple, choices))) == 3
+    assert all(c["generated_tokens"] == 16 and c["logprob"] < 0 for c in alone["choices"])
+
+
+def test_samples_decode_as_one_batch(stand_in):
+    prompt = list(range(5, 25))
+    batch = sample(stand_in, prompt, samples=3, seed=7)["choices"]
+    # Sample i is the completion a lone request with seed + i gets
+    for index, choice in enumerate(batch):
+        assert sample(stand_in, prompt, seed=7 + index)["token_ids"] == choice["token_ids"]
+
+    greedy = sample(stand_in, prompt, samples=3, temperature=0.0)["choices"]
+    assert all(c["token_ids"] == sample(stand_in, prompt, temperature=0.0)["token_ids"] for c in greedy)
+
+
+def test_rows_stop_independently(stand_in):
+    model, tokenizer = stand_in
+    prompt = list(range(5, 25))
+    choices = sample(stand_in, prompt, samples=4, seed=3, max_tokens=24)["choices"]
+    # A stop string from the middle of the first sample only ends that one early
+    stop = tokenizer.decode(choices[0]["token_ids"][8:10])
+    stopped = sample(stand_in, prompt, samples=4, seed=3, max_tokens=24, stop=[stop])["choices"]
+
+    assert stopped[0]["stopped"] == "stop_sequence" and stopped[0]["generated_tokens"] <= 10
+    assert stopped[0]["token_ids"] == choices[0]["token_ids"][:stopped[0]["generated_tokens"]]
+    for before, after in zip(choices[1:], stopped[1:]):
+        if after["stopped"] is None:
+            assert after["token_ids"] == before["token_ids"] and after["finish_reason"] == "length"
+
+
+def test_batched_samples_store_one_prefix_entry(stand_in):
+    prefix_cache = PrefixKVCache(min_tokens=8)
+    prompt = list(range(5, 45))
+    sample(stand_in, prompt, samples=3, seed=1, prefix_cache=prefix_cache)
+
+    (tokens, cache, _), = prefix_cache.entries.values()
+    assert tokens.tolist() == prompt
+    assert cache.get_seq_length() == len(prompt) and cache.layers[0].keys.shape[0] == 1
+    # A later request reuses it
+    assert sample(stand_in, prompt + [7], prefix_cache=prefix_cache)["prefix_tokens_reused"] == len(prompt)
+
+
+def test_chat_best_of_with_seed(api):
+    body = {"messages": [{"role": "user", "content": "name three colors"}], "max_tokens": 8,
+            "temperature": 0.9, "n": 2, "best_of": 4, "seed": 11}
+
+    async def run():
+        api_key = await api.api_key_manager.create_api_key("sampling-user", tier="admin")
+        headers = {"Authorization": f"Bearer {api_key}"}
+        async with api_client(api.app) as client:
+            first = await client.post("/v1/chat/completions", headers=headers, json=body)
+            api.qwen_api.memory_cache.clear()
+            await api.qwen_api.redis_client.flushdb()
+            second = await client.post("/v1/chat/completions", headers=headers, json=body)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.status_code == 200 and len(first.json()["choices"]) == 2
+    # Decoded again from scratch, the seed gives the same answer
+    assert [c["message"] for c in first.json()["choices"]] == [c["message"] for c in second.json()["choices"]]
+    assert first.json()["usage"]["completion_tokens"] <= 4 * 8
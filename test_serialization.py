@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_serialization.py
+"""RawJSON splicing and pre-serialized cache records"""
+import json
+
+import pytest
+
+from serialization import (
+    FastJSONResponse, RawJSON, _split_record, decode_cache_record, dumps, dumps_with_raw, encode_cache_record
+)
+
+TEXTS = ["", "plain", 'quotes " and \\ backslashes \\" \\\\', 'looks like a field ,"text":"x"} ', "ünïcode \n\t \x00"]
+
+
+def test_dumps_with_raw_splices_values_verbatim():
+    obj = {
+        "a": RawJSON('{"pre": [1, 2]}'),
+        "list": [RawJSON('"x"'), 3, {"deep": RawJSON("null")}],
+        # Looks like a placeholder, but NUL is escaped in JSON strings
+        "b": "\x00raw0\x00",
+    }
+    encoded = dumps_with_raw(obj)
+    assert b'{"pre": [1, 2]}' in encoded
+    assert json.loads(encoded) == {"a": {"pre": [1, 2]}, "list": ["x", 3, {"deep": None}], "b": "\x00raw0\x00"}
+    assert dumps_with_raw({"plain": [1, "two"]}) == dumps({"plain": [1, "two"]})
+    assert json.loads(FastJSONResponse({"text": RawJSON(dumps("hi").decode())}).body) == {"text": "hi"}
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_cache_record_round_trip(text):
+    choices = [{"text": text, "finish_reason": "stop"}]
+    for meta in ({}, {"finish_reason": "length", "completion_tokens": 7}, {"choices": choices, "token_ids": [1, 2]}):
+        record = encode_cache_record(text, **meta)
+        decoded = decode_cache_record(record)
+        assert json.loads(decoded.pop("text_json")) == text
+        assert decoded == meta
+        # Without decoding the text: the stored bytes are spliced as they are
+        assert _split_record(record)[1] == dumps(text).decode()
+
+
+@pytest.mark.parametrize("record, meta", [
+    ('{"text":"first","finish_reason":"stop"}', {"finish_reason": "stop"}),
+    ('{"a":1,"text":"middle","b":2}', {"a": 1, "b": 2}),
+    ('{"text":"top","extra":{"n":1,"text":"nested"}}', {"extra": {"n": 1, "text": "nested"}}),
+    ('{"extra":{"n":1,"text":"nested"},"text":"last"}', {"extra": {"n": 1, "text": "nested"}}),
+    ('{ "finish_reason" : "stop" , "text" : "spaced" }', {"finish_reason": "stop"}),
+])
+def test_other_layouts_are_decoded(record, meta):
+    assert _split_record(record) is None or record.endswith('"last"}')
+    decoded = decode_cache_record(record)
+    text = json.loads(decoded.pop("text_json"))
+    assert decoded == meta and text == json.loads(record)["text"]
+
+
+@pytest.mark.parametrize("record", ["not json", '{"finish_reason":"stop"}', '{"text":3}', '["text"]', ""])
+def test_non_records_are_rejected(record):
+    with pytest.raises(ValueError):
+        decode_cache_record(record)
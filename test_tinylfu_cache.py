@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_tinylfu_cache.py
+"""W-TinyLFU admission, sketch aging and segmented-LRU eviction"""
+import pytest
+from prometheus_client import REGISTRY
+
+from tinylfu_cache import CountMinSketch, TinyLFUCache
+
+
+def admissions(decision: str) -> float:
+    return REGISTRY.get_sample_value("qwen_memory_cache_admissions_total", {"decision": decision}) or 0.0
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def lookup(cache: TinyLFUCache, key: str):
+    """The API server's pattern: get, and set on a miss"""
+    if cache.get(key) is None:
+        cache[key] = f"value of {key}"
+
+
+def test_hot_keys_survive_a_scan():
+    cache = TinyLFUCache(100, ttl=3600, tier=None)
+    hot = [f"hot-{i}" for i in range(60)]
+    for _ in range(5):
+        for key in hot:
+            lookup(cache, key)
+    rejected = admissions("rejected")
+
+    # A batch job's one-off prompts, ten times the cache size, while the hot ones keep coming
+    for i in range(1000):
+        lookup(cache, f"scan-{i}")
+        lookup(cache, hot[i % len(hot)])
+
+    assert all(key in cache for key in hot)
+    # The one-offs only get the room the hot keys leave
+    assert len(cache) == 100
+    assert sum(f"scan-{i}" in cache for i in range(1000)) == 100 - len(hot)
+    # Most are turned away at admission (sketch collisions let a few replace each other)
+    assert admissions("rejected") > rejected + 700
+
+
+def test_window_eviction_beats_a_colder_victim():
+    cache = TinyLFUCache(10, ttl=3600, tier=None)
+    for i in range(10):
+        cache[f"cold-{i}"] = i
+    assert len(cache) == 10 and cache.window_size == 1
+    admitted = admissions("admitted")
+
+    # Looked up (missed) more often than the probation LRU entry, then set
+    for _ in range(3):
+        cache.get("popular")
+    cache["popular"] = "value"
+    cache["next"] = "value"  # pushes "popular" out of the window
+
+    assert "popular" in cache and "cold-0" not in cache
+    assert admissions("admitted") == admitted + 1
+
+
+def test_sketch_counts_saturate_and_age():
+    sketch = CountMinSketch(capacity=64, sample_size=1000)
+    for _ in range(300):
+        sketch.increment("busy")
+    assert sketch.frequency("busy") == 255
+    assert sketch.frequency("never seen") == 0
+
+    sketch = CountMinSketch(capacity=64, sample_size=100)
+    for _ in range(60):
+        sketch.increment("old")
+    for _ in range(39):
+        sketch.increment("other")
+    assert (sketch.frequency("old"), sketch.frequency("other")) == (60, 39)
+    # The 100th increment halves every counter, so old popularity fades
+    sketch.increment("other")
+    assert (sketch.frequency("old"), sketch.frequency("other")) == (30, 20)
+    assert sketch.additions == 50
+
+
+def test_second_hit_protects_an_entry():
+    cache = TinyLFUCache(100, ttl=3600, tier=None)
+    for i in range(5):
+        cache[f"key-{i}"] = i
+    # Out of the window (size 1) into probation, in insertion order
+    assert list(cache.probation) == [f"key-{i}" for i in range(4)] and list(cache.window) == ["key-4"]
+
+    assert cache.get("key-1") == 1
+    assert list(cache.protected) == ["key-1"]
+    # The coldest goes first: probation LRU, then the window, then protected
+    assert [cache.popitem()[0] for _ in range(5)] == ["key-0", "key-2", "key-3", "key-4", "key-1"]
+    with pytest.raises(KeyError):
+        cache.popitem()
+
+
+def test_protected_overflow_is_demoted_to_probation():
+    cache = TinyLFUCache(11, ttl=3600, tier=None)
+    assert (cache.window_size, cache.probation_size, cache.protected_size) == (1, 2, 8)
+    for i in range(11):
+        cache[f"key-{i}"] = i
+    for i in range(9):
+        cache.get(f"key-{i}")
+
+    # Protected holds 8; the least recently promoted goes back to probation, not out
+    assert list(cache.protected) == [f"key-{i}" for i in range(1, 9)]
+    assert "key-0" in cache.probation and len(cache) == 11
+
+
+def test_entries_expire_after_ttl():
+    clock = Clock()
+    cache = TinyLFUCache(100, ttl=60, timer=clock, tier=None)
+    cache["a"] = 1
+    clock.now = 30
+    cache["b"] = 2
+    clock.now = 60
+    assert "a" not in cache and cache.get("a") is None
+    with pytest.raises(KeyError):
+        cache["a"]
+    assert cache["b"] == 2 and list(cache) == ["b"]
+
+    # Setting again restarts the clock
+    cache["b"] = 3
+    clock.now = 100
+    assert cache.get("b") == 3
+    clock.now = 150
+    assert len(cache) == 0
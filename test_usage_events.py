@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# ~/qwen-api/test_usage_events.py
+"""Daily request counters and rollups written from the usage stream"""
+import asyncio
+import hashlib
+import time
+from collections import deque
+
+import fakeredis
+from prometheus_client import REGISTRY
+
+from auth import APIKeyManager
+from usage_events import USAGE_GROUP, USAGE_STREAM, UsagePipeline
+
+
+def test_flush_counts_requests_and_skips_revoked_keys():
+    async def run():
+        redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        manager = APIKeyManager()
+        manager.redis_client = redis_client
+
+        async def get_redis():
+            return redis_client
+
+        pipeline = UsagePipeline(get_redis)
+        kept = await manager.create_api_key("kept-user")
+        revoked = await manager.create_api_key("revoked-user")
+        kept_data = await manager.verify_api_key(kept)
+        revoked_data = await manager.verify_api_key(revoked)
+        for user_data in (kept_data, kept_data, kept_data, revoked_data):
+            pipeline.record(user_data, endpoint="generate", model="m", prompt_tokens=3,
+                            completion_tokens=5, latency=0.1, cached=False)
+        await manager.revoke_api_keys([revoked_data["key_hash"]])
+
+        assert await pipeline.flush() == 4
+        revoked_hash = hashlib.sha256(revoked.encode()).hexdigest()
+        return (
+            await redis_client.hget(f"apikey:{kept_data['key_hash']}", "requests_today"),
+            await redis_client.exists(f"apikey:{revoked_hash}"),
+            await redis_client.xlen(USAGE_STREAM),
+        )
+
+    requests_today, revoked_exists, events = asyncio.run(run())
+    assert requests_today == "3"
+    # The revoked key's record is not recreated by its late increment
+    assert revoked_exists == 0
+    assert events == 4
+
+
+def pipeline_with_key(redis_client):
+    manager = APIKeyManager()
+    manager.redis_client = redis_client
+
+    async def get_redis():
+        return redis_client
+
+    return manager, UsagePipeline(get_redis)
+
+
+def record(pipeline, user_data, count: int, ts: float = None):
+    for _ in range(count):
+        pipeline.record(user_data, endpoint="generate", model="m", prompt_tokens=3,
+                        completion_tokens=5, latency=0.1, cached=False)
+        if ts is not None:
+            pipeline.buffer[-1]["ts"] = ts
+
+
+def test_events_of_a_dead_consumer_are_claimed():
+    async def run():
+        redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        manager, pipeline = pipeline_with_key(redis_client)
+        user_data = await manager.verify_api_key(await manager.create_api_key("claimed-user"))
+        await pipeline.ensure_group()
+        record(pipeline, user_data, 3)
+        await pipeline.flush()
+
+        # Reads the events, then its process dies before the rollup and ack
+        await redis_client.xreadgroup(USAGE_GROUP, "old-host-1", {USAGE_STREAM: ">"}, count=10)
+        assert await pipeline.aggregate_once(block_ms=1) == 0
+
+        claimed = await pipeline.claim_stale(min_idle_ms=0)
+        pending = await redis_client.xpending(USAGE_STREAM, USAGE_GROUP)
+        consumers = [c["name"] for c in await redis_client.xinfo_consumers(USAGE_STREAM, USAGE_GROUP)]
+        return claimed, pending["pending"], consumers, await pipeline.get_user_usage("claimed-user")
+
+    claimed, pending, consumers, usage = asyncio.run(run())
+    assert claimed == 3 and pending == 0
+    assert "old-host-1" not in consumers
+    assert usage["today"]["requests"] == 3 and usage["today"]["completion_tokens"] == 15
+
+
+def test_buffered_events_count_against_their_own_day():
+    async def run():
+        redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        manager, pipeline = pipeline_with_key(redis_client)
+        user_data = await manager.verify_api_key(await manager.create_api_key("midnight-user"))
+        # Still buffered from yesterday when the counter was reset for today
+        record(pipeline, user_data, 4, ts=time.time() - 86400)
+        record(pipeline, user_data, 2)
+        assert await pipeline.flush() == 6
+        return await redis_client.hget(f"apikey:{user_data['key_hash']}", "requests_today")
+
+    assert asyncio.run(run()) == "2"
+
+
+def test_full_buffer_counts_dropped_events():
+    dropped_before = REGISTRY.get_sample_value("qwen_usage_events_dropped_total") or 0.0
+
+    async def run():
+        redis_client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        manager, pipeline = pipeline_with_key(redis_client)
+        pipeline.buffer = deque(maxlen=4)
+        user_data = await manager.verify_api_key(await manager.create_api_key("busy-user"))
+        record(pipeline, user_data, 6)
+        assert pipeline.dropped == 2
+        await pipeline.flush()
+        return pipeline.dropped, await redis_client.xlen(USAGE_STREAM)
+
+    assert asyncio.run(run()) == (0, 4)
+    assert REGISTRY.get_sample_value("qwen_usage_events_dropped_total") == dropped_before + 2
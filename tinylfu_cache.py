@@ -0,0 +1,214 @@
+# ~/qwen-api/tinylfu_cache.py
+"""
+W-TinyLFU in-memory cache: frequency-aware admission, TTL expiry.
+
+A plain LRU/TTL cache admits everything, so a burst of one-off prompts (a
+batch job) pushes out the prompts an IDE sends over and over. Here every
+lookup is counted in a count-min sketch (4 rows of saturating byte
+counters, halved every 10 x maxsize lookups so old popularity fades). New
+entries go to a small LRU window (1% of maxsize) that absorbs short
+bursts. An entry falling out of the window only enters the main cache if
+the sketch has seen it more often than the main cache's eviction victim.
+The main cache is a segmented LRU: entries hit a second time move from
+probation (20%) to protected (80%).
+
+Entries expire ttl seconds after they were set, as with cachetools'
+TTLCache. The class has the mapping methods the API server uses, so it
+replaces the TTLCache as is; get() is the lookup that counts.
+"""
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterator, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+# Lookups per hit-ratio gauge update
+HIT_RATIO_WINDOW = 1000
+
+# One gauge value per process (the HTTP workers each have their own memory cache)
+CACHE_HIT_RATIO = Gauge(
+    'qwen_cache_hit_ratio', f'Cache hit ratio over the last {HIT_RATIO_WINDOW} lookups', ['tier'],
+    multiprocess_mode='liveall'
+)
+CACHE_ADMISSIONS = Counter(
+    'qwen_memory_cache_admissions_total', 'Window evictions admitted to or rejected from the main memory cache',
+    ['decision']
+)
+
+_MASK64 = (1 << 64) - 1
+# Odd 64-bit multipliers, one per sketch row
+_SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+_HALVE = bytes(i >> 1 for i in range(256))
+
+
+class HitRatio:
+    """Hit ratio over consecutive windows of lookups, published to CACHE_HIT_RATIO{tier}"""
+
+    def __init__(self, tier: str, window: int = HIT_RATIO_WINDOW):
+        self.gauge = CACHE_HIT_RATIO.labels(tier=tier)
+        self.window = window
+        self.hits = 0
+        self.lookups = 0
+
+    def record(self, hit: bool):
+        self.hits += hit
+        self.lookups += 1
+        if self.lookups >= self.window:
+            self.gauge.set(self.hits / self.lookups)
+            self.hits = self.lookups = 0
+
+
+class CountMinSketch:
+    """Approximate access counts, saturating at 255, all halved every sample_size increments"""
+
+    def __init__(self, capacity: int, sample_size: int):
+        self.bits = max(4, (max(capacity, 1) - 1).bit_length() + 1)  # about 2 x capacity counters per row
+        self.rows = [bytearray(1 << self.bits) for _ in _SEEDS]
+        self.sample_size = sample_size
+        self.additions = 0
+
+    def _indexes(self, key: Hashable):
+        h = hash(key) & _MASK64
+        h ^= h >> 32
+        return [((h * seed) & _MASK64) >> (64 - self.bits) for seed in _SEEDS]
+
+    def increment(self, key: Hashable):
+        for row, index in zip(self.rows, self._indexes(key)):
+            if row[index] < 255:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.rows = [row.translate(_HALVE) for row in self.rows]
+            self.additions //= 2
+
+    def frequency(self, key: Hashable) -> int:
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+
+class TinyLFUCache:
+    def __init__(self, maxsize: int, ttl: float, timer: Callable[[], float] = time.monotonic,
+                 window_ratio: float = 0.01, tier: Optional[str] = "memory"):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.window_size = max(1, round(maxsize * window_ratio))
+        main = max(0, maxsize - self.window_size)
+        self.protected_size = int(main * 0.8)
+        self.probation_size = main - self.protected_size
+        self.window: "OrderedDict[Hashable, object]" = OrderedDict()
+        self.probation: "OrderedDict[Hashable, object]" = OrderedDict()
+        self.protected: "OrderedDict[Hashable, object]" = OrderedDict()
+        # Insertion order is expiry order, ttl being the same for every entry
+        self.deadlines: "OrderedDict[Hashable, float]" = OrderedDict()
+        self.sketch = CountMinSketch(maxsize, 10 * maxsize)
+        self.hit_ratio = HitRatio(tier) if tier else None
+
+    def _segment(self, key: Hashable) -> Optional[OrderedDict]:
+        for segment in (self.window, self.probation, self.protected):
+            if key in segment:
+                return segment
+        return None
+
+    def _live(self, key: Hashable) -> Optional[OrderedDict]:
+        """Segment holding key, None if absent or expired (then removed)"""
+        segment = self._segment(key)
+        if segment is not None and self.deadlines[key] <= self.timer():
+            del segment[key]
+            del self.deadlines[key]
+            return None
+        return segment
+
+    def expire(self):
+        now = self.timer()
+        while self.deadlines:
+            key, deadline = next(iter(self.deadlines.items()))
+            if deadline > now:
+                break
+            del self.deadlines[key]
+            del self._segment(key)[key]
+
+    def get(self, key: Hashable, default=None):
+        """Lookup, counted for admission (hit or miss) and for the hit ratio"""
+        self.sketch.increment(key)
+        segment = self._live(key)
+        if self.hit_ratio is not None:
+            self.hit_ratio.record(segment is not None)
+        if segment is None:
+            return default
+        value = segment[key]
+        if segment is self.probation:
+            # Second hit: promote, the protected LRU end goes back to probation
+            del self.probation[key]
+            self.protected[key] = value
+            if len(self.protected) > self.protected_size:
+                demoted, demoted_value = self.protected.popitem(last=False)
+                self.probation[demoted] = demoted_value
+        else:
+            segment.move_to_end(key)
+        return value
+
+    def __getitem__(self, key: Hashable):
+        segment = self._live(key)
+        if segment is None:
+            raise KeyError(key)
+        return segment[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._live(key) is not None
+
+    def __setitem__(self, key: Hashable, value):
+        self.expire()
+        segment = self._segment(key)
+        if segment is not None:
+            segment[key] = value
+            segment.move_to_end(key)
+        else:
+            self.window[key] = value
+        self.deadlines[key] = self.timer() + self.ttl
+        self.deadlines.move_to_end(key)
+        while len(self.window) > self.window_size:
+            self._admit(*self.window.popitem(last=False))
+
+    def _admit(self, candidate: Hashable, value):
+        """Window eviction: into probation if there is room or it is used more than the victim"""
+        if len(self.probation) + len(self.protected) < self.probation_size + self.protected_size:
+            self.probation[candidate] = value
+            return
+        victims = self.probation or self.protected
+        victim = next(iter(victims)) if victims else None
+        if victim is not None and self.sketch.frequency(candidate) > self.sketch.frequency(victim):
+            del victims[victim]
+            del self.deadlines[victim]
+            self.probation[candidate] = value
+            CACHE_ADMISSIONS.labels(decision="admitted").inc()
+        else:
+            del self.deadlines[candidate]
+            CACHE_ADMISSIONS.labels(decision="rejected").inc()
+
+    def __delitem__(self, key: Hashable):
+        segment = self._segment(key)
+        if segment is None:
+            raise KeyError(key)
+        del segment[key]
+        del self.deadlines[key]
+
+    def popitem(self) -> Tuple[Hashable, object]:
+        """Evict the coldest entry: probation LRU, then the window, then protected"""
+        for segment in (self.probation, self.window, self.protected):
+            if segment:
+                key, value = segment.popitem(last=False)
+                del self.deadlines[key]
+                return key, value
+        raise KeyError("cache is empty")
+
+    def clear(self):
+        for segment in (self.window, self.probation, self.protected, self.deadlines):
+            segment.clear()
+
+    def __len__(self) -> int:
+        self.expire()
+        return len(self.deadlines)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        self.expire()
+        return iter(list(self.deadlines))
@@ -0,0 +1,285 @@
+# ~/qwen-api/usage_events.py
+"""
+Asynchronous usage accounting.
+
+Requests only append an event to an in-process buffer. A background flusher
+writes buffered events to a Redis Stream in one pipeline (together with the
+per-key daily request counters), and an aggregation consumer folds the
+stream into per-user hourly and daily rollups that /stats reads.
+
+The daily request counter (requests_today, checked by verify_api_key) is
+therefore eventually consistent:
+- only requests that record a usage event count, so failed or rejected
+  generations are free;
+- a key can go past its daily_limit by what is still buffered (up to
+  USAGE_FLUSH_INTERVAL of its traffic per process), and buffered counts are
+  lost if the process dies;
+- events count against the UTC day they happened on: those still buffered
+  when the key's counter is reset for a new day are not counted again;
+- counts for a key revoked in the meantime are dropped instead of
+  recreating a partial apikey:<hash> record;
+- a full buffer (USAGE_BUFFER_MAX, Redis down for long) drops the oldest
+  events, counted in qwen_usage_events_dropped_total.
+
+Events a consumer read but never acked (its process died) are claimed by
+another consumer once idle for USAGE_CLAIM_IDLE_MS, so they still reach
+the rollups.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+USAGE_STREAM = "usage:events"
+USAGE_GROUP = "usage-aggregators"
+USAGE_STREAM_MAXLEN = int(os.getenv("USAGE_STREAM_MAXLEN", "1000000"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0"))
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "500"))
+USAGE_BUFFER_MAX = int(os.getenv("USAGE_BUFFER_MAX", "100000"))
+# Well above the time to fold one batch, so live consumers are never raced
+USAGE_CLAIM_IDLE_MS = int(os.getenv("USAGE_CLAIM_IDLE_MS", "60000"))
+
+HOURLY_TTL = 7 * 86400
+DAILY_TTL = 90 * 86400
+
+# KEYS[1] apikey hash; ARGV increment, day of the requests. Never recreates a
+# revoked key (no last_reset) nor counts a past day against the current one.
+INCREMENT_IF_SAME_DAY_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'last_reset') == ARGV[2] then
+    return redis.call('HINCRBY', KEYS[1], 'requests_today', ARGV[1])
+end
+return false
+"""
+
+USAGE_EVENTS_DROPPED = Counter(
+    'qwen_usage_events_dropped_total', 'Usage events dropped before reaching the stream (buffer full)'
+)
+
+# Summed per rollup bucket
+ROLLUP_FIELDS = ("requests", "prompt_tokens", "completion_tokens", "cache_hits", "latency_ms")
+
+
+def hourly_key(user_id: str, ts: float) -> str:
+    return f"usage:hourly:{user_id}:{datetime.fromtimestamp(ts, timezone.utc):%Y%m%d%H}"
+
+
+def daily_key(user_id: str, ts: float) -> str:
+    return f"usage:daily:{user_id}:{datetime.fromtimestamp(ts, timezone.utc):%Y%m%d}"
+
+
+def usage_day(ts: float) -> str:
+    """UTC day in the format of the key's last_reset"""
+    return datetime.fromtimestamp(ts, timezone.utc).date().isoformat()
+
+
+class UsagePipeline:
+    def __init__(self, get_redis: Callable[[], Awaitable]):
+        self.get_redis = get_redis
+        self.buffer: deque = deque(maxlen=USAGE_BUFFER_MAX)
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self.tasks: List[asyncio.Task] = []
+        self.increment_script = None
+        # Dropped since the last warning
+        self.dropped = 0
+
+    def record(
+        self,
+        user_data: Dict,
+        endpoint: str,
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        latency: float,
+        cached: bool
+    ):
+        """Queue one usage event; never touches Redis on the request path"""
+        if len(self.buffer) == self.buffer.maxlen:
+            self._count_dropped(1)
+        self.buffer.append({
+            "user_id": user_data["user_id"],
+            "key_hash": user_data.get("key_hash", ""),
+            "tier": user_data.get("tier", ""),
+            "endpoint": endpoint,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency_ms": int(latency * 1000),
+            "cached": int(cached),
+            "ts": time.time()
+        })
+
+    def _count_dropped(self, count: int):
+        self.dropped += count
+        USAGE_EVENTS_DROPPED.inc(count)
+
+    async def flush(self) -> int:
+        """Write buffered events to the stream in one pipeline"""
+        if self.dropped:
+            logger.warning(f"Usage buffer full, {self.dropped} events dropped")
+            self.dropped = 0
+        if not self.buffer:
+            return 0
+        batch = [self.buffer.popleft() for _ in range(min(len(self.buffer), USAGE_BATCH_SIZE))]
+
+        # Daily limit counters, formerly incremented inside verify_api_key
+        requests: Dict[Tuple[str, str], int] = {}
+        for event in batch:
+            if event["key_hash"]:
+                key = (event["key_hash"], usage_day(event["ts"]))
+                requests[key] = requests.get(key, 0) + 1
+
+        try:
+            redis_client = await self.get_redis()
+            if self.increment_script is None:
+                self.increment_script = redis_client.register_script(INCREMENT_IF_SAME_DAY_SCRIPT)
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for event in batch:
+                    pipe.xadd(USAGE_STREAM, event, maxlen=USAGE_STREAM_MAXLEN, approximate=True)
+                for (key_hash, day), count in requests.items():
+                    # Queued on the pipeline, awaiting only adds it
+                    await self.increment_script(keys=[f"apikey:{key_hash}"], args=[count, day], client=pipe)
+                await pipe.execute()
+        except Exception as e:
+            # Keep the events for the next attempt; a full buffer drops the newest
+            overflow = len(self.buffer) + len(batch) - self.buffer.maxlen
+            if overflow > 0:
+                self._count_dropped(overflow)
+            self.buffer.extendleft(reversed(batch))
+            logger.warning(f"Usage flush failed, {len(self.buffer)} events buffered: {e}")
+            return 0
+
+        return len(batch)
+
+    async def ensure_group(self):
+        redis_client = await self.get_redis()
+        try:
+            await redis_client.xgroup_create(USAGE_STREAM, USAGE_GROUP, id="0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def aggregate_once(self, block_ms: int = 1000) -> int:
+        """Fold one batch of stream events into hourly/daily rollups"""
+        redis_client = await self.get_redis()
+        response = await redis_client.xreadgroup(
+            USAGE_GROUP, self.consumer, {USAGE_STREAM: ">"}, count=USAGE_BATCH_SIZE, block=block_ms
+        )
+        if not response:
+            return 0
+        _, entries = response[0]
+        return await self._fold(redis_client, entries)
+
+    async def claim_stale(self, min_idle_ms: int = USAGE_CLAIM_IDLE_MS) -> int:
+        """Fold events left pending by consumers that died before acking them"""
+        redis_client = await self.get_redis()
+        claimed = 0
+        start = "0-0"
+        while True:
+            start, entries, *_ = await redis_client.xautoclaim(
+                USAGE_STREAM, USAGE_GROUP, self.consumer, min_idle_ms, start_id=start, count=USAGE_BATCH_SIZE
+            )
+            # Entries trimmed from the stream in the meantime have no fields
+            entries = [(entry_id, event) for entry_id, event in entries if event]
+            if entries:
+                claimed += await self._fold(redis_client, entries)
+            if start in ("0-0", b"0-0"):
+                break
+
+        # Every restart joins as a new hostname-pid consumer, forget the old ones
+        for consumer in await redis_client.xinfo_consumers(USAGE_STREAM, USAGE_GROUP):
+            if consumer["name"] != self.consumer and consumer["pending"] == 0 and consumer["idle"] >= min_idle_ms:
+                await redis_client.xgroup_delconsumer(USAGE_STREAM, USAGE_GROUP, consumer["name"])
+        return claimed
+
+    async def _fold(self, redis_client, entries: List) -> int:
+        rollups: Dict[str, Dict[str, int]] = {}
+        for _, event in entries:
+            ts = float(event["ts"])
+            values = {
+                "requests": 1,
+                "prompt_tokens": int(event["prompt_tokens"]),
+                "completion_tokens": int(event["completion_tokens"]),
+                "cache_hits": int(event["cached"]),
+                "latency_ms": int(event["latency_ms"])
+            }
+            for key in (hourly_key(event["user_id"], ts), daily_key(event["user_id"], ts)):
+                bucket = rollups.setdefault(key, dict.fromkeys(ROLLUP_FIELDS, 0))
+                for field, value in values.items():
+                    bucket[field] += value
+
+        # Ack in the same transaction so a crash cannot double count
+        async with redis_client.pipeline(transaction=True) as pipe:
+            for key, bucket in rollups.items():
+                for field, value in bucket.items():
+                    pipe.hincrby(key, field, value)
+                pipe.expire(key, HOURLY_TTL if key.startswith("usage:hourly:") else DAILY_TTL)
+            pipe.xack(USAGE_STREAM, USAGE_GROUP, *[entry_id for entry_id, _ in entries])
+            await pipe.execute()
+
+        return len(entries)
+
+    async def get_user_usage(self, user_id: str, hours: int = 24) -> Dict:
+        """Today's rollup and the last N hourly buckets for one user"""
+        now = time.time()
+        hour_keys = [hourly_key(user_id, now - 3600 * i) for i in range(hours)]
+        redis_client = await self.get_redis()
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(daily_key(user_id, now))
+            for key in hour_keys:
+                pipe.hgetall(key)
+            results = await pipe.execute()
+
+        def as_ints(bucket: Dict) -> Dict[str, int]:
+            return {field: int(bucket.get(field, 0)) for field in ROLLUP_FIELDS}
+
+        return {
+            "today": as_ints(results[0]),
+            "hourly": [
+                {"hour": key.rsplit(":", 1)[1], **as_ints(bucket)}
+                for key, bucket in zip(hour_keys, results[1:]) if bucket
+            ]
+        }
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            while await self.flush() == USAGE_BATCH_SIZE:
+                pass
+
+    async def _aggregate_loop(self):
+        while True:
+            try:
+                await self.ensure_group()
+                next_claim = 0.0
+                while True:
+                    if time.monotonic() >= next_claim:
+                        claimed = await self.claim_stale()
+                        if claimed:
+                            logger.warning(f"Recovered {claimed} usage events left pending by a stopped consumer")
+                        next_claim = time.monotonic() + USAGE_CLAIM_IDLE_MS / 1000
+                    await self.aggregate_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Usage aggregation error: {e}")
+                await asyncio.sleep(5)
+
+    def start(self):
+        self.tasks = [
+            asyncio.create_task(self._flush_loop()),
+            asyncio.create_task(self._aggregate_loop())
+        ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        while self.buffer and await self.flush():
+            pass